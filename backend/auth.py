@@ -1,13 +1,24 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import Lock
+from time import time
+import asyncio
+import hashlib
+import logging
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
 from pydantic import BaseModel, EmailStr, Field
 import os
 from database import get_db, Usuario
+from tracing import span
+logger = logging.getLogger(__name__)
 # Configuración
 SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
@@ -16,8 +27,22 @@ if not SECRET_KEY:
     warnings.warn("SECRET_KEY no configurada. Usando clave de desarrollo. NO USAR EN PRODUCCIÓN.")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 días
+# Cache de tokens verificados (por proceso)
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))  # Segundos; 0 desactiva
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", "16"))
+PASSWORD_HASH_RETRY_AFTER = int(os.getenv("PASSWORD_HASH_RETRY_AFTER", "2"))  # Segundos
+# min/max = default: hashes con otro costo quedan marcados para rehash al hacer login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
 # Security scheme
 security = HTTPBearer()
 # ==================== SCHEMAS ====================
@@ -43,11 +68,165 @@ class UserResponse(BaseModel):
     created_at: datetime
     class Config:
         from_attributes = True
+@dataclass(frozen=True)
+class CurrentUser:
+    # Snapshot mínimo del usuario autenticado que usan los endpoints protegidos
+    id: int
+    username: str
+    is_active: bool
+    is_admin: bool
+    @classmethod
+    def from_usuario(cls, user: Usuario) -> "CurrentUser":
+        return cls(
+            id=user.id,
+            username=user.username,
+            is_active=user.is_active,
+            is_admin=user.is_admin
+        )
+# ==================== CACHE DE AUTENTICACIÓN ====================
+class AuthCache:
+    def __init__(self, ttl: int = 60, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[CurrentUser, float]]" = OrderedDict()
+        self._by_user: Dict[int, Set[str]] = {}  # Para invalidar todos los tokens de un usuario
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+    @staticmethod
+    def _key(token: str) -> str:
+        # No guardar el token en claro en memoria
+        return hashlib.sha256(token.encode()).hexdigest()
+    def get(self, token: str) -> Optional[CurrentUser]:
+        if self.ttl <= 0:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, expires_at = entry
+            if time() >= expires_at:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return user
+    def set(self, token: str, user: CurrentUser, token_exp: Optional[float] = None):
+        if self.ttl <= 0:
+            return
+        expires_at = time() + self.ttl
+        if token_exp:
+            # Nunca servir un token más allá de su expiración
+            expires_at = min(expires_at, float(token_exp))
+        key = self._key(token)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (user, expires_at)
+            self._by_user.setdefault(user.id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+    def _remove(self, key: str):
+        user, _ = self._entries.pop(key)
+        keys = self._by_user.get(user.id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user.id]
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+auth_cache = AuthCache(ttl=AUTH_CACHE_TTL, max_entries=AUTH_CACHE_MAX_ENTRIES)
+_CAMPOS_CACHEADOS = ("is_active", "is_admin", "username")
+def _marcar_para_invalidar(target: Usuario):
+    # Se invalida recién en after_commit: antes, un request concurrente podría
+    # leer el estado viejo de la BD y volver a cachearlo hasta AUTH_CACHE_TTL
+    session = object_session(target)
+    if session is None:
+        auth_cache.invalidate_user(target.id)
+        return
+    session.info.setdefault("auth_invalidar", set()).add(target.id)
+@event.listens_for(Usuario, "after_update")
+def _invalidar_usuario_actualizado(mapper, connection, target):
+    # Desactivación, cambio de rol o username: invalidar tokens cacheados.
+    # Nota: query.update() masivo no dispara eventos ORM; el TTL acota ese caso
+    state = inspect(target)
+    if any(state.attrs[campo].history.has_changes() for campo in _CAMPOS_CACHEADOS):
+        _marcar_para_invalidar(target)
+@event.listens_for(Usuario, "after_delete")
+def _invalidar_usuario_eliminado(mapper, connection, target):
+    _marcar_para_invalidar(target)
+@event.listens_for(Session, "after_commit")
+def _invalidar_tras_commit(session):
+    for user_id in session.info.pop("auth_invalidar", ()):
+        auth_cache.invalidate_user(user_id)
+@event.listens_for(Session, "after_rollback")
+def _descartar_invalidaciones(session):
+    # Rollback: el usuario no cambió, lo cacheado sigue siendo válido
+    session.info.pop("auth_invalidar", None)
 # ==================== FUNCIONES DE HASHING ====================
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
+class PasswordHashPool:
+    # bcrypt es CPU-bound (cientos de ms): se ejecuta fuera del event loop en un
+    # pool dedicado, con cola acotada para rechazar rápido cuando está saturado
+    def __init__(self, workers: int = 2, queue_size: int = 16, retry_after: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.capacity = workers + queue_size
+        self.retry_after = retry_after
+        self.pending = 0
+        self.rejected = 0
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            logger.warning(f"Pool de hashing saturado ({self.pending} pendientes)")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="El servidor está ocupado. Intenta nuevamente en unos segundos.",
+                headers={"Retry-After": str(self.retry_after)}
+            )
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+    def get_stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "capacity": self.capacity,
+            "rejected": self.rejected,
+            "bcrypt_rounds": BCRYPT_ROUNDS
+        }
+password_pool = PasswordHashPool(
+    workers=PASSWORD_HASH_WORKERS,
+    queue_size=PASSWORD_HASH_QUEUE_SIZE,
+    retry_after=PASSWORD_HASH_RETRY_AFTER
+)
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    # Devuelve (válido, nuevo_hash); nuevo_hash != None si el costo configurado cambió
+    return await password_pool.run(pwd_context.verify_and_update, plain_password, hashed_password)
+async def get_password_hash_async(password: str) -> str:
+    return await password_pool.run(pwd_context.hash, password)
 # ==================== JWT ====================
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     from datetime import timezone
@@ -70,46 +249,57 @@ def decode_access_token(token: str) -> dict:
             headers={"WWW-Authenticate": "Bearer"},
         )
 # ==================== AUTENTICACIÓN ====================
-def authenticate_user(db: Session, username: str, password: str) -> Optional[Usuario]:
+async def authenticate_user(db: Session, username: str, password: str) -> Optional[Usuario]:
     user = db.query(Usuario).filter(Usuario.username == username).first()
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await verify_password_async(password, user.hashed_password)
+    if not valid:
         return None
+    if new_hash:
+        # Rehash transparente con el BCRYPT_ROUNDS actual (se guarda con el login)
+        user.hashed_password = new_hash
     return user
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
-) -> Usuario:
+) -> CurrentUser:
     token = credentials.credentials
-    try:
-        payload = decode_access_token(token)
-        user_id: int = payload.get("sub")
-        if user_id is None:
+    with span("auth"):
+        cached_user = auth_cache.get(token)
+        if cached_user is not None:
+            return cached_user
+        try:
+            payload = decode_access_token(token)
+            # "sub" viaja como string (python-jose rechaza otro tipo): id del usuario
+            user_id = int(payload["sub"])
+        except (KeyError, TypeError, ValueError):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Token inválido",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-    except JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="No se pudo validar las credenciales",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    user = db.query(Usuario).filter(Usuario.id == user_id).first()
-    if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Usuario no encontrado"
-        )
-    if not user.is_active:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Usuario inactivo"
-        )
-    return user
-def get_current_admin(current_user: Usuario = Depends(get_current_user)) -> Usuario:
+        except JWTError:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="No se pudo validar las credenciales",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        user = db.query(Usuario).filter(Usuario.id == user_id).first()
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Usuario no encontrado"
+            )
+        if not user.is_active:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Usuario inactivo"
+            )
+        current_user = CurrentUser.from_usuario(user)
+        auth_cache.set(token, current_user, payload.get("exp"))
+    return current_user
+def get_current_admin(current_user: CurrentUser = Depends(get_current_user)) -> CurrentUser:
     if not current_user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -117,7 +307,7 @@ def get_current_admin(current_user: Usuario = Depends(get_current_user)) -> Usua
         )
     return current_user
 # ==================== FUNCIONES DE USUARIO ====================
-def create_user(
+async def create_user(
     db: Session,
     user_data: UserCreate,
     skip_email_verification: bool = False
@@ -148,7 +338,7 @@ def create_user(
         verification_token = generate_verification_token()
         verification_expires = datetime.now() + timedelta(hours=24)
     # Crear usuario
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
     db_user = Usuario(
         username=user_data.username,
         email=user_data.email,
@@ -167,20 +357,22 @@ def create_user(
     if verification_token:
         send_verification_email(db_user.email, verification_token, db_user.username)
     return db_user
-def login_user(db: Session, login_data: UserLogin) -> Token:
-    user = authenticate_user(db, login_data.username, login_data.password)
+async def login_user(db: Session, login_data: UserLogin) -> Token:
+    user = await authenticate_user(db, login_data.username, login_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Username o contraseña incorrectos",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return issue_token(db, user)
+def issue_token(db: Session, user: Usuario) -> Token:
     # Actualizar último login
     from datetime import timezone
     user.last_login = datetime.now(timezone.utc)
     db.commit()
     # Crear token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = create_access_token(data={"sub": str(user.id)})
     return Token(
         access_token=access_token,
         token_type="bearer",
@@ -200,7 +392,7 @@ if __name__ == "__main__":
     print(f"Hash: {hashed}")
     print(f"Verify: {verify_password(password, hashed)}")
     # Test de token
-    token = create_access_token(data={"sub": 1})
+    token = create_access_token(data={"sub": "1"})
     print(f"\nToken: {token}")
     decoded = decode_access_token(token)
     print(f"Decoded: {decoded}")
\ No newline at end of file
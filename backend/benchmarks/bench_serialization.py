@@ -0,0 +1,95 @@
+import argparse
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
+from timeit import repeat
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+import serialization
+from models import TareaResponse
+# Payload representativo de /api/desambiguar (texto en español, ~10 ítems por lista)
+PASO = "Definir el alcance del análisis y los criterios de evaluación del mercado objetivo"
+RESULTADO = {
+    "pasos": [f"{PASO} ({i})" for i in range(10)],
+    "ambiguedades": [f"No se especifica la fecha de entrega exacta ({i})" for i in range(6)],
+    "preguntas_sugeridas": [f"¿Cuál es el formato requerido para el documento? ({i})" for i in range(6)],
+}
+def _response_data():
+    return {
+        **RESULTADO,
+        "metadata": {
+            "total_pasos": 10,
+            "total_ambiguedades": 6,
+            "total_preguntas": 6,
+            "timestamp": datetime.now().isoformat(),
+            "cached": False
+        }
+    }
+def _log_context():
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "message": "AI call - Input: 480 chars, Time: 2300ms, Success: True",
+        "input_length": 480,
+        "response_time_ms": 2300.5,
+        "success": True,
+        "user_id": 42,
+        "pasos_count": 10,
+        "ambiguedades_count": 6
+    }
+def _por_request(dumps, loads, render):
+    # Lo que paga un análisis: respuesta HTTP + 3 columnas JSON + 2 líneas de log,
+    # más la lectura de una página de historial (10 filas x 3 columnas)
+    data = _response_data()
+    render(jsonable_encoder(TareaResponse(**data)))
+    stored = [dumps(data["pasos"]), dumps(data["ambiguedades"]), dumps(data["preguntas_sugeridas"])]
+    dumps(_log_context())
+    dumps(_log_context())
+    for _ in range(10):
+        for columna in stored:
+            loads(columna)
+def _stdlib_render(content):
+    return JSONResponse(content).body
+def _fast_render(content):
+    return serialization.FastJSONResponse(content).body
+def _medir(func, number: int, repeticiones: int) -> float:
+    tiempos = repeat(func, number=number, repeat=repeticiones)
+    return min(tiempos) / number * 1e6  # µs por operación
+def main():
+    parser = argparse.ArgumentParser(description="Costo de serialización JSON por request")
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Salida en formato JSON")
+    args = parser.parse_args()
+    casos = {
+        "stdlib": (json.dumps, json.loads, _stdlib_render),
+        f"serialization[{serialization.JSON_BACKEND}]": (
+            serialization.dumps, serialization.loads, _fast_render
+        ),
+    }
+    resultados = {}
+    for nombre, (dumps, loads, render) in casos.items():
+        resultados[nombre] = {
+            "response_us": _medir(
+                lambda: render(jsonable_encoder(TareaResponse(**_response_data()))),
+                args.number, args.repeat
+            ),
+            "db_write_us": _medir(
+                lambda: [dumps(v) for v in RESULTADO.values()], args.number, args.repeat
+            ),
+            "log_line_us": _medir(lambda: dumps(_log_context()), args.number, args.repeat),
+            "per_request_us": _medir(
+                lambda: _por_request(dumps, loads, render), args.number, args.repeat
+            ),
+        }
+    if args.json:
+        print(json.dumps({"backend": serialization.JSON_BACKEND, "results": resultados}, indent=2))
+        return
+    print(f"Backend activo: {serialization.JSON_BACKEND}\n")
+    columnas = ["response_us", "db_write_us", "log_line_us", "per_request_us"]
+    print(f"{'caso':<28}" + "".join(f"{c:>16}" for c in columnas))
+    for nombre, valores in resultados.items():
+        print(f"{nombre:<28}" + "".join(f"{valores[c]:>16.2f}" for c in columnas))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import html
+import json
+import random
+import re
+import sys
+from pathlib import Path
+from timeit import repeat
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from models import TareaRequest, sanitizar_texto
+SEED = 1234
+# Alfabeto de prueba: controles, whitespace Unicode que strip() elimina, caracteres
+# que escapa html.escape, acentos, CJK, emoji y surrogates sueltos
+ALFABETO = (
+    [chr(c) for c in range(32)]
+    + list("\x7f\x85\xa0\u2002\u2028\u3000\ufeff")
+    + list("&<>\"'")
+    + list("aZ09 .,;:¿?¡!")
+    + list("áéíóúñÑü€")
+    + ["中", "文", "😀", "👍🏽", "\ud800", "\udfff"]
+)
+def _sanitizar_referencia(v: str) -> str:
+    # Implementación original, carácter por carácter
+    texto_limpio = ''.join(char for char in v if ord(char) >= 32 or char in '\n\r\t')
+    return html.escape(texto_limpio.strip())
+def _validar_referencia(v: str) -> str:
+    if not v or not v.strip():
+        raise ValueError('El texto no puede estar vacío')
+    texto_limpio = _sanitizar_referencia(v)
+    if not re.search(r'[a-zA-Z0-9]', texto_limpio):
+        raise ValueError('El texto debe contener al menos caracteres alfanuméricos')
+    if len(texto_limpio) < 10:
+        raise ValueError('El texto debe tener al menos 10 caracteres válidos')
+    return texto_limpio
+def _resultado(func, v: str):
+    try:
+        return func(v)
+    except ValueError as e:
+        return ("ValueError", str(e))
+def _caso(rng: random.Random) -> str:
+    largo = rng.choice([0, 1, 2, 5, 10, 11, 50, 300, 2000])
+    # Mezcla de textos "normales" con ruido y ruido puro
+    ruido = rng.random()
+    base = "Hacer un análisis del mercado para el viernes. "
+    return "".join(
+        rng.choice(ALFABETO) if rng.random() < ruido else base[i % len(base)]
+        for i in range(largo)
+    )
+def verificar_equivalencia(casos: int) -> int:
+    rng = random.Random(SEED)
+    fallos = 0
+    entradas = [_caso(rng) for _ in range(casos)]
+    entradas += ALFABETO + ["".join(ALFABETO) * 3, "&" * 20, " \x1c\x1f " * 5 + "texto válido 123"]
+    for v in entradas:
+        for referencia, nueva in (
+            (_sanitizar_referencia, sanitizar_texto),
+            (_validar_referencia, TareaRequest.validar_texto),
+        ):
+            esperado, obtenido = _resultado(referencia, v), _resultado(nueva, v)
+            if esperado != obtenido:
+                fallos += 1
+                if fallos <= 5:
+                    print(f"Diferencia en {nueva.__name__}({v!r}): {esperado!r} != {obtenido!r}")
+    return fallos
+def _texto(largo: int, frase: str) -> str:
+    return (frase * (largo // len(frase) + 1))[:largo]
+def _medir(func, v: str, number: int, repeticiones: int) -> float:
+    tiempos = repeat(lambda: func(v), number=number, repeat=repeticiones)
+    return min(tiempos) / number * 1e6  # µs por operación
+def main():
+    parser = argparse.ArgumentParser(description="Equivalencia y costo de TareaRequest.validar_texto")
+    parser.add_argument("--cases", type=int, default=20000, help="Casos aleatorios de equivalencia")
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Salida en formato JSON")
+    args = parser.parse_args()
+    fallos = verificar_equivalencia(args.cases)
+    textos = {
+        "una_linea": "Hacer un análisis del mercado para el viernes y enviarlo al equipo. ",
+        "multilinea": "Preparar el informe trimestral:\n\t- ventas y márgenes\n",
+        "con_html": "Revisar <b>precios</b> & \"descuentos\" del proveedor.\x07\n",
+    }
+    resultados = {}
+    for nombre, frase in textos.items():
+        for largo in (50, 500, 2000):
+            v = _texto(largo, frase)
+            resultados[f"{nombre}_{largo}"] = {
+                "referencia_us": _medir(_validar_referencia, v, args.number, args.repeat),
+                "actual_us": _medir(TareaRequest.validar_texto, v, args.number, args.repeat),
+            }
+    if args.json:
+        print(json.dumps({"cases": args.cases, "mismatches": fallos, "results": resultados}, indent=2))
+    else:
+        print(f"Equivalencia: {args.cases} casos aleatorios, {fallos} diferencias\n")
+        print(f"{'caso':<20}{'referencia_us':>16}{'actual_us':>16}{'speedup':>10}")
+        for nombre, valores in resultados.items():
+            speedup = valores["referencia_us"] / valores["actual_us"]
+            print(f"{nombre:<20}{valores['referencia_us']:>16.2f}{valores['actual_us']:>16.2f}{speedup:>9.1f}x")
+    if fallos:
+        sys.exit(1)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import httpx
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+# Mezcla por defecto (pesos relativos). No hay endpoint de exportación: "export"
+# pide una página grande del historial, que es lo que descarga el frontend
+MEZCLA_DEFAULT = {
+    "analyze_hit": 30,
+    "analyze_miss": 15,
+    "history": 30,
+    "export": 5,
+    "login": 15,
+    "register": 5,
+}
+TEXTOS_CALIENTES = [
+    "Hacer un ensayo sobre la Segunda Guerra Mundial para el viernes",
+    "Para el viernes quiero un análisis del mercado actual",
+    "Crear una app para gestionar tareas pendientes",
+    "Preparar una presentación sobre cambio climático",
+    "Necesito datos de ventas que muestren crecimiento ASAP",
+]
+PASSWORD = "loadtest-password"
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True,
+            stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+def _percentil(ordenados: List[float], q: float) -> Optional[float]:
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))]
+class Servidor:
+    # La API en un proceso aparte (uvicorn), con backend de IA fake y SQLite temporal
+    def __init__(self, workdir: Path, port: int, args: argparse.Namespace):
+        self.workdir = workdir
+        self.port = port
+        self.base_url = f"http://127.0.0.1:{port}"
+        env = {
+            **os.environ,
+            "AI_BACKEND": "fake",
+            "FAKE_LATENCY_MEDIAN_MS": str(args.ai_latency_ms),
+            "FAKE_LATENCY_SIGMA": str(args.ai_latency_sigma),
+            "FAKE_ERROR_RATE": str(args.ai_error_rate),
+            "FAKE_SEED": str(args.seed),
+            "DATABASE_URL": f"sqlite:///{workdir / 'loadtest.db'}",
+            "ENABLE_RATE_LIMIT": "false",
+            "ENABLE_ENDPOINT_RATE_LIMITS": "false",  # Registro 3/hora y login 5/min por IP
+            "REQUIRE_API_KEY": "false",
+            "EMAIL_VERIFICATION_REQUIRED": "false",
+            "ENABLE_PROFILING": "false",
+            "JOB_WORKERS": "0",
+        }
+        if args.bcrypt_rounds:
+            env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+        self._env = env
+        self._proc: Optional[subprocess.Popen] = None
+    def start(self, timeout: float = 30.0):
+        # cwd temporal: .env, logs y traces del benchmark no tocan el repo
+        self._proc = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--app-dir", str(BACKEND_DIR),
+                "--host", "127.0.0.1", "--port", str(self.port),
+                "--log-level", "warning", "--no-access-log",
+            ],
+            cwd=self.workdir,
+            env=self._env,
+            stdout=subprocess.DEVNULL,
+            stderr=open(self.workdir / "server.log", "w"),
+        )
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            if self._proc.poll() is not None:
+                raise RuntimeError(f"El servidor terminó al iniciar; ver {self.workdir / 'server.log'}")
+            try:
+                if httpx.get(f"{self.base_url}/health", timeout=1.0).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("Timeout esperando al servidor")
+    def stop(self):
+        if self._proc and self._proc.poll() is None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+class Carga:
+    def __init__(self, client: httpx.AsyncClient, rng: random.Random):
+        self.client = client
+        self.rng = rng
+        self.usuarios: List[Dict[str, str]] = []  # {"username", "token"}
+        self.latencias: Dict[str, List[float]] = {}
+        self.estados: Dict[str, Dict[str, int]] = {}
+        self._contador = 0
+    def _nuevo_nombre(self, prefijo: str) -> str:
+        self._contador += 1
+        return f"{prefijo}{os.getpid()}x{self._contador}"
+    async def registrar(self) -> httpx.Response:
+        username = self._nuevo_nombre("lt")
+        response = await self.client.post("/api/auth/register", json={
+            "username": username,
+            "email": f"{username}@loadtest.example.com",
+            "password": PASSWORD,
+        })
+        if response.status_code == 200:
+            self.usuarios.append({"username": username, "token": response.json()["access_token"]})
+        return response
+    def _auth(self) -> Dict[str, str]:
+        usuario = self.rng.choice(self.usuarios)
+        return {"Authorization": f"Bearer {usuario['token']}"}
+    async def ejecutar(self, operacion: str) -> httpx.Response:
+        if operacion == "register":
+            return await self.registrar()
+        if operacion == "login":
+            usuario = self.rng.choice(self.usuarios)
+            return await self.client.post("/api/auth/login", json={
+                "username": usuario["username"], "password": PASSWORD
+            })
+        if operacion == "analyze_hit":
+            texto = self.rng.choice(TEXTOS_CALIENTES)
+            return await self.client.post("/api/desambiguar", json={"texto": texto}, headers=self._auth())
+        if operacion == "analyze_miss":
+            texto = f"Organizar el evento número {self._nuevo_nombre('')} con presupuesto acotado"
+            return await self.client.post("/api/desambiguar", json={"texto": texto}, headers=self._auth())
+        if operacion == "history":
+            offset = self.rng.randint(0, 20)
+            return await self.client.get(
+                f"/api/historial?limit=10&offset={offset}", headers=self._auth()
+            )
+        if operacion == "export":
+            return await self.client.get("/api/historial?limit=100&offset=0", headers=self._auth())
+        raise ValueError(f"Operación desconocida: {operacion}")
+    async def medir(self, operacion: str, programado: float):
+        # Latencia desde el instante programado (carga abierta: sin omisión coordinada)
+        try:
+            response = await self.ejecutar(operacion)
+            estado = str(response.status_code)
+        except httpx.HTTPError as e:
+            estado = type(e).__name__
+        self.latencias.setdefault(operacion, []).append(time.perf_counter() - programado)
+        estados = self.estados.setdefault(operacion, {})
+        estados[estado] = estados.get(estado, 0) + 1
+    async def preparar(self, n_usuarios: int):
+        for _ in range(n_usuarios):
+            response = await self.registrar()
+            if response.status_code != 200:
+                raise RuntimeError(f"No se pudo registrar usuario: {response.status_code} {response.text}")
+        # Sin tokens válidos todo lo medido serían 401: fallar acá con la causa real
+        response = await self.client.get("/api/auth/me", headers=self._auth())
+        if response.status_code != 200:
+            raise RuntimeError(f"El token emitido no autentica: {response.status_code} {response.text}")
+        # Calentar el cache con los textos frecuentes; si falla, los "hits" medidos no lo serían
+        for texto in TEXTOS_CALIENTES:
+            response = await self.client.post(
+                "/api/desambiguar", json={"texto": texto}, headers=self._auth()
+            )
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"No se pudo calentar el cache: {response.status_code} {response.text}"
+                )
+    async def correr(self, mezcla: Dict[str, int], rate: float, duracion: float, poisson: bool):
+        operaciones = list(mezcla)
+        pesos = [mezcla[op] for op in operaciones]
+        tareas = []
+        inicio = time.perf_counter()
+        siguiente = inicio
+        while siguiente - inicio < duracion:
+            espera = siguiente - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            operacion = self.rng.choices(operaciones, weights=pesos)[0]
+            tareas.append(asyncio.create_task(self.medir(operacion, siguiente)))
+            siguiente += self.rng.expovariate(rate) if poisson else 1.0 / rate
+        await asyncio.gather(*tareas)
+        return time.perf_counter() - inicio
+def _resumen(latencias: List[float], estados: Dict[str, int], segundos: float) -> Dict[str, Any]:
+    ordenadas = sorted(latencias)
+    ok = sum(n for estado, n in estados.items() if estado.startswith("2"))
+    def ms(valor: Optional[float]) -> Optional[float]:
+        return round(valor * 1000, 2) if valor is not None else None
+    return {
+        "count": len(ordenadas),
+        "ok": ok,
+        "errors": len(ordenadas) - ok,
+        "status": dict(sorted(estados.items())),
+        "throughput_rps": round(ok / segundos, 2) if segundos else 0.0,
+        "p50_ms": ms(_percentil(ordenadas, 0.50)),
+        "p90_ms": ms(_percentil(ordenadas, 0.90)),
+        "p99_ms": ms(_percentil(ordenadas, 0.99)),
+        "max_ms": ms(ordenadas[-1] if ordenadas else None),
+    }
+async def _ejecutar(args: argparse.Namespace, base_url: str, mezcla: Dict[str, int]) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        carga = Carga(client, random.Random(args.seed))
+        await carga.preparar(args.users)
+        if args.warmup > 0:
+            await carga.correr(mezcla, args.rate, args.warmup, args.poisson)
+            carga.latencias.clear()
+            carga.estados.clear()
+        segundos = await carga.correr(mezcla, args.rate, args.duration, args.poisson)
+    endpoints = {
+        operacion: _resumen(carga.latencias[operacion], carga.estados[operacion], segundos)
+        for operacion in sorted(carga.latencias)
+    }
+    todas = [valor for valores in carga.latencias.values() for valor in valores]
+    estados_totales: Dict[str, int] = {}
+    for estados in carga.estados.values():
+        for estado, n in estados.items():
+            estados_totales[estado] = estados_totales.get(estado, 0) + n
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rate_rps": args.rate,
+            "duration_s": args.duration,
+            "arrivals": "poisson" if args.poisson else "fixed",
+            "users": args.users,
+            "mix": mezcla,
+            "ai_latency_ms": args.ai_latency_ms,
+            "ai_error_rate": args.ai_error_rate,
+            "seed": args.seed,
+        },
+        "endpoints": endpoints,
+        "total": _resumen(todas, estados_totales, segundos),
+    }
+def _imprimir(resultado: Dict[str, Any]):
+    meta = resultado["meta"]
+    print(f"commit={meta['commit']} rate={meta['rate_rps']} rps duración={meta['duration_s']}s\n")
+    print(f"{'endpoint':<14}{'count':>8}{'errors':>8}{'rps':>10}{'p50_ms':>10}{'p90_ms':>10}{'p99_ms':>10}")
+    filas = {**resultado["endpoints"], "TOTAL": resultado["total"]}
+    for nombre, r in filas.items():
+        print(
+            f"{nombre:<14}{r['count']:>8}{r['errors']:>8}{r['throughput_rps']:>10.2f}"
+            f"{r['p50_ms'] or 0:>10.1f}{r['p90_ms'] or 0:>10.1f}{r['p99_ms'] or 0:>10.1f}"
+        )
+def comparar(base: Dict[str, Any], actual: Dict[str, Any], umbral: float) -> bool:
+    # True si hay regresión: p99 o p50 peor que el umbral relativo, o más errores
+    regresion = False
+    print(f"\nComparación {base['meta'].get('commit')} -> {actual['meta'].get('commit')} (umbral {umbral:.0%})")
+    print(f"{'endpoint':<14}{'p50 Δ':>10}{'p99 Δ':>10}{'rps Δ':>10}{'err Δ':>8}")
+    filas = {**actual["endpoints"], "TOTAL": actual["total"]}
+    filas_base = {**base["endpoints"], "TOTAL": base["total"]}
+    for nombre, r in filas.items():
+        b = filas_base.get(nombre)
+        if not b or not b["p50_ms"] or not r["p50_ms"]:
+            continue
+        d50 = r["p50_ms"] / b["p50_ms"] - 1
+        d99 = r["p99_ms"] / b["p99_ms"] - 1
+        drps = r["throughput_rps"] / b["throughput_rps"] - 1 if b["throughput_rps"] else 0.0
+        derr = r["errors"] - b["errors"]
+        marca = ""
+        if d50 > umbral or d99 > umbral or derr > 0:
+            regresion = True
+            marca = "  <- regresión"
+        print(f"{nombre:<14}{d50:>+10.1%}{d99:>+10.1%}{drps:>+10.1%}{derr:>+8d}{marca}")
+    return regresion
+def _parse_mezcla(valor: str) -> Dict[str, int]:
+    # "analyze_hit=50,history=50"
+    mezcla = {}
+    for parte in valor.split(","):
+        operacion, _, peso = parte.partition("=")
+        if operacion.strip() not in MEZCLA_DEFAULT:
+            raise argparse.ArgumentTypeError(f"Operación desconocida: {operacion}")
+        mezcla[operacion.strip()] = int(peso)
+    return mezcla
+def main():
+    parser = argparse.ArgumentParser(
+        description="Prueba de carga end-to-end contra la API (backend de IA fake, SQLite temporal)"
+    )
+    parser.add_argument("--rate", type=float, default=20.0, help="Llegadas por segundo")
+    parser.add_argument("--duration", type=float, default=30.0, help="Segundos medidos")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Segundos de calentamiento (no medidos)")
+    parser.add_argument("--poisson", action="store_true", help="Llegadas Poisson en vez de intervalo fijo")
+    parser.add_argument("--users", type=int, default=20, help="Usuarios registrados antes de medir")
+    parser.add_argument("--mix", type=_parse_mezcla, default=MEZCLA_DEFAULT,
+                        help="Pesos, p.ej. analyze_hit=50,history=30,login=20")
+    parser.add_argument("--ai-latency-ms", type=float, default=800.0, help="Mediana de latencia del modelo fake")
+    parser.add_argument("--ai-latency-sigma", type=float, default=0.5)
+    parser.add_argument("--ai-error-rate", type=float, default=0.0)
+    parser.add_argument("--bcrypt-rounds", type=int, default=None, help="Por defecto el de la API")
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--url", help="Usar una API ya levantada en vez de iniciar una")
+    parser.add_argument("--output", help="Guardar resultados JSON en este archivo")
+    parser.add_argument("--json", action="store_true", help="Salida en formato JSON")
+    parser.add_argument("--compare", help="JSON de una corrida anterior para comparar")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Regresión relativa tolerada en p50/p99 (con --compare)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="demystify-loadtest-") as workdir:
+        servidor = None
+        base_url = args.url
+        if not base_url:
+            servidor = Servidor(Path(workdir), _puerto_libre(), args)
+            servidor.start()
+            base_url = servidor.base_url
+        try:
+            resultado = asyncio.run(_ejecutar(args, base_url, args.mix))
+        finally:
+            if servidor:
+                servidor.stop()
+    if args.output:
+        Path(args.output).write_text(json.dumps(resultado, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.json:
+        print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    else:
+        _imprimir(resultado)
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if comparar(base, resultado, args.threshold):
+            sys.exit(1)
+if __name__ == "__main__":
+    main()
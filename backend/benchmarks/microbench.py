@@ -0,0 +1,166 @@
+import argparse
+import json
+import platform
+import random
+import string
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import time
+from timeit import Timer
+from typing import Any, Callable, Dict, List, Tuple
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import serialization
+from auth import create_access_token, decode_access_token
+from encryption import decrypt_data, encrypt_data
+from middleware import RateLimitMiddleware, StatsTracker
+from models import TareaRequest
+from utils import SimpleCache, generate_cache_key
+SEED = 1234
+# Texto en español con acentos, saltos de línea, HTML y algún carácter de control
+FRASE = "Preparar el informe <b>trimestral</b> de ventas & márgenes para el viernes.\n\x07"
+def _texto(n: int) -> str:
+    return (FRASE * (n // len(FRASE) + 1))[:n]
+def _claves(n: int) -> List[str]:
+    rng = random.Random(SEED)
+    return ["".join(rng.choices(string.hexdigits, k=32)) for _ in range(n)]
+RESULTADO = {
+    "pasos": [f"Definir el alcance del análisis y los criterios de evaluación ({i})" for i in range(8)],
+    "ambiguedades": [f"No se especifica la fecha de entrega exacta ({i})" for i in range(5)],
+    "preguntas_sugeridas": [f"¿Cuál es el formato requerido para el documento? ({i})" for i in range(5)],
+}
+# Cada benchmark: (tamaños, tamaños en modo --quick, setup(tamaño) -> función a medir)
+def bench_validar_texto(n: int) -> Callable[[], Any]:
+    texto = _texto(n)
+    return lambda: TareaRequest.validar_texto(texto)
+def bench_generate_cache_key(n: int) -> Callable[[], Any]:
+    texto = _texto(n)
+    return lambda: generate_cache_key(texto)
+def _cache_lleno(n: int) -> Tuple[SimpleCache, List[str]]:
+    cache = SimpleCache(ttl=3600)
+    claves = _claves(min(n, 10000))
+    ahora = time()
+    valor = {**RESULTADO, "metadata": {"cached": False}}
+    # Llenado directo del dict: set() uno por uno haría lento el setup de 1M
+    cache.cache = {f"{i:032x}": (valor, ahora) for i in range(n)}
+    for clave in claves:
+        cache.cache[clave] = (valor, ahora)
+    return cache, claves
+def bench_cache_get(n: int) -> Callable[[], Any]:
+    cache, claves = _cache_lleno(n)
+    indices = iter(range(10 ** 12))
+    return lambda: cache.get(claves[next(indices) % len(claves)])
+def bench_cache_set(n: int) -> Callable[[], Any]:
+    cache, claves = _cache_lleno(n)
+    valor = RESULTADO
+    indices = iter(range(10 ** 12))
+    return lambda: cache.set(claves[next(indices) % len(claves)], valor)
+def bench_encrypt(n: int) -> Callable[[], Any]:
+    texto = _texto(n)
+    return lambda: encrypt_data(texto)
+def bench_decrypt(n: int) -> Callable[[], Any]:
+    cifrado = encrypt_data(_texto(n))
+    return lambda: decrypt_data(cifrado)
+def bench_create_token(n: int) -> Callable[[], Any]:
+    data = {"sub": "usuario_benchmark", "user_id": 42}
+    return lambda: create_access_token(data)
+def bench_decode_token(n: int) -> Callable[[], Any]:
+    token = create_access_token({"sub": "usuario_benchmark", "user_id": 42})
+    return lambda: decode_access_token(token)
+def bench_record_request(n: int) -> Callable[[], Any]:
+    # n = tiempos ya registrados (el tracker recorta a los últimos 1000)
+    tracker = StatsTracker()
+    tracker.response_times = [0.05] * n
+    return lambda: tracker.record_request("/api/desambiguar", "POST", 200, 0.05)
+def bench_clean_old_requests(n: int) -> Callable[[], Any]:
+    # n timestamps recientes para una IP: el filtrado no los descarta y el costo es estable
+    middleware = RateLimitMiddleware(app=None, requests_per_window=n + 1, window_seconds=3600)
+    ahora = datetime.now()
+    middleware.requests["10.0.0.1"] = [ahora - timedelta(seconds=i % 60) for i in range(n)]
+    return lambda: middleware._clean_old_requests("10.0.0.1")
+def bench_historial_filas(n: int) -> Callable[[], Any]:
+    # n filas como las lee /api/historial: 3 columnas JSON + texto cifrado
+    filas = [
+        (
+            encrypt_data(_texto(200)),
+            serialization.dumps(RESULTADO["pasos"]),
+            serialization.dumps(RESULTADO["ambiguedades"]),
+            serialization.dumps(RESULTADO["preguntas_sugeridas"]),
+        )
+        for _ in range(n)
+    ]
+    loads = serialization.loads
+    def decodificar():
+        return [
+            {
+                "texto_original": decrypt_data(texto),
+                "pasos": loads(pasos),
+                "ambiguedades": loads(ambiguedades),
+                "preguntas": loads(preguntas),
+            }
+            for texto, pasos, ambiguedades, preguntas in filas
+        ]
+    return decodificar
+BENCHMARKS: Dict[str, Tuple[List[int], List[int], Callable[[int], Callable[[], Any]]]] = {
+    "validar_texto": ([50, 500, 2000], [50, 2000], bench_validar_texto),
+    "generate_cache_key": ([50, 500, 2000], [50, 2000], bench_generate_cache_key),
+    "cache_get": ([1_000, 100_000, 1_000_000], [1_000, 100_000], bench_cache_get),
+    "cache_set": ([1_000, 100_000, 1_000_000], [1_000, 100_000], bench_cache_set),
+    "encrypt_data": ([50, 500, 2000], [50, 2000], bench_encrypt),
+    "decrypt_data": ([50, 500, 2000], [50, 2000], bench_decrypt),
+    "create_access_token": ([1], [1], bench_create_token),
+    "decode_access_token": ([1], [1], bench_decode_token),
+    "record_request": ([0, 500, 1000], [0, 1000], bench_record_request),
+    "clean_old_requests": ([10, 1_000, 10_000], [10, 1_000], bench_clean_old_requests),
+    "historial_filas": ([10, 100], [10], bench_historial_filas),
+}
+def _medir(func: Callable[[], Any], repeticiones: int, min_time: float) -> Tuple[float, int]:
+    timer = Timer(func)
+    # Calibrar para que cada repetición dure al menos min_time
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    tiempos = timer.repeat(repeat=repeticiones, number=number)
+    return min(tiempos) / number * 1e9, number  # ns por operación (mínimo: menos ruido)
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de primitivas del camino caliente")
+    parser.add_argument("--filter", help="Solo benchmarks cuyo nombre contenga este texto")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="Segundos mínimos por repetición (calibra el número de iteraciones)")
+    parser.add_argument("--quick", action="store_true", help="Menos tamaños (sin el cache de 1M)")
+    parser.add_argument("--json", action="store_true", help="Salida en formato JSON")
+    args = parser.parse_args()
+    random.seed(SEED)
+    resultados = []
+    for nombre, (tamanos, tamanos_quick, setup) in BENCHMARKS.items():
+        if args.filter and args.filter not in nombre:
+            continue
+        for tamano in (tamanos_quick if args.quick else tamanos):
+            func = setup(tamano)
+            ns, number = _medir(func, args.repeat, args.min_time)
+            resultados.append({
+                "name": nombre,
+                "size": tamano,
+                "ns_per_op": round(ns, 1),
+                "ops_per_sec": round(1e9 / ns, 1),
+                "number": number,
+                "repeat": args.repeat,
+            })
+            del func  # Liberar el cache de 1M antes del siguiente
+            if not args.json:
+                print(f"{nombre:<22}{tamano:>10}{ns:>16.1f} ns/op{1e9 / ns:>16.0f} ops/s")
+    if args.json:
+        print(json.dumps({
+            "meta": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "json_backend": serialization.JSON_BACKEND,
+                "timestamp": datetime.now().isoformat(),
+            },
+            "results": resultados,
+        }, indent=2, ensure_ascii=False))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import asyncio
+import zlib
+from time import thread_time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import logging
+try:
+    import brotli
+except ImportError:  # Opcional: sin él no se ofrece "br"
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # Opcional: sin él no se ofrece "zstd"
+    zstandard = None
+logger = logging.getLogger(__name__)
+# Tipos que vale la pena comprimir (JSON, texto); imágenes y binarios ya lo están
+_TIPOS_COMPRIMIBLES = ("application/json", "text/", "application/javascript", "application/xml")
+# SSE: cada evento debe llegar apenas se genera, sin buffers de compresión
+_TIPOS_EXCLUIDOS = ("text/event-stream",)
+def _disponible(encoding: str) -> bool:
+    return (encoding == "gzip"
+            or (encoding == "br" and brotli is not None)
+            or (encoding == "zstd" and zstandard is not None))
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    # "gzip, br;q=0.8, *;q=0" -> {"gzip": 1.0, "br": 0.8, "*": 0.0}
+    aceptados = {}
+    for parte in header.split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        nombre = nombre.strip().lower()
+        if not nombre:
+            continue
+        q = 1.0
+        parametro = parametros.strip()
+        if parametro.startswith("q="):
+            try:
+                q = float(parametro[2:])
+            except ValueError:
+                q = 0.0
+        aceptados[nombre] = q
+    return aceptados
+class _Compresor:
+    # Interfaz común para compresión en streaming: chunk(), y finish() al final
+    def __init__(self, encoding: str, nivel: int):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(nivel, zlib.DEFLATED, 31)  # 31 = cabecera gzip
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=nivel)
+        else:
+            self._obj = zstandard.ZstdCompressor(level=nivel).compressobj()
+    def chunk(self, data: bytes) -> bytes:
+        # Con flush para que cada chunk llegue al cliente sin esperar al siguiente
+        if self.encoding == "gzip":
+            return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self._obj.process(data) + self._obj.flush()
+        return self._obj.compress(data) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    def finish(self) -> bytes:
+        if self.encoding == "gzip":
+            return self._obj.flush(zlib.Z_FINISH)
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+def _comprimir_completo(encoding: str, nivel: int, data: bytes) -> Tuple[bytes, float]:
+    # Devuelve el cuerpo comprimido y el CPU usado (thread_time del thread que comprime)
+    inicio = thread_time()
+    if encoding == "gzip":
+        comprimido = zlib.compress(data, nivel, wbits=31)
+    elif encoding == "br":
+        comprimido = brotli.compress(data, quality=nivel)
+    else:
+        comprimido = zstandard.ZstdCompressor(level=nivel).compress(data)
+    return comprimido, thread_time() - inicio
+class CompressionStats:
+    # Solo se actualiza desde el event loop: sin lock
+    def __init__(self):
+        self.por_encoding: Dict[str, Dict[str, float]] = {}
+        self.skipped_small = 0
+        self.skipped_type = 0
+        self.offloaded = 0
+    def record(self, encoding: str, bytes_in: int, bytes_out: int, cpu_seconds: float,
+               streaming: bool = False):
+        stats = self.por_encoding.setdefault(encoding, {
+            "responses": 0, "streamed": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0
+        })
+        stats["responses"] += 0 if streaming else 1
+        stats["streamed"] += 1 if streaming else 0
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+        stats["cpu_seconds"] += cpu_seconds
+    def get_stats(self) -> Dict[str, Any]:
+        encodings = {}
+        for encoding, stats in self.por_encoding.items():
+            encodings[encoding] = {
+                **stats,
+                "cpu_seconds": round(stats["cpu_seconds"], 4),
+                "bytes_saved": stats["bytes_in"] - stats["bytes_out"],
+                "ratio": round(stats["bytes_out"] / stats["bytes_in"], 4) if stats["bytes_in"] else None,
+                # CPU por MB de entrada: costo comparable entre encodings y niveles
+                "cpu_ms_per_mb": (
+                    round(stats["cpu_seconds"] * 1000 / (stats["bytes_in"] / 1_000_000), 2)
+                    if stats["bytes_in"] else None
+                )
+            }
+        return {
+            "encodings": encodings,
+            "bytes_saved": sum(e["bytes_saved"] for e in encodings.values()),
+            "cpu_seconds": round(sum(e["cpu_seconds"] for e in encodings.values()), 4),
+            "skipped_small": self.skipped_small,
+            "skipped_type": self.skipped_type,
+            "offloaded": self.offloaded
+        }
+class CompressionMiddleware:
+    # Middleware ASGI puro (no BaseHTTPMiddleware): necesita reescribir headers
+    # y cuerpo chunk por chunk sin acumular respuestas en streaming.
+    # - Encoding según Accept-Encoding (q) y la preferencia de `encodings`;
+    #   br y zstd solo si sus librerías están instaladas.
+    # - Los chunks se acumulan hasta juntar `minimum_size` bytes (y uno más) o
+    #   hasta el mensaje final: así "cuerpo + mensaje final vacío", como envían
+    #   los BaseHTTPMiddleware, cuenta como cuerpo completo.
+    # - Cuerpos completos menores a `minimum_size` van sin comprimir; desde
+    #   `offload_size` se comprimen en un thread para no frenar el loop.
+    # - Las respuestas en streaming se comprimen por chunk (con flush); SSE no.
+    def __init__(self, app, minimum_size: int = 1024, offload_size: int = 65536,
+                 encodings: Tuple[str, ...] = ("zstd", "br", "gzip"),
+                 levels: Optional[Dict[str, int]] = None,
+                 stats: Optional[CompressionStats] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.encodings = tuple(e for e in encodings if _disponible(e))
+        self.levels = {"gzip": 6, "br": 4, "zstd": 3, **(levels or {})}
+        self.stats = stats or CompressionStats()
+        logger.info(f"Compresión de respuestas: {', '.join(self.encodings) or 'ninguna'}")
+    def _elegir(self, scope) -> Optional[str]:
+        header = ""
+        for nombre, valor in scope.get("headers", []):
+            if nombre == b"accept-encoding":
+                header = valor.decode("latin-1")
+                break
+        if not header:
+            return None
+        aceptados = parse_accept_encoding(header)
+        comodin = aceptados.get("*", 0.0)
+        candidatos = [(aceptados.get(e, comodin), -i, e) for i, e in enumerate(self.encodings)]
+        candidatos = [c for c in candidatos if c[0] > 0]
+        return max(candidatos)[2] if candidatos else None
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+        encoding = self._elegir(scope)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _Respuesta(self, encoding).run(scope, receive, send)
+    async def _comprimir(self, encoding: str, data: bytes) -> Tuple[bytes, float]:
+        nivel = self.levels[encoding]
+        if len(data) >= self.offload_size:
+            self.stats.offloaded += 1
+            return await asyncio.to_thread(_comprimir_completo, encoding, nivel, data)
+        return _comprimir_completo(encoding, nivel, data)
+class _Respuesta:
+    # Estado de una respuesta: el inicio se retiene hasta decidir si el cuerpo
+    # es completo o streaming
+    def __init__(self, middleware: CompressionMiddleware, encoding: str):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.inicio: Optional[Dict[str, Any]] = None
+        self.pendiente: List[bytes] = []
+        self.largo_pendiente = 0
+        self.compresor: Optional[_Compresor] = None
+        self.directo = False  # Se pasa sin tocar
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu = 0.0
+    async def run(self, scope, receive, send: Callable):
+        self.send = send
+        await self.middleware.app(scope, receive, self._send)
+    async def _send(self, message):
+        if message["type"] == "http.response.start":
+            self.inicio = message
+            self.directo = not self._comprimible(message)
+            if self.directo:
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.directo:
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.inicio is not None:
+            # Si ya había `minimum_size` bytes antes de este mensaje, se decide ahora
+            decidir = self.largo_pendiente >= self.middleware.minimum_size
+            self.pendiente.append(body)
+            self.largo_pendiente += len(body)
+            if more_body and not decidir:
+                return
+            inicio, self.inicio = self.inicio, None
+            body, self.pendiente = b"".join(self.pendiente), []
+            if not more_body:
+                await self._cuerpo_completo(inicio, body)
+                return
+            # Streaming: sin Content-Length, se comprime a medida que llega
+            self.compresor = _Compresor(self.encoding, self.middleware.levels[self.encoding])
+            await self.send(self._con_encoding(inicio, None))
+        await self._chunk(body, more_body)
+    def _comprimible(self, message) -> bool:
+        if message["status"] < 200 or message["status"] in (204, 304):
+            return False
+        tipo = ""
+        for nombre, valor in message.get("headers", []):
+            if nombre == b"content-encoding":
+                return False  # Ya viene comprimida
+            if nombre == b"content-type":
+                tipo = valor.decode("latin-1").lower()
+        if tipo.startswith(_TIPOS_EXCLUIDOS) or not tipo.startswith(_TIPOS_COMPRIMIBLES):
+            self.middleware.stats.skipped_type += 1
+            return False
+        return True
+    async def _cuerpo_completo(self, inicio, body: bytes):
+        stats = self.middleware.stats
+        if len(body) < self.middleware.minimum_size:
+            stats.skipped_small += 1
+            await self.send(inicio)
+            await self.send({"type": "http.response.body", "body": body})
+            return
+        comprimido, cpu = await self.middleware._comprimir(self.encoding, body)
+        stats.record(self.encoding, len(body), len(comprimido), cpu)
+        await self.send(self._con_encoding(inicio, len(comprimido)))
+        await self.send({"type": "http.response.body", "body": comprimido})
+    def _comprimir_chunk(self, body: bytes, more_body: bool) -> Tuple[bytes, float]:
+        inicio = thread_time()
+        data = self.compresor.chunk(body) if body else b""
+        if not more_body:
+            data += self.compresor.finish()
+        return data, thread_time() - inicio
+    async def _chunk(self, body: bytes, more_body: bool):
+        if len(body) >= self.middleware.offload_size:
+            # Los chunks se procesan en orden: el compresor nunca se usa en paralelo
+            self.middleware.stats.offloaded += 1
+            data, cpu = await asyncio.to_thread(self._comprimir_chunk, body, more_body)
+        else:
+            data, cpu = self._comprimir_chunk(body, more_body)
+        self.cpu += cpu
+        self.bytes_in += len(body)
+        self.bytes_out += len(data)
+        if not more_body:
+            self.middleware.stats.record(
+                self.encoding, self.bytes_in, self.bytes_out, self.cpu, streaming=True
+            )
+        if data or not more_body:
+            await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+    def _con_encoding(self, inicio, largo: Optional[int]):
+        headers: List[Tuple[bytes, bytes]] = []
+        vary = None
+        for nombre, valor in inicio.get("headers", []):
+            if nombre == b"content-length":
+                continue
+            if nombre == b"vary":
+                vary = valor
+                continue
+            if nombre == b"etag" and not valor.startswith(b"W/"):
+                # La representación cambió: el ETag fuerte pasa a débil
+                valor = b"W/" + valor
+            headers.append((nombre, valor))
+        headers.append((b"content-encoding", self.encoding.encode()))
+        headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+        if largo is not None:
+            headers.append((b"content-length", str(largo).encode()))
+        return {**inicio, "headers": headers}
@@ -0,0 +1,233 @@
+import asyncio
+import math
+from collections import OrderedDict, deque
+from time import monotonic
+from typing import Any, Deque, Dict, Hashable, Optional
+from fastapi import HTTPException, status
+import logging
+logger = logging.getLogger(__name__)
+PRIORIDAD_NORMAL = "normal"
+PRIORIDAD_ALTA = "alta"
+MIN_MUESTRAS_LATENCIA = 20  # Antes no hay base confiable para juzgar la latencia
+class _Flujo:
+    __slots__ = ("waiters", "weight", "deficit")
+    def __init__(self, weight: int):
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.weight = weight
+        self.deficit = 0
+class FairQueue:
+    # Deficit round-robin entre flujos (uno por usuario). Cada visita suma
+    # `weight` al déficit del flujo y cada request cuesta 1, así un flujo de
+    # peso 4 atiende hasta 4 requests por ronda frente a 1 de uno normal.
+    def __init__(self):
+        self._flujos: "OrderedDict[Hashable, _Flujo]" = OrderedDict()
+        self._size = 0
+    def __len__(self) -> int:
+        return self._size
+    def queued(self, key: Hashable) -> int:
+        flujo = self._flujos.get(key)
+        return len(flujo.waiters) if flujo else 0
+    def flows(self) -> int:
+        return len(self._flujos)
+    def push(self, key: Hashable, waiter: asyncio.Future, weight: int = 1):
+        flujo = self._flujos.get(key)
+        if flujo is None:
+            flujo = self._flujos[key] = _Flujo(weight)
+        flujo.weight = max(flujo.weight, weight)
+        flujo.waiters.append(waiter)
+        self._size += 1
+    def pop(self) -> Optional[asyncio.Future]:
+        while self._flujos:
+            key, flujo = next(iter(self._flujos.items()))
+            if flujo.deficit < 1:
+                flujo.deficit += flujo.weight
+                self._flujos.move_to_end(key)
+                continue
+            flujo.deficit -= 1
+            waiter = flujo.waiters.popleft()
+            self._size -= 1
+            if not flujo.waiters:
+                del self._flujos[key]  # Un flujo vacío no acumula déficit
+            return waiter
+        return None
+    def remove(self, key: Hashable, waiter: asyncio.Future):
+        flujo = self._flujos.get(key)
+        if flujo is None or waiter not in flujo.waiters:
+            return
+        flujo.waiters.remove(waiter)
+        self._size -= 1
+        if not flujo.waiters:
+            del self._flujos[key]
+class AdaptiveConcurrencyLimiter:
+    # Límite adaptativo de llamadas simultáneas a la IA. Crece +1/limit por
+    # éxito mientras se usa al menos la mitad del límite. Se multiplica por
+    # `backoff` ante timeouts o sobrecarga del proveedor (429), y por
+    # baseline/reciente (con piso `backoff`) cuando la latencia reciente
+    # (EWMA de ~10 llamadas) supera `latency_tolerance` veces la de base
+    # (EWMA de ~`baseline_window` llamadas): una llamada lenta aislada no
+    # cuenta, solo una suba sostenida. El exceso espera en una FairQueue
+    # acotada (global y por usuario); si está llena o vence el plazo responde 503.
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 32,
+                 max_queue: int = 50, queue_timeout: float = 10.0,
+                 latency_tolerance: float = 2.0, backoff: float = 0.7,
+                 latency_window: int = 100, max_queue_per_key: int = 10,
+                 priority_weight: int = 4, baseline_window: int = 500):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.max_queue = max_queue
+        self.max_queue_per_key = max_queue_per_key
+        self.priority_weight = priority_weight
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self._waiters = FairQueue()
+        self._waits: Dict[str, Deque[float]] = {
+            PRIORIDAD_NORMAL: deque(maxlen=latency_window),
+            PRIORIDAD_ALTA: deque(maxlen=latency_window)
+        }
+        self._alpha_baseline = 2.0 / (baseline_window + 1)
+        self._baseline_latency = 0.0  # EWMA larga: latencia "sana" del proveedor
+        self._avg_latency = 0.0  # EWMA corta: latencia reciente
+        self._samples = 0
+        self._last_decrease = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.decreases = 0
+    def _retry_after(self) -> int:
+        # Estimación del tiempo hasta que se libere lugar para un request nuevo
+        avg = self._avg_latency or 1.0
+        return max(1, math.ceil(avg * (len(self._waiters) + 1) / max(self.limit, 1.0)))
+    def _reject(self, motivo: str) -> HTTPException:
+        self.rejected += 1
+        retry_after = self._retry_after()
+        logger.warning(
+            f"Llamada a IA rechazada ({motivo}): en curso={self.in_flight}, "
+            f"límite={self.limit:.1f}, en cola={len(self._waiters)}"
+        )
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="El servicio de IA está saturado. Intenta nuevamente en unos segundos.",
+            headers={"Retry-After": str(retry_after)}
+        )
+    def check_admission(self, key: Hashable = None):
+        # Rechazo temprano sin reservar lugar (p.ej. antes de abrir un stream)
+        if self.in_flight < int(self.limit):
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("cola llena")
+        if key is not None and self._waiters.queued(key) >= self.max_queue_per_key:
+            raise self._reject("cola del usuario llena")
+    async def acquire(self, timeout: Optional[float] = None, key: Hashable = None,
+                      priority: bool = False) -> float:
+        # Devuelve los segundos de espera en cola
+        clase = PRIORIDAD_ALTA if priority else PRIORIDAD_NORMAL
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            self._waits[clase].append(0.0)
+            return 0.0
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("cola llena")
+        if key is not None and self._waiters.queued(key) >= self.max_queue_per_key:
+            raise self._reject("cola del usuario llena")
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.push(key, waiter, self.priority_weight if priority else 1)
+        inicio = monotonic()
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()  # Carrera: el lugar llegó junto con el timeout
+            self.queue_timeouts += 1
+            raise self._reject("plazo de espera vencido")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()  # Se le había cedido el lugar: devolverlo
+            raise
+        finally:
+            self._waiters.remove(key, waiter)
+        espera = monotonic() - inicio
+        self._waits[clase].append(espera)
+        self.admitted += 1
+        return espera
+    def release(self, latency: Optional[float] = None, overloaded: bool = False):
+        # latency en segundos (None: no se llegó a llamar a la IA);
+        # overloaded=True para timeouts y 429 del proveedor
+        if latency is not None:
+            self._record(latency, overloaded)
+        self._release_slot()
+    def _release_slot(self):
+        self.in_flight -= 1
+        # Ceder lugares directamente a los que esperan (in_flight no baja)
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.pop()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+    def _record(self, latency: float, overloaded: bool):
+        self._samples += 1
+        self._avg_latency = latency if not self._avg_latency else (
+            0.9 * self._avg_latency + 0.1 * latency
+        )
+        # Media simple hasta llenar la ventana, después EWMA larga
+        alpha = max(1.0 / self._samples, self._alpha_baseline)
+        self._baseline_latency += alpha * (latency - self._baseline_latency)
+        factor = None
+        if overloaded:
+            factor = self.backoff
+        elif self._samples >= MIN_MUESTRAS_LATENCIA:
+            ratio = self._avg_latency / self._baseline_latency
+            if ratio > self.latency_tolerance:
+                # Gradiente: cuanto más se alejó de la base, más se reduce
+                factor = max(self.backoff, self.latency_tolerance / ratio)
+        now = monotonic()
+        if factor is not None:
+            # Una baja por "ronda": varias llamadas que fallan juntas cuentan una vez
+            if now - self._last_decrease >= max(self._baseline_latency, 1.0):
+                self.limit = max(float(self.min_limit), self.limit * factor)
+                self._last_decrease = now
+                self.decreases += 1
+                logger.info(f"Límite de concurrencia IA reducido a {self.limit:.1f}")
+        elif self.in_flight >= self.limit / 2:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "queued_users": self._waiters.flows(),
+            "max_queue": self.max_queue,
+            "max_queue_per_user": self.max_queue_per_key,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_timeouts": self.queue_timeouts,
+            "decreases": self.decreases,
+            "avg_latency_ms": round(self._avg_latency * 1000, 2),
+            "baseline_latency_ms": round(self._baseline_latency * 1000, 2),
+            "queue_wait_ms": {clase: _percentiles(esperas) for clase, esperas in self._waits.items()}
+        }
+def _percentiles(valores: Deque[float]) -> Dict[str, Optional[float]]:
+    if not valores:
+        return {"avg": None, "p50": None, "p95": None, "max": None}
+    ordenados = sorted(valores)
+    def p(q: float) -> float:
+        return round(ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))] * 1000, 2)
+    return {
+        "avg": round(sum(ordenados) / len(ordenados) * 1000, 2),
+        "p50": p(0.5),
+        "p95": p(0.95),
+        "max": round(ordenados[-1] * 1000, 2)
+    }
+# Mensajes de error del SDK que indican saturación del proveedor
+OVERLOAD_MARKERS = ("429", "resource exhausted", "resourceexhausted", "quota", "overloaded", "503")
+def is_overload_error(mensaje: Optional[str]) -> bool:
+    if not mensaje:
+        return False
+    mensaje = mensaje.lower()
+    return any(marker in mensaje for marker in OVERLOAD_MARKERS)
@@ -1,5 +1,6 @@
 import os
 from functools import lru_cache
+from typing import Optional
 from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     # API Info
@@ -21,6 +22,13 @@ class Settings(BaseSettings):
     # Logging
     log_level: str = "INFO"
     log_file: str = "api.log"
+    log_queue_size: int = 10000  # Registros en cola antes de descartar
+    log_max_bytes: int = 10 * 1024 * 1024  # Rotación a los 10 MB
+    log_backup_count: int = 5
+    # Muestreo de logs en el hot path (INFO/DEBUG; los errores nunca se muestrean)
+    log_sampling_enabled: bool = True
+    log_sample_rate: float = 1.0  # Líneas por segundo por plantilla
+    log_sample_burst: int = 10
     # API Keys
     gemini_api_key: str = os.getenv("GEMINI_API_KEY", "")
     # Security - API Keys (opcional para proteger endpoints)
@@ -31,14 +39,106 @@ class Settings(BaseSettings):
     rate_limit_requests: int = 60  # Requests por ventana
     rate_limit_window: int = 60  # Segundos (ventana de tiempo)
     rate_limit_by_ip: bool = True
+    enable_endpoint_rate_limits: bool = True  # Límites por endpoint (registro 3/hora, login 5/min)
     # Cache
     enable_cache: bool = True
     cache_ttl: int = 300  # 5 minutos
+    cache_stale_ttl: int = 3600  # Entradas vencidas servibles si la IA no está disponible
+    cache_swr_ttl: int = 600  # Vencidas hace menos de esto: se sirven y se refrescan en background (0 = off)
+    cache_negative_ttl: int = 60  # Fallos deterministas (SAFETY, JSON inválido) por texto (0 = off)
+    static_cache_max_age: int = 3600  # Cache-Control de respuestas estáticas (/api/ejemplos)
+    idempotency_ttl: int = 600  # Vida de respuestas por Idempotency-Key (0 = deshabilitado)
+    idempotency_max_entries: int = 1000
+    # Análisis en lote
+    batch_max_concurrency: int = 5  # Llamadas simultáneas a Gemini por lote
+    # Trabajos asíncronos
+    job_workers: int = 2  # Workers en el proceso de la API (0 = solo `python jobs.py`)
+    job_timeout: int = 180  # Límite por trabajo (segundos)
+    job_poll_interval: float = 1.0  # Espera entre consultas a la cola vacía (segundos)
+    job_max_attempts: int = 3  # Intentos por trabajo (worker caído o IA saturada/cuota agotada)
+    job_retry_base_delay: float = 5.0  # Backoff ante 503/429: base * 2^(intento-1) segundos
+    job_retry_max_delay: float = 300.0  # Tope del backoff (un Retry-After mayor se respeta)
+    job_max_wait: int = 30  # Máximo de long-polling en GET /api/jobs/{id}?wait= (segundos)
+    # Concurrencia adaptativa de llamadas a la IA (AIMD)
+    ai_concurrency_initial: int = 8
+    ai_concurrency_min: int = 1
+    ai_concurrency_max: int = 32
+    ai_queue_size: int = 50  # Requests en espera; con la cola llena se responde 503
+    ai_queue_timeout: float = 10.0  # Espera máxima en cola (segundos)
+    ai_queue_per_user: int = 10  # Requests en espera por usuario (cola justa DRR)
+    ai_priority_weight: int = 4  # Peso DRR de admins y clientes con API key (normal = 1)
+    ai_latency_tolerance: float = 2.0  # Latencia reciente > tolerancia * base (EWMA larga) = congestión
+    # Backend de IA: "gemini" o "fake" (modelo local para pruebas de carga)
+    ai_backend: str = "gemini"
+    fake_latency_median_ms: float = 800.0  # Latencia lognormal del backend fake
+    fake_latency_sigma: float = 0.5
+    fake_error_rate: float = 0.0  # Fracción de llamadas que fallan con 503
+    fake_safety_rate: float = 0.0  # Fracción cortada por SAFETY
+    fake_malformed_rate: float = 0.0  # Fracción con JSON truncado
+    fake_seed: Optional[int] = None
+    # Reintentos y hedging de llamadas a Gemini
+    ai_max_retries: int = 2  # Errores transitorios y JSON mal formado
+    ai_retry_base_delay: float = 0.5  # Backoff exponencial con jitter (segundos)
+    ai_retry_max_delay: float = 4.0
+    ai_retry_budget_ratio: float = 0.1  # Reintentos + hedges permitidos por request (ventana de 10s)
+    ai_retry_budget_min: int = 3  # Reintentos siempre permitidos por ventana
+    ai_hedge_enabled: bool = True
+    ai_hedge_quantile: float = 0.95  # Segundo intento si el primero supera este percentil
+    ai_hedge_min_delay: float = 2.0  # Delay mínimo antes de lanzar el hedge (segundos)
+    ai_hedge_workers: int = 32  # Threads para hedges (se usa al menos ai_concurrency_max)
+    # Prompt y presupuesto de tokens de salida
+    ai_prompt_version: str = "v2"  # v1 = prompt original, v2 = esquema compacto
+    ai_min_output_tokens: int = 1024  # Presupuesto base de salida por llamada
+    ai_output_tokens_ratio: float = 2.0  # Tokens de salida extra por token de la tarea (tope: 4096)
+    ai_structured_output: bool = True  # JSON restringido por esquema (response_schema)
+    # Uso de tokens por usuario y cuota diaria
+    usage_daily_token_limit: int = 0  # Tokens (entrada + salida) por usuario y día UTC; 0 = sin límite
+    usage_flush_interval: float = 5.0  # Volcado en lote de contadores a la BD (segundos)
+    usage_refresh_seconds: float = 30.0  # Relectura del total en BD (cuenta otros procesos)
+    usage_price_input_per_million: float = 0.30  # USD por millón de tokens de entrada
+    usage_price_output_per_million: float = 2.50  # USD por millón de tokens de salida
+    # Circuit breaker hacia Gemini
+    circuit_failure_rate: float = 0.5  # Tasa de fallos (errores o llamadas lentas) que abre el circuito
+    circuit_slow_call_seconds: float = 20.0  # Llamadas más lentas cuentan como fallo
+    circuit_window: int = 20  # Llamadas consideradas
+    circuit_min_calls: int = 10  # Mínimo de llamadas antes de evaluar la tasa
+    circuit_open_seconds: float = 30.0  # Tiempo abierto antes de probar recuperación
+    circuit_half_open_calls: int = 3  # Sondas exitosas necesarias para cerrar
     # Timeouts
     gemini_timeout: int = 30  # Timeout para llamadas a Gemini API (segundos)
     request_timeout: int = 60  # Timeout general de requests
+    # Profiling (opt-in): fracción de requests muestreados o header de admin
+    enable_profiling: bool = False
+    profiling_sample_rate: float = 0.0  # 0.01 = 1% de los requests
+    profiling_header: str = "X-Profile"
+    profiling_max_profiles: int = 20  # Perfiles retenidos en memoria
+    # Tracing local: header Server-Timing + export OTLP/JSON de requests lentos
+    enable_tracing: bool = True
+    trace_export_file: str = ""  # Ej. "logs/traces.jsonl"; vacío para no exportar
+    trace_export_min_ms: float = 500.0  # Solo exportar traces más lentos que esto
     # Security Headers
     enable_security_headers: bool = True
+    # Compresión de respuestas según Accept-Encoding (br y zstd requieren brotli/zstandard)
+    enable_compression: bool = True
+    compression_encodings: str = "zstd,br,gzip"  # Orden de preferencia del servidor
+    compression_min_size: int = 1024  # Bytes; cuerpos menores van sin comprimir
+    compression_offload_size: int = 65536  # Desde este tamaño se comprime en un thread
+    compression_gzip_level: int = 6
+    compression_brotli_quality: int = 4
+    compression_zstd_level: int = 3
+    def get_ai_backend_options(self) -> dict:
+        if self.ai_backend != "fake":
+            return {}
+        return {
+            "latency_median_ms": self.fake_latency_median_ms,
+            "latency_sigma": self.fake_latency_sigma,
+            "error_rate": self.fake_error_rate,
+            "safety_rate": self.fake_safety_rate,
+            "malformed_rate": self.fake_malformed_rate,
+            "seed": self.fake_seed
+        }
+    def get_compression_encodings(self) -> tuple:
+        return tuple(e.strip().lower() for e in self.compression_encodings.split(",") if e.strip())
     def get_api_keys_list(self) -> list:
         if not self.api_keys:
             return []
@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Date, Text, ForeignKey, Boolean, BigInteger
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import datetime
@@ -27,6 +28,8 @@ class Usuario(Base):
     verification_token_expires = Column(DateTime)
     # Relación con consultas
     consultas = relationship("Consulta", back_populates="usuario", cascade="all, delete-orphan")
+    trabajos = relationship("TrabajoAnalisis", back_populates="usuario", cascade="all, delete-orphan")
+    uso_tokens = relationship("UsoTokensDiario", back_populates="usuario", cascade="all, delete-orphan")
     # Propiedades híbridas para encriptación automática
     @hybrid_property
     def email(self):
@@ -62,6 +65,44 @@ class Consulta(Base):
         self._texto_original = encrypt_data(value) if value else None
     def __repr__(self):
         return f"<Consulta {self.id} - Usuario {self.usuario_id}>"
+class TrabajoAnalisis(Base):
+    # Cola durable de análisis asíncronos (POST /api/jobs)
+    __tablename__ = "trabajos_analisis"
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    usuario_id = Column(Integer, ForeignKey("usuarios.id"), nullable=False, index=True)
+    _texto = Column("texto", Text, nullable=False)  # Encriptado
+    estado = Column(String(20), nullable=False, default="pendiente", index=True)
+    resultado = Column(Text)  # JSON de la respuesta (mismo formato que /api/desambiguar)
+    error = Column(Text)
+    consulta_id = Column(Integer, ForeignKey("consultas.id", ondelete="SET NULL"))
+    intentos = Column(Integer, default=0)
+    worker_id = Column(String(100))
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    disponible_desde = Column(DateTime)  # Reintento con backoff: no reclamar antes de esto
+    usuario = relationship("Usuario", back_populates="trabajos")
+    @hybrid_property
+    def texto(self):
+        return decrypt_data(self._texto) if self._texto else None
+    @texto.setter
+    def texto(self, value):
+        self._texto = encrypt_data(value) if value else None
+    def __repr__(self):
+        return f"<TrabajoAnalisis {self.id} - {self.estado}>"
+class UsoTokensDiario(Base):
+    # Contadores de tokens de Gemini por usuario y día (UTC); usage.TokenMeter
+    # los incrementa en lote
+    __tablename__ = "uso_tokens_diario"
+    usuario_id = Column(Integer, ForeignKey("usuarios.id"), primary_key=True)
+    fecha = Column(Date, primary_key=True)
+    input_tokens = Column(BigInteger, nullable=False, default=0)
+    output_tokens = Column(BigInteger, nullable=False, default=0)
+    llamadas = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    usuario = relationship("Usuario", back_populates="uso_tokens")
+    def __repr__(self):
+        return f"<UsoTokensDiario {self.usuario_id} - {self.fecha}>"
 # Configuración de base de datos
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./demystify.db")
 # Crear engine
@@ -72,8 +113,28 @@ engine = create_engine(
 )
 # Session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Columnas nuevas en tablas existentes: create_all no altera tablas ya creadas,
+# así que init_db las agrega (nullable, sin default) en bases anteriores
+COLUMNAS_AGREGADAS = {
+    "trabajos_analisis": ["disponible_desde"],
+}
+def _agregar_columnas_faltantes():
+    import logging
+    inspector = inspect(engine)
+    for tabla, columnas in COLUMNAS_AGREGADAS.items():
+        if not inspector.has_table(tabla):
+            continue
+        existentes = {columna["name"] for columna in inspector.get_columns(tabla)}
+        for nombre in columnas:
+            if nombre in existentes:
+                continue
+            tipo = Base.metadata.tables[tabla].c[nombre].type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}"))
+            logging.info(f"Columna agregada: {tabla}.{nombre}")
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _agregar_columnas_faltantes()
     import logging
     logging.info("Base de datos inicializada")
 def get_db():
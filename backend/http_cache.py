@@ -0,0 +1,68 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Callable, Optional
+from fastapi import Request, Response
+from serialization import dumps_bytes
+# Validadores HTTP (ETag / Last-Modified) y respuestas condicionales (304)
+def etag_de(*partes: object) -> str:
+    # ETag fuerte a partir del cuerpo o de lo que lo determina (id, fecha, ...)
+    digest = hashlib.blake2b(digest_size=16)
+    for parte in partes:
+        digest.update(parte if isinstance(parte, bytes) else str(parte).encode())
+        digest.update(b"\0")
+    return f'"{digest.hexdigest()}"'
+def fecha_http(fecha: datetime) -> str:
+    # Las fechas de la BD son UTC sin zona (datetime.utcnow)
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return format_datetime(fecha.replace(microsecond=0), usegmt=True)
+def _coincide_etag(if_none_match: str, etag: str) -> bool:
+    # Comparación débil (RFC 9110 §13.1.2): W/"x" equivale a "x"
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidato.strip().removeprefix("W/") == etag
+        for candidato in if_none_match.split(",")
+    )
+def no_modificado(request: Request, etag: str, last_modified: Optional[str] = None) -> bool:
+    # If-None-Match tiene prioridad; If-Modified-Since solo si no vino
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _coincide_etag(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False  # Fecha inválida: se ignora el header
+def headers_cache(etag: str, cache_control: str, last_modified: Optional[str] = None) -> dict:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+def respuesta_condicional(request: Request, construir: Callable[[], Any], etag: str,
+                          cache_control: str, last_modified: Optional[str] = None) -> Response:
+    # 304 sin cuerpo si el cliente ya tiene esta versión; si no, construir() arma
+    # el contenido (solo entonces se paga el costo) y va con los validadores
+    headers = headers_cache(etag, cache_control, last_modified)
+    if no_modificado(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(dumps_bytes(construir()), media_type="application/json", headers=headers)
+class RespuestaEstatica:
+    # Cuerpo JSON serializado una sola vez (al arrancar) con su ETag; cada
+    # request solo compara validadores y devuelve los mismos bytes
+    def __init__(self, contenido: Any, cache_control: str,
+                 last_modified: Optional[datetime] = None):
+        self.body = dumps_bytes(contenido)
+        self.etag = etag_de(self.body)
+        self.cache_control = cache_control
+        self.last_modified = fecha_http(last_modified or datetime.now(timezone.utc))
+        self.not_modified = 0
+    def response(self, request: Request) -> Response:
+        headers = headers_cache(self.etag, self.cache_control, self.last_modified)
+        if no_modificado(request, self.etag, self.last_modified):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(self.body, media_type="application/json", headers=headers)
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from fastapi import HTTPException, status
+import logging
+logger = logging.getLogger(__name__)
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotency-Replayed"
+MAX_KEY_LENGTH = 255
+class _Entrada:
+    __slots__ = ("fingerprint", "task", "result", "expires_at")
+    def __init__(self, fingerprint: str, task: "asyncio.Task"):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.result: Optional[Dict[str, Any]] = None
+        self.expires_at: Optional[float] = None  # None mientras está en curso
+class IdempotencyStore:
+    # Respuestas exitosas por (usuario, Idempotency-Key). Un reintento con la
+    # misma clave recibe la respuesta original o se engancha al cómputo en
+    # curso; los errores no se guardan para que el reintento vuelva a ejecutar.
+    # Local al proceso: con varios workers de uvicorn cada uno tiene su store.
+    def __init__(self, ttl: int = 600, max_entries: int = 1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, str], _Entrada]" = OrderedDict()
+        self.replayed = 0
+        self.attached = 0
+        self.executed = 0
+        self.conflicts = 0
+    @staticmethod
+    def fingerprint(payload: str) -> str:
+        return hashlib.sha256(payload.encode()).hexdigest()
+    @staticmethod
+    def validate_key(key: str) -> str:
+        key = key.strip()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{IDEMPOTENCY_HEADER} debe tener entre 1 y {MAX_KEY_LENGTH} caracteres"
+            )
+        return key
+    async def run(self, user_id: int, key: str, fingerprint: str,
+                  compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Dict[str, Any], bool]:
+        # Devuelve (respuesta, replayed)
+        if self.ttl <= 0:
+            return await compute(), False
+        store_key = (user_id, key)
+        entrada = self._get(store_key)
+        if entrada is not None:
+            if entrada.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"{IDEMPOTENCY_HEADER} ya usada con un cuerpo distinto"
+                )
+            if entrada.result is not None:
+                self.replayed += 1
+                return entrada.result, True
+            self.attached += 1
+            # shield: si este cliente se desconecta, el cómputo sigue para los demás
+            return await asyncio.shield(entrada.task), True
+        self.executed += 1
+        task = asyncio.ensure_future(compute())
+        entrada = _Entrada(fingerprint, task)
+        self._entries[store_key] = entrada
+        self._evict()
+        try:
+            result = await asyncio.shield(task)
+        except BaseException:
+            if self._entries.get(store_key) is entrada:
+                del self._entries[store_key]
+            if task.done() and not task.cancelled():
+                task.exception()  # Ya propagada a quienes esperan: no loguear "never retrieved"
+            raise
+        entrada.result = result
+        entrada.expires_at = time() + self.ttl
+        return result, False
+    def _get(self, store_key: Tuple[int, str]) -> Optional[_Entrada]:
+        entrada = self._entries.get(store_key)
+        if entrada is None:
+            return None
+        if entrada.expires_at is not None and time() >= entrada.expires_at:
+            del self._entries[store_key]
+            return None
+        self._entries.move_to_end(store_key)
+        return entrada
+    def _evict(self):
+        # Descarta primero las completadas más viejas; las en curso solo si no queda otra
+        while len(self._entries) > self.max_entries:
+            for store_key, entrada in self._entries.items():
+                if entrada.result is not None:
+                    del self._entries[store_key]
+                    break
+            else:
+                self._entries.popitem(last=False)
+    def clear(self):
+        self._entries.clear()
+    def get_stats(self) -> Dict[str, Any]:
+        en_curso = sum(1 for entrada in self._entries.values() if entrada.result is None)
+        return {
+            "size": len(self._entries),
+            "in_flight": en_curso,
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+            "replayed": self.replayed,
+            "attached": self.attached,
+            "executed": self.executed,
+            "conflicts": self.conflicts
+        }
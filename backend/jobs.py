@@ -0,0 +1,306 @@
+import asyncio
+import os
+import socket
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from fastapi import HTTPException, status
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+import logging
+from database import SessionLocal, TrabajoAnalisis
+from serialization import dumps
+logger = logging.getLogger(__name__)
+ESTADO_PENDIENTE = "pendiente"
+ESTADO_PROCESANDO = "procesando"
+ESTADO_COMPLETADO = "completado"
+ESTADO_ERROR = "error"
+ESTADOS_FINALES = (ESTADO_COMPLETADO, ESTADO_ERROR)
+# Contrapresión pasajera (cola de IA llena, circuito abierto, cuota diaria):
+# el trabajo vuelve a la cola con backoff en vez de fallar
+ESTADOS_REINTENTABLES = (status.HTTP_429_TOO_MANY_REQUESTS, status.HTTP_503_SERVICE_UNAVAILABLE)
+@dataclass(frozen=True)
+class TrabajoReclamado:
+    id: str
+    usuario_id: int
+    texto: str
+    intentos: int
+# procesar(texto, usuario_id, timeout) -> (respuesta, consulta_id)
+ProcesarTrabajo = Callable[[str, int, float], Awaitable[Tuple[Dict[str, Any], Optional[int]]]]
+class JobQueue:
+    # Operaciones sobre la tabla trabajos_analisis. El reclamo es un UPDATE
+    # condicional, así que varios procesos pueden consumir la misma cola.
+    def __init__(self, session_factory=SessionLocal, max_intentos: int = 3):
+        self.session_factory = session_factory
+        self.max_intentos = max_intentos
+    def submit(self, db: Session, usuario_id: int, texto: str) -> TrabajoAnalisis:
+        trabajo = TrabajoAnalisis(
+            id=uuid.uuid4().hex,
+            usuario_id=usuario_id,
+            texto=texto,
+            estado=ESTADO_PENDIENTE,
+            intentos=0
+        )
+        db.add(trabajo)
+        db.commit()
+        db.refresh(trabajo)
+        return trabajo
+    def claim(self, worker_id: str) -> Optional[TrabajoReclamado]:
+        db = self.session_factory()
+        try:
+            candidatos = db.query(TrabajoAnalisis.id)\
+                .filter(
+                    TrabajoAnalisis.estado == ESTADO_PENDIENTE,
+                    or_(
+                        TrabajoAnalisis.disponible_desde.is_(None),
+                        TrabajoAnalisis.disponible_desde <= datetime.utcnow()
+                    )
+                )\
+                .order_by(TrabajoAnalisis.created_at)\
+                .limit(5)\
+                .all()
+            for (trabajo_id,) in candidatos:
+                reclamados = db.query(TrabajoAnalisis)\
+                    .filter(
+                        TrabajoAnalisis.id == trabajo_id,
+                        TrabajoAnalisis.estado == ESTADO_PENDIENTE
+                    )\
+                    .update(
+                        {
+                            TrabajoAnalisis.estado: ESTADO_PROCESANDO,
+                            TrabajoAnalisis.worker_id: worker_id,
+                            TrabajoAnalisis.started_at: datetime.utcnow(),
+                            TrabajoAnalisis.intentos: TrabajoAnalisis.intentos + 1
+                        },
+                        synchronize_session=False
+                    )
+                db.commit()
+                if reclamados:
+                    trabajo = db.query(TrabajoAnalisis).filter(TrabajoAnalisis.id == trabajo_id).first()
+                    return TrabajoReclamado(
+                        id=trabajo.id,
+                        usuario_id=trabajo.usuario_id,
+                        texto=trabajo.texto,
+                        intentos=trabajo.intentos
+                    )
+            return None
+        finally:
+            db.close()
+    def _finish(self, trabajo_id: str, valores: Dict[Any, Any]):
+        db = self.session_factory()
+        try:
+            db.query(TrabajoAnalisis)\
+                .filter(TrabajoAnalisis.id == trabajo_id)\
+                .update(
+                    {**valores, TrabajoAnalisis.finished_at: datetime.utcnow()},
+                    synchronize_session=False
+                )
+            db.commit()
+        finally:
+            db.close()
+    def complete(self, trabajo_id: str, respuesta: Dict[str, Any], consulta_id: Optional[int]):
+        self._finish(trabajo_id, {
+            TrabajoAnalisis.estado: ESTADO_COMPLETADO,
+            TrabajoAnalisis.resultado: dumps(respuesta),
+            TrabajoAnalisis.consulta_id: consulta_id,
+            TrabajoAnalisis.error: None
+        })
+    def fail(self, trabajo_id: str, error: str):
+        self._finish(trabajo_id, {
+            TrabajoAnalisis.estado: ESTADO_ERROR,
+            TrabajoAnalisis.error: error
+        })
+    def retry_later(self, trabajo_id: str, error: str, delay: float):
+        # Vuelve a pendiente; `intentos` ya se incrementó al reclamarlo
+        db = self.session_factory()
+        try:
+            db.query(TrabajoAnalisis)\
+                .filter(TrabajoAnalisis.id == trabajo_id)\
+                .update(
+                    {
+                        TrabajoAnalisis.estado: ESTADO_PENDIENTE,
+                        TrabajoAnalisis.worker_id: None,
+                        TrabajoAnalisis.error: error,
+                        TrabajoAnalisis.disponible_desde: datetime.utcnow() + timedelta(seconds=delay)
+                    },
+                    synchronize_session=False
+                )
+            db.commit()
+        finally:
+            db.close()
+    def requeue_stale(self, older_than_seconds: float) -> int:
+        # Trabajos de un worker que murió a mitad de camino: reintentar o marcar error
+        limite = datetime.utcnow() - timedelta(seconds=older_than_seconds)
+        db = self.session_factory()
+        try:
+            base = db.query(TrabajoAnalisis).filter(
+                TrabajoAnalisis.estado == ESTADO_PROCESANDO,
+                TrabajoAnalisis.started_at < limite
+            )
+            fallidos = base.filter(TrabajoAnalisis.intentos >= self.max_intentos).update(
+                {
+                    TrabajoAnalisis.estado: ESTADO_ERROR,
+                    TrabajoAnalisis.error: "Se agotaron los reintentos del trabajo",
+                    TrabajoAnalisis.finished_at: datetime.utcnow()
+                },
+                synchronize_session=False
+            )
+            reencolados = base.filter(TrabajoAnalisis.intentos < self.max_intentos).update(
+                {TrabajoAnalisis.estado: ESTADO_PENDIENTE, TrabajoAnalisis.worker_id: None},
+                synchronize_session=False
+            )
+            db.commit()
+            if fallidos or reencolados:
+                logger.warning(
+                    f"Trabajos colgados: {reencolados} reencolados, {fallidos} marcados con error"
+                )
+            return reencolados
+        finally:
+            db.close()
+class JobWorkerPool:
+    def __init__(self, queue: JobQueue, procesar: ProcesarTrabajo, workers: int = 2,
+                 job_timeout: float = 180.0, poll_interval: float = 1.0,
+                 retry_base_delay: float = 5.0, retry_max_delay: float = 300.0):
+        self.queue = queue
+        self.procesar = procesar
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.poll_interval = poll_interval
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._tasks = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._terminados: Dict[str, Tuple[asyncio.Event, int]] = {}  # id -> (evento, esperando)
+        self._prefix = f"{socket.gethostname()}:{os.getpid()}"
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._worker(f"{self._prefix}:{i}"))
+            for i in range(self.workers)
+        ]
+        if self.workers:
+            # El barrido de colgados corre en ambos modos (embebido y `python jobs.py`)
+            self._tasks.append(asyncio.create_task(self._barrer_colgados()))
+            logger.info(f"Workers de trabajos iniciados: {self.workers}")
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    async def run_forever(self):
+        await self.start()
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            await self.stop()
+    async def _barrer_colgados(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.queue.requeue_stale, self.job_timeout * 2)
+            except Exception as e:
+                logger.error(f"Error al reencolar trabajos colgados: {e}")
+            await asyncio.sleep(self.job_timeout)
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+    async def wait(self, trabajo_id: str, timeout: float):
+        # Espera la notificación local de fin; con workers en otro proceso
+        # no llega nunca y el llamador vuelve a consultar la BD tras `timeout`
+        evento, esperando = self._terminados.get(trabajo_id, (asyncio.Event(), 0))
+        self._terminados[trabajo_id] = (evento, esperando + 1)
+        try:
+            await asyncio.wait_for(evento.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            actual = self._terminados.get(trabajo_id)
+            if actual is not None and actual[0] is evento:
+                if actual[1] <= 1:
+                    del self._terminados[trabajo_id]
+                else:
+                    self._terminados[trabajo_id] = (evento, actual[1] - 1)
+    def _notify_done(self, trabajo_id: str):
+        entrada = self._terminados.pop(trabajo_id, None)
+        if entrada is not None:
+            entrada[0].set()
+    async def _worker(self, worker_id: str):
+        while True:
+            try:
+                trabajo = await asyncio.to_thread(self.queue.claim, worker_id)
+            except Exception as e:
+                logger.error(f"Error al reclamar trabajo: {e}")
+                trabajo = None
+            if trabajo is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            await self._ejecutar(trabajo)
+    async def _ejecutar(self, trabajo: TrabajoReclamado):
+        try:
+            respuesta, consulta_id = await asyncio.wait_for(
+                self.procesar(trabajo.texto, trabajo.usuario_id, self.job_timeout),
+                timeout=self.job_timeout
+            )
+            await asyncio.to_thread(self.queue.complete, trabajo.id, respuesta, consulta_id)
+        except asyncio.CancelledError:
+            raise  # Apagado: requeue_stale lo retoma al reiniciar
+        except asyncio.TimeoutError:
+            await asyncio.to_thread(
+                self.queue.fail, trabajo.id,
+                f"El análisis superó el límite de {self.job_timeout:.0f} segundos"
+            )
+        except HTTPException as e:
+            if e.status_code in ESTADOS_REINTENTABLES and trabajo.intentos < self.queue.max_intentos:
+                espera = self._espera_reintento(trabajo.intentos, e)
+                logger.warning(
+                    f"Trabajo {trabajo.id} reencolado en {espera:.0f}s "
+                    f"(intento {trabajo.intentos}/{self.queue.max_intentos}): {e.detail}"
+                )
+                await asyncio.to_thread(self.queue.retry_later, trabajo.id, str(e.detail), espera)
+            else:
+                await asyncio.to_thread(self.queue.fail, trabajo.id, str(e.detail))
+        except Exception as e:
+            logger.error(f"Error inesperado en trabajo {trabajo.id}: {e}")
+            await asyncio.to_thread(self.queue.fail, trabajo.id, f"Error inesperado: {str(e)}")
+        finally:
+            self._notify_done(trabajo.id)
+    def _espera_reintento(self, intentos: int, error: HTTPException) -> float:
+        # Backoff exponencial; si el servidor indicó Retry-After (p.ej. hasta que
+        # se renueve la cuota diaria), no antes de eso
+        espera = min(self.retry_base_delay * 2 ** max(intentos - 1, 0), self.retry_max_delay)
+        try:
+            espera = max(espera, float((error.headers or {}).get("Retry-After", 0)))
+        except ValueError:
+            pass
+        return espera
+if __name__ == "__main__":
+    # Workers en un proceso separado (con JOB_WORKERS=0 en la API):
+    #   python jobs.py --workers 4
+    import argparse
+    parser = argparse.ArgumentParser(description="Workers de análisis asíncronos")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+    import main
+    pool = JobWorkerPool(
+        JobQueue(max_intentos=main.settings.job_max_attempts),
+        main.procesar_trabajo,
+        workers=args.workers,
+        job_timeout=main.settings.job_timeout,
+        poll_interval=main.settings.job_poll_interval,
+        retry_base_delay=main.settings.job_retry_base_delay,
+        retry_max_delay=main.settings.job_retry_max_delay
+    )
+    main.init_db()
+    async def correr():
+        # El uso de tokens de estos trabajos se vuelca desde este proceso
+        # (cuota diaria compartida con la API vía uso_tokens_diario)
+        await main.token_meter.start()
+        try:
+            await pool.run_forever()
+        finally:
+            await main.token_meter.stop()  # Vuelca lo pendiente al salir
+    asyncio.run(correr())
@@ -1,15 +1,120 @@
 import logging
-import json
 import sys
-from datetime import datetime
+import queue
+import atexit
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from typing import Any, Dict, Optional
+from threading import Lock
+from time import time, monotonic
+from typing import Any, Dict, Hashable, Optional, Tuple
 import traceback
+from serialization import dumps
+class _LazyJSON:
+    # Se serializa recién cuando el listener formatea el registro
+    __slots__ = ("context",)
+    def __init__(self, context: Dict[str, Any]):
+        self.context = context
+    def __str__(self) -> str:
+        context = dict(self.context)
+        context["timestamp"] = (
+            datetime.fromtimestamp(context["timestamp"], timezone.utc)
+            .replace(tzinfo=None)
+            .isoformat()
+        )
+        return dumps(context)
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # No formatear en el hilo del request: solo congelar el traceback
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Cola llena: descartar antes que bloquear el event loop
+            self.dropped += 1
+class _DrainingQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Al cerrar, esperar lugar en la cola en vez de perder el sentinel
+        self.queue.put(self._sentinel)
+class LogSampler:
+    # Token bucket por plantilla de mensaje: `rate` líneas/seg con ráfagas de `burst`
+    def __init__(self, rate: float = 1.0, burst: int = 10, max_keys: int = 1000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: Dict[Hashable, list] = {}  # {key: [tokens, last, suprimidos_pendientes]}
+        self._emitted: Dict[Hashable, int] = {}
+        self._suppressed: Dict[Hashable, int] = {}
+        self._lock = Lock()
+    def allow(self, key: Hashable) -> Tuple[bool, int]:
+        now = monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    return True, 0
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False, 0
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+            self._emitted[key] = self._emitted.get(key, 0) + 1
+            return True, suppressed
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            keys = set(self._emitted) | set(self._suppressed)
+            return {
+                "emitted": sum(self._emitted.values()),
+                "suppressed": sum(self._suppressed.values()),
+                "by_key": {
+                    (":".join(map(str, key)) if isinstance(key, tuple) else str(key)): {
+                        "emitted": self._emitted.get(key, 0),
+                        "suppressed": self._suppressed.get(key, 0)
+                    }
+                    for key in keys
+                }
+            }
+class SamplingFilter(logging.Filter):
+    # Para loggers estándar (middleware, utils): la clave es el punto de llamada
+    def __init__(self, sampler: LogSampler):
+        super().__init__()
+        self.sampler = sampler
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        allowed, suppressed = self.sampler.allow((record.name, record.lineno))
+        if allowed and suppressed:
+            record.msg = f"{record.getMessage()} (+{suppressed} suprimidos)"
+            record.args = None
+        return allowed
 class StructuredLogger:
-    def __init__(self, name: str, log_file: Optional[str] = "api.log", level=logging.INFO):
+    def __init__(
+        self,
+        name: str,
+        log_file: Optional[str] = "api.log",
+        level=logging.INFO,
+        queue_size: int = 10000,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        sampler: Optional[LogSampler] = None
+    ):
+        self.sampler = sampler
         self.logger = logging.getLogger(name)
         self.logger.setLevel(level)
         self.logger.handlers.clear()  # Limpiar handlers existentes
+        self.logger.propagate = False
         # Formatter estructurado
         formatter = logging.Formatter(
             '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -19,50 +124,94 @@ class StructuredLogger:
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setLevel(level)
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
-        # File handler (producción)
+        handlers = [console_handler]
+        # File handler con rotación (producción)
         if log_file:
             log_path = Path(log_file)
             log_path.parent.mkdir(exist_ok=True)
-            file_handler = logging.FileHandler(log_file, encoding='utf-8')
+            file_handler = RotatingFileHandler(
+                log_file,
+                maxBytes=max_bytes,
+                backupCount=backup_count,
+                encoding='utf-8'
+            )
             file_handler.setLevel(level)
             file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
+            handlers.append(file_handler)
+        # La escritura real ocurre en el hilo del QueueListener
+        self.queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+        self.logger.addHandler(self.queue_handler)
+        self.listener = _DrainingQueueListener(
+            self.queue_handler.queue,
+            *handlers,
+            respect_handler_level=True
+        )
+        self.listener.start()
+        atexit.register(self.close)
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+    @property
+    def dropped_records(self) -> int:
+        return self.queue_handler.dropped
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue_handler.queue.qsize(),
+            "dropped": self.queue_handler.dropped,
+            "sampling": self.sampler.get_stats() if self.sampler else None
+        }
     def _build_context(
         self,
         message: str,
         extra: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         context = {
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": time(),
             "message": message,
         }
         if extra:
             context.update(extra)
         return context
-    def info(self, message: str, **kwargs):
-        context = self._build_context(message, kwargs)
-        self.logger.info(json.dumps(context) if kwargs else message)
-    def warning(self, message: str, **kwargs):
-        context = self._build_context(message, kwargs)
-        self.logger.warning(json.dumps(context) if kwargs else message)
-    def error(self, message: str, error: Optional[Exception] = None, **kwargs):
-        context = self._build_context(message, kwargs)
+    def _log(
+        self,
+        level: int,
+        message: str,
+        extra: Dict[str, Any],
+        error: Optional[Exception] = None,
+        exc_info: bool = False,
+        sample_key: Optional[str] = None
+    ):
+        if not self.logger.isEnabledFor(level):
+            return
+        # Solo se muestrean INFO/DEBUG; warnings y errores siempre se registran
+        if sample_key and self.sampler and level < logging.WARNING:
+            allowed, suppressed = self.sampler.allow(sample_key)
+            if not allowed:
+                return
+            if suppressed:
+                extra["suppressed"] = suppressed
+        if not extra and not error:
+            self.logger.log(level, message, exc_info=exc_info)
+            return
+        context = self._build_context(message, extra)
         if error:
             context["error_type"] = type(error).__name__
             context["error_message"] = str(error)
             context["stack_trace"] = traceback.format_exc()
-        self.logger.error(json.dumps(context) if (kwargs or error) else message)
+        self.logger.log(level, _LazyJSON(context), exc_info=exc_info)
+    def info(self, message: str, sample_key: Optional[str] = None, **kwargs):
+        self._log(logging.INFO, message, kwargs, sample_key=sample_key)
+    def warning(self, message: str, **kwargs):
+        self._log(logging.WARNING, message, kwargs)
+    def error(self, message: str, error: Optional[Exception] = None, **kwargs):
+        self._log(logging.ERROR, message, kwargs, error)
+    def exception(self, message: str, **kwargs):
+        self._log(logging.ERROR, message, kwargs, exc_info=True)
     def critical(self, message: str, error: Optional[Exception] = None, **kwargs):
-        context = self._build_context(message, kwargs)
-        if error:
-            context["error_type"] = type(error).__name__
-            context["error_message"] = str(error)
-            context["stack_trace"] = traceback.format_exc()
-        self.logger.critical(json.dumps(context) if (kwargs or error) else message)
-    def debug(self, message: str, **kwargs):
-        context = self._build_context(message, kwargs)
-        self.logger.debug(json.dumps(context) if kwargs else message)
+        self._log(logging.CRITICAL, message, kwargs, error)
+    def debug(self, message: str, sample_key: Optional[str] = None, **kwargs):
+        self._log(logging.DEBUG, message, kwargs, sample_key=sample_key)
 class BusinessLogger:
     def __init__(self, logger: StructuredLogger):
         self.logger = logger
@@ -74,36 +223,81 @@ class BusinessLogger:
             **kwargs
         )
     def log_ai_call(self, input_length: int, response_time_ms: float,
-                    success: bool, **kwargs):
+                    success: bool, input_tokens: Optional[int] = None,
+                    output_tokens: Optional[int] = None, **kwargs):
+        if not self.logger.logger.isEnabledFor(logging.INFO):
+            return
+        tokens = (
+            f", Tokens: {input_tokens} in / {output_tokens} out"
+            if input_tokens is not None else ""
+        )
         self.logger.info(
             (
                 f"AI call - Input: {input_length} chars, "
-                f"Time: {response_time_ms:.0f}ms, Success: {success}"
+                f"Time: {response_time_ms:.0f}ms, Success: {success}{tokens}"
             ),
+            sample_key="ai_call",
             input_length=input_length,
             response_time_ms=response_time_ms,
             success=success,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
             **kwargs
         )
     def log_cache_hit(self, cache_key: str):
+        if not self.logger.logger.isEnabledFor(logging.DEBUG):
+            return
         self.logger.debug(
             f"Cache HIT: {cache_key[:50]}...",
+            sample_key="cache_hit",
             cache_key=cache_key,
             cache_hit=True
         )
     def log_cache_miss(self, cache_key: str):
+        if not self.logger.logger.isEnabledFor(logging.DEBUG):
+            return
         self.logger.debug(
             f"Cache MISS: {cache_key[:50]}...",
+            sample_key="cache_miss",
             cache_key=cache_key,
             cache_hit=False
         )
 # Singleton loggers
 _main_logger: Optional[StructuredLogger] = None
 _business_logger: Optional[BusinessLogger] = None
+_log_sampler: Optional[LogSampler] = None
+def get_log_sampler() -> Optional[LogSampler]:
+    global _log_sampler
+    from config import get_settings
+    settings = get_settings()
+    if _log_sampler is None and settings.log_sampling_enabled:
+        _log_sampler = LogSampler(
+            rate=settings.log_sample_rate,
+            burst=settings.log_sample_burst
+        )
+    return _log_sampler
+def apply_log_sampling(*logger_names: str):
+    sampler = get_log_sampler()
+    if sampler is None:
+        return
+    for name in logger_names:
+        logging.getLogger(name).addFilter(SamplingFilter(sampler))
+def _create_main_logger(level=logging.INFO) -> StructuredLogger:
+    from config import get_settings
+    settings = get_settings()
+    return StructuredLogger(
+        "demystify",
+        log_file="logs/api.log",
+        level=level,
+        queue_size=settings.log_queue_size,
+        max_bytes=settings.log_max_bytes,
+        backup_count=settings.log_backup_count,
+        sampler=get_log_sampler()
+    )
 def get_logger() -> StructuredLogger:
     global _main_logger
     if _main_logger is None:
-        _main_logger = StructuredLogger("demystify", log_file="logs/api.log")
+        _main_logger = _create_main_logger()
     return _main_logger
 def get_business_logger() -> BusinessLogger:
     global _business_logger
@@ -112,6 +306,9 @@ def get_business_logger() -> BusinessLogger:
     return _business_logger
 # Para compatibilidad con código existente
 def setup_logging(level=logging.INFO):
-    global _main_logger
-    _main_logger = StructuredLogger("demystify", log_file="logs/api.log", level=level)
-    return _main_logger
\ No newline at end of file
+    global _main_logger, _business_logger
+    if _main_logger is not None:
+        _main_logger.close()
+    _main_logger = _create_main_logger(level=level)
+    _business_logger = None
+    return _main_logger
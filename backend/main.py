@@ -1,20 +1,24 @@
-from fastapi import FastAPI, HTTPException, status, Request, Depends
+from fastapi import FastAPI, HTTPException, status, Request, Depends, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 from sqlalchemy.orm import Session
 from pydantic import EmailStr
 import sys
 from pathlib import Path
-from time import time
+from time import monotonic, time
 import logging
-import json
 import signal
+import threading
 import asyncio
-from datetime import datetime
-from logger import get_logger, get_business_logger
+from concurrent.futures import Future, InvalidStateError
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from logger import get_logger, get_business_logger, apply_log_sampling
 from models import (
-    TareaRequest, TareaResponse, ErrorResponse,
+    TareaRequest, TareaResponse, TareaBatchRequest, TareaBatchItem, TareaBatchResponse,
+    TrabajoCreadoResponse, TrabajoResponse, UsoDiaItem, UsoResponse,
+    ErrorResponse,
     HealthResponse, EjemplosResponse, EjemploItem, StatsResponse
 )
 from middleware import (
@@ -22,23 +26,79 @@ from middleware import (
     RateLimitMiddleware, APIKeyMiddleware, SecurityHeadersMiddleware
 )
 from config import get_settings
+from serialization import FastJSONResponse, dumps, loads
+from profiling import ProfileStore, ProfilingMiddleware, to_pstats_bytes, to_speedscope
+from tracing import TraceExporter, TracingMiddleware, span
 from utils import SimpleCache, generate_cache_key, measure_time
-from database import get_db, init_db, Usuario, Consulta
+from compression import CompressionMiddleware, CompressionStats
+from http_cache import RespuestaEstatica, etag_de, fecha_http, respuesta_condicional
+from jobs import JobQueue, JobWorkerPool, ESTADOS_FINALES
+from idempotency import IdempotencyStore, IDEMPOTENCY_HEADER, REPLAYED_HEADER
+from concurrency import AdaptiveConcurrencyLimiter, is_overload_error
+from usage import TokenMeter
+from database import get_db, init_db, SessionLocal, Usuario, Consulta, TrabajoAnalisis
 from auth import (
-    get_current_user, get_current_admin,
+    get_current_user, get_current_admin, CurrentUser, auth_cache,
     UserCreate, UserLogin, UserResponse, Token,
-    create_user, login_user
+    create_user, login_user, issue_token
 )
 from oauth import google_login, google_callback, OAUTH_ENABLED
 from rate_limiter import setup_rate_limiting, limiter, RATE_LIMITS
 # Agregar el directorio raíz al path para importar shared
 sys.path.append(str(Path(__file__).parent.parent))
-from shared.ai_service import AIService
+from shared.ai_service import AIService, crear_backend, codigo_error
+from shared.prompts import PromptBuilder
+from shared.resilience import CircuitBreaker, RetryBudget, CIRCUITO_ABIERTO
 logger = get_logger()
 business_logger = get_business_logger()
 settings = get_settings()
+apply_log_sampling("middleware", "utils")
 stats_tracker = StatsTracker()
-cache = SimpleCache(ttl=settings.cache_ttl)
+cache = SimpleCache(
+    ttl=settings.cache_ttl,
+    stale_ttl=settings.cache_stale_ttl,
+    swr_ttl=settings.cache_swr_ttl
+)
+# Fallos deterministas (SAFETY, JSON irrecuperable) por texto, con vida corta
+cache_negativo = SimpleCache(ttl=settings.cache_negative_ttl)
+# Refrescos en background de entradas servidas vencidas (uno por clave)
+revalidaciones: Dict[str, asyncio.Task] = {}
+cache_contadores = {
+    "swr_hits": 0, "revalidations": 0, "revalidation_errors": 0,
+    "negative_hits": 0, "negative_sets": 0
+}
+idempotency_store = IdempotencyStore(
+    ttl=settings.idempotency_ttl,
+    max_entries=settings.idempotency_max_entries
+)
+ai_limiter = AdaptiveConcurrencyLimiter(
+    initial_limit=settings.ai_concurrency_initial,
+    min_limit=settings.ai_concurrency_min,
+    max_limit=settings.ai_concurrency_max,
+    max_queue=settings.ai_queue_size,
+    queue_timeout=settings.ai_queue_timeout,
+    latency_tolerance=settings.ai_latency_tolerance,
+    max_queue_per_key=settings.ai_queue_per_user,
+    priority_weight=settings.ai_priority_weight
+)
+ai_breaker = CircuitBreaker(
+    name="gemini",
+    failure_rate=settings.circuit_failure_rate,
+    slow_call_seconds=settings.circuit_slow_call_seconds,
+    window=settings.circuit_window,
+    min_calls=settings.circuit_min_calls,
+    open_seconds=settings.circuit_open_seconds,
+    half_open_calls=settings.circuit_half_open_calls
+)
+token_meter = TokenMeter(
+    daily_limit=settings.usage_daily_token_limit,
+    flush_interval=settings.usage_flush_interval,
+    refresh_seconds=settings.usage_refresh_seconds,
+    price_input_per_million=settings.usage_price_input_per_million,
+    price_output_per_million=settings.usage_price_output_per_million
+)
+profile_store = ProfileStore(max_profiles=settings.profiling_max_profiles)
+compression_stats = CompressionStats()
 start_time = time()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -50,17 +110,26 @@ async def lifespan(app: FastAPI):
     )
     init_db()
     logger.info("Base de datos inicializada")
-    setup_rate_limiting(app)
+    setup_rate_limiting(app, enabled=settings.enable_endpoint_rate_limits)
     logger.info("Rate limiting configurado")
+    await token_meter.start()
+    await job_pool.start()
     yield
+    for tarea in list(revalidaciones.values()):
+        tarea.cancel()
+    await job_pool.stop()
+    await token_meter.stop()
     logger.info("Cerrando De-Mystify API")
     logger.info(f"Stats finales: {stats_tracker.get_stats()}")
+    if logger.dropped_records:
+        logger.warning(f"Registros de log descartados: {logger.dropped_records}")
 app = FastAPI(
     title=settings.app_name,
     description=settings.app_description,
     version=settings.app_version,
     docs_url="/docs",
     redoc_url="/redoc",
+    default_response_class=FastJSONResponse,
     lifespan=lifespan
 )
 app.add_middleware(
@@ -90,11 +159,65 @@ if settings.require_api_key:
         logger.info(f"API Key authentication enabled ({len(api_keys)} keys)")
     else:
         logger.warning("ADVERTENCIA: require_api_key=True but no API keys configured")
+if settings.enable_profiling:
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profile_store,
+        sample_rate=settings.profiling_sample_rate,
+        header=settings.profiling_header
+    )
+    logger.info(f"Profiling habilitado (sample_rate={settings.profiling_sample_rate})")
 app.add_middleware(RequestLoggingMiddleware)
 app.add_middleware(RequestStatsMiddleware, stats_tracker=stats_tracker)
+if settings.enable_tracing:
+    trace_exporter = (
+        TraceExporter(
+            settings.trace_export_file,
+            service_name=settings.app_name,
+            min_duration_ms=settings.trace_export_min_ms
+        )
+        if settings.trace_export_file else None
+    )
+    app.add_middleware(TracingMiddleware, exporter=trace_exporter)
+if settings.enable_compression:
+    # El más externo: comprime la respuesta final (headers de los demás incluidos)
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.compression_min_size,
+        offload_size=settings.compression_offload_size,
+        encodings=settings.get_compression_encodings(),
+        levels={
+            "gzip": settings.compression_gzip_level,
+            "br": settings.compression_brotli_quality,
+            "zstd": settings.compression_zstd_level
+        },
+        stats=compression_stats
+    )
 ai_service = None
 try:
-    ai_service = AIService()
+    ai_backend = crear_backend(settings.ai_backend, **settings.get_ai_backend_options())
+    ai_service = AIService(
+        span_factory=span,
+        backend=ai_backend,
+        max_retries=settings.ai_max_retries,
+        retry_base_delay=settings.ai_retry_base_delay,
+        retry_max_delay=settings.ai_retry_max_delay,
+        retry_budget=RetryBudget(
+            ratio=settings.ai_retry_budget_ratio,
+            min_retries=settings.ai_retry_budget_min
+        ),
+        hedge_enabled=settings.ai_hedge_enabled,
+        hedge_quantile=settings.ai_hedge_quantile,
+        hedge_min_delay=settings.ai_hedge_min_delay,
+        # Un hedge posible por llamada en curso: nunca menos que el límite de concurrencia
+        hedge_workers=max(settings.ai_hedge_workers, settings.ai_concurrency_max),
+        structured_output=settings.ai_structured_output,
+        prompt_builder=PromptBuilder(
+            version=settings.ai_prompt_version,
+            min_output_tokens=settings.ai_min_output_tokens,
+            output_tokens_ratio=settings.ai_output_tokens_ratio
+        )
+    )
     logger.info("Servicio de IA inicializado correctamente")
 except Exception as e:
     logger.error(f"Error al inicializar servicio de IA: {str(e)}")
@@ -116,9 +239,11 @@ async def root():
 @app.get("/health", response_model=HealthResponse, tags=["Health"])
 async def health_check():
     uptime = time() - start_time
+    circuito = ai_breaker.state
     return HealthResponse(
-        status="healthy" if ai_service else "degraded",
+        status="healthy" if ai_service and circuito != CIRCUITO_ABIERTO else "degraded",
         ai_service="ready" if ai_service else "not initialized",
+        circuit_breaker=circuito,
         version=settings.app_version,
         uptime=round(uptime, 2)
     )
@@ -127,9 +252,9 @@ async def health_check():
 @limiter.limit(RATE_LIMITS["auth_register"])
 async def register(request: Request, user_data: UserCreate, db: Session = Depends(get_db)):
     try:
-        user = create_user(db, user_data)
-        login_data = UserLogin(username=user.username, password=user_data.password)
-        token = login_user(db, login_data)
+        user = await create_user(db, user_data)
+        # El usuario recién creado ya está autenticado: no repetir bcrypt
+        token = issue_token(db, user)
         business_logger.log_user_action(
             "register",
             user.id,
@@ -149,7 +274,7 @@ async def register(request: Request, user_data: UserCreate, db: Session = Depend
 @limiter.limit(RATE_LIMITS["auth_login"])
 async def login(request: Request, login_data: UserLogin, db: Session = Depends(get_db)):
     try:
-        token = login_user(db, login_data)
+        token = await login_user(db, login_data)
         business_logger.log_user_action(
             "login",
             token.user["id"],
@@ -165,8 +290,18 @@ async def login(request: Request, login_data: UserLogin, db: Session = Depends(g
             detail=f"Error al iniciar sesión: {str(e)}"
         )
 @app.get("/api/auth/me", response_model=UserResponse, tags=["Autenticación"])
-async def get_me(current_user: Usuario = Depends(get_current_user)):
-    return current_user
+async def get_me(
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # El snapshot cacheado no incluye datos personales: leerlos de la BD
+    user = db.query(Usuario).filter(Usuario.id == current_user.id).first()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Usuario no encontrado"
+        )
+    return user
 # ==================== OAUTH (GOOGLE) ====================
 @app.get("/api/auth/oauth/status", tags=["OAuth"])
 async def oauth_status():
@@ -217,6 +352,228 @@ async def resend_verification_endpoint(
         "message": "Email de verificación enviado"
     }
 # ==================== ANÁLISIS (PROTEGIDO) ====================
+def _verificar_servicio_ia():
+    if not ai_service:
+        logger.error("Servicio de IA no inicializado")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=(
+                "El servicio de IA no está disponible. "
+                "Verifica la configuración de GEMINI_API_KEY"
+            )
+        )
+def _es_prioritario(http_request: Request, current_user: CurrentUser) -> bool:
+    # Admins y clientes con API key van en la clase prioritaria de la cola de IA
+    return current_user.is_admin or getattr(http_request.state, "api_key_client", False)
+def _circuito_abierto() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="El servicio de IA no responde correctamente. Intenta nuevamente en unos segundos.",
+        headers={"Retry-After": str(ai_breaker.retry_after())}
+    )
+_ESTADOS_INDISPONIBLE = (status.HTTP_503_SERVICE_UNAVAILABLE, status.HTTP_504_GATEWAY_TIMEOUT)
+def _respuesta_stale(cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    # Respaldo cuando la IA falla por indisponibilidad: entrada vencida del cache
+    if not settings.enable_cache or not cache_key:
+        return None
+    stale = cache.get_stale(cache_key)
+    if stale is None:
+        return None
+    logger.warning("Sirviendo resultado vencido del cache", cache_key=cache_key)
+    return _marcar_stale(stale)
+def _marcar_stale(resultado: Dict[str, Any]) -> Dict[str, Any]:
+    return {**resultado, "metadata": {**resultado.get("metadata", {}), "cached": True, "stale": True}}
+def _leer_cache(cache_key: str, texto: str, user_id: int) -> Optional[Dict[str, Any]]:
+    # Hit fresco, o vencido dentro de la ventana SWR: se sirve igual y se
+    # refresca en background para que el próximo request no espere a la IA
+    cached_result = cache.get(cache_key)
+    if cached_result is None and settings.cache_swr_ttl > 0:
+        vencido = cache.get_swr(cache_key)
+        if vencido is not None:
+            cache_contadores["swr_hits"] += 1
+            _revalidar(cache_key, texto, user_id)
+            cached_result = _marcar_stale(vencido)
+    return cached_result
+def _revalidar(cache_key: str, texto: str, user_id: int):
+    # Single-flight: a lo sumo un refresco en curso por clave
+    if cache_key in revalidaciones or ai_breaker.is_open():
+        return
+    cache_contadores["revalidations"] += 1
+    tarea = asyncio.create_task(_refrescar_cache(cache_key, texto, user_id))
+    revalidaciones[cache_key] = tarea
+    tarea.add_done_callback(lambda _: revalidaciones.pop(cache_key, None))
+async def _refrescar_cache(cache_key: str, texto: str, user_id: int):
+    # Los tokens se cobran al usuario que recibió la entrada vencida
+    try:
+        resultado = await _ejecutar_ia(texto, user_id)
+    except Exception as e:
+        cache_contadores["revalidation_errors"] += 1
+        logger.warning(
+            "No se pudo revalidar entrada del cache",
+            cache_key=cache_key,
+            error_detail=getattr(e, "detail", str(e))
+        )
+        return
+    response_data = _armar_respuesta(resultado)
+    if not response_data["metadata"]["partial"]:
+        cache.set(cache_key, response_data)
+    logger.info("Entrada del cache revalidada", sample_key="cache_revalidada", cache_key=cache_key)
+def _fallo_cacheado(texto: str) -> Optional[HTTPException]:
+    # Cache negativo: el mismo texto ya falló de forma determinista hace poco
+    if not settings.enable_cache or settings.cache_negative_ttl <= 0:
+        return None
+    fallo = cache_negativo.get(generate_cache_key(texto))
+    if fallo is None:
+        return None
+    cache_contadores["negative_hits"] += 1
+    logger.info("Fallo determinista servido del cache negativo", codigo=fallo["codigo"])
+    return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=fallo["error"])
+def _cachear_fallo(texto: str, error: str, codigo: Optional[str]):
+    if codigo and settings.enable_cache and settings.cache_negative_ttl > 0:
+        cache_negativo.set(generate_cache_key(texto), {"error": error, "codigo": codigo})
+        cache_contadores["negative_sets"] += 1
+async def _ejecutar_ia(texto: str, user_id: int, timeout: Optional[float] = None,
+                      prioritario: bool = False) -> Dict[str, Any]:
+    timeout = timeout or settings.gemini_timeout
+    fallo = _fallo_cacheado(texto)
+    if fallo:
+        raise fallo
+    if ai_breaker.is_open():
+        raise _circuito_abierto()
+    await token_meter.check(user_id)
+    inicio = time()
+    # Espera en la cola justa por usuario (visible en Server-Timing como ai.queue)
+    with span("ai.queue", prioritario=prioritario):
+        espera = await ai_limiter.acquire(timeout=timeout, key=user_id, priority=prioritario)
+    if not ai_breaker.allow():
+        ai_limiter.release()
+        raise _circuito_abierto()
+    logger.info(
+        f"Procesando tarea de {len(texto)} caracteres",
+        sample_key="analisis_inicio",
+        user_id=user_id,
+        queue_wait_ms=round(espera * 1000, 2)
+    )
+    # El plazo es por request: la espera en cola se descuenta del timeout
+    restante = max(timeout - (time() - inicio), 1.0)
+    inicio_ia = time()
+    # El thread puede seguir esperando al intento primario cuando un hedge ya
+    # ganó: se espera `entrega` (primer resultado) y el thread libera el lugar
+    entrega: Future = Future()
+    tarea = asyncio.ensure_future(
+        asyncio.to_thread(ai_service.desambiguar_tarea, texto, monotonic() + restante, entrega)
+    )
+    def _liberar(t: asyncio.Future):
+        # El lugar se libera cuando termina el thread, no cuando vence el timeout
+        latencia = time() - inicio_ia
+        if t.cancelled() or t.exception() is not None:
+            fallo, error = True, None
+        else:
+            # Un fallo determinista (SAFETY, JSON irrecuperable, con "codigo")
+            # depende del texto, no de la salud de Gemini: no cuenta para el
+            # circuito ni como sobrecarga
+            error = None if t.result().get("codigo") else t.result().get("error")
+            fallo = error is not None
+            # Se cobra aunque el request ya haya respondido 504
+            token_meter.record(user_id, **t.result().get("uso", {}))
+        ai_breaker.record(success=not fallo and latencia <= restante, duration=latencia)
+        ai_limiter.release(latencia, overloaded=latencia > restante or is_overload_error(error))
+    def _propagar_error(t: asyncio.Future):
+        # desambiguar_tarea no deja escapar errores, pero si pasara no colgar la espera
+        if not t.cancelled() and t.exception() is not None:
+            try:
+                entrega.set_exception(t.exception())
+            except InvalidStateError:
+                pass
+    tarea.add_done_callback(_liberar)
+    tarea.add_done_callback(_propagar_error)
+    try:
+        with span("ai", input_length=len(texto)):
+            resultado = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(entrega)), timeout=restante
+            )
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout al procesar tarea ({timeout}s)")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=(
+                f"El análisis tardó más de {timeout:g} segundos. "
+                "Intenta con un texto más corto."
+            )
+        )
+    if "error" in resultado:
+        logger.error(
+            "Error en procesamiento IA",
+            error_detail=resultado["error"],
+            codigo=resultado.get("codigo"),
+            user_id=user_id
+        )
+        _cachear_fallo(texto, resultado["error"], resultado.get("codigo"))
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=resultado["error"]
+        )
+    return resultado
+def _armar_respuesta(resultado: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "pasos": resultado.get("pasos", []),
+        "ambiguedades": resultado.get("ambiguedades", []),
+        "preguntas_sugeridas": resultado.get("preguntas_sugeridas", []),
+        "metadata": {
+            "total_pasos": len(resultado.get("pasos", [])),
+            "total_ambiguedades": len(resultado.get("ambiguedades", [])),
+            "total_preguntas": len(resultado.get("preguntas_sugeridas", [])),
+            "timestamp": datetime.now().isoformat(),
+            "cached": False,
+            # JSON de la IA truncado: solo los ítems que llegaron completos
+            "partial": resultado.get("parcial", False)
+        }
+    }
+def _nueva_consulta(user_id: int, texto: str, response_data: Dict[str, Any],
+                    tiempo_proceso: float) -> Consulta:
+    return Consulta(
+        usuario_id=user_id,
+        texto_original=texto,
+        pasos=dumps(response_data["pasos"]),
+        ambiguedades=dumps(response_data["ambiguedades"]),
+        preguntas=dumps(response_data["preguntas_sugeridas"]),
+        tiempo_respuesta_ms=int(tiempo_proceso),
+        cached=False
+    )
+def _guardar_consultas(db: Session, consultas: List[Consulta], user_id: int) -> bool:
+    # Una sola transacción; un fallo al guardar no hace fallar el request
+    try:
+        db.add_all(consultas)
+        def timeout_handler(signum, frame):
+            raise TimeoutError("Database commit timeout")
+        # signal solo funciona en el thread principal (y no existe SIGALRM en
+        # Windows): con el loop en otro thread (TestClient, worker embebido) el
+        # commit queda acotado por el timeout del driver (sqlite3: 5s de lock)
+        usar_alarma = hasattr(signal, "SIGALRM") and threading.current_thread() is threading.main_thread()
+        if usar_alarma:
+            old_handler = signal.signal(signal.SIGALRM, timeout_handler)
+            signal.alarm(5)  # 5 segundos timeout
+        try:
+            with span("db.commit", rows=len(consultas)):
+                db.commit()
+            logger.info(
+                "Consulta guardada en BD",
+                sample_key="consulta_guardada",
+                consulta_ids=[consulta.id for consulta in consultas],
+                user_id=user_id
+            )
+            return True
+        finally:
+            if usar_alarma:
+                signal.alarm(0)  # Cancelar alarma
+                signal.signal(signal.SIGALRM, old_handler)
+    except TimeoutError:
+        logger.error("Timeout al guardar en BD", timeout_seconds=5, user_id=user_id)
+        db.rollback()
+    except Exception as e:
+        logger.error("Error al guardar en BD", error=e, user_id=user_id)
+        db.rollback()
+    return False
 @app.post(
     "/api/desambiguar",
     response_model=TareaResponse,
@@ -232,115 +589,79 @@ async def resend_verification_endpoint(
 @measure_time
 async def desambiguar_tarea(
     request: TareaRequest,
+    http_request: Request,
+    response: Response,
     db: Session = Depends(get_db),
-    current_user: Usuario = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ) -> TareaResponse:
-    start_process_time = time()
     # Verificar que el servicio de IA esté disponible
-    if not ai_service:
-        logger.error("Servicio de IA no inicializado")
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail=(
-                "El servicio de IA no está disponible. "
-                "Verifica la configuración de GEMINI_API_KEY"
-            )
-        )
+    _verificar_servicio_ia()
+    prioritario = _es_prioritario(http_request, current_user)
+    idempotency_key = http_request.headers.get(IDEMPOTENCY_HEADER)
+    if idempotency_key is None:
+        return TareaResponse(**await _analizar_tarea(request.texto, current_user.id, db, prioritario))
+    # Reintentos del cliente: misma respuesta (o el mismo cómputo en curso)
+    response_data, replayed = await idempotency_store.run(
+        current_user.id,
+        IdempotencyStore.validate_key(idempotency_key),
+        IdempotencyStore.fingerprint(request.texto),
+        lambda: _analizar_con_sesion_propia(request.texto, current_user.id, prioritario)
+    )
+    if replayed:
+        response.headers[REPLAYED_HEADER] = "true"
+        logger.info("Respuesta idempotente reutilizada", user_id=current_user.id)
+    return TareaResponse(**response_data)
+async def _analizar_con_sesion_propia(texto: str, user_id: int,
+                                     prioritario: bool = False) -> Dict[str, Any]:
+    # El cómputo idempotente corre desacoplado del request (shield) y puede
+    # terminar después de que get_db cierre la sesión: usar una propia
+    db = SessionLocal()
+    try:
+        return await _analizar_tarea(texto, user_id, db, prioritario)
+    finally:
+        db.close()
+async def _analizar_tarea(texto: str, user_id: int, db: Session,
+                          prioritario: bool = False) -> Dict[str, Any]:
+    start_process_time = time()
+    cache_key = None
     # Verificar cache si está habilitado
     if settings.enable_cache:
-        cache_key = generate_cache_key(request.texto)
-        cached_result = cache.get(cache_key)
+        cache_key = generate_cache_key(texto)
+        with span("cache.lookup"):
+            cached_result = _leer_cache(cache_key, texto, user_id)
         if cached_result:
             business_logger.log_cache_hit(cache_key)
-            return TareaResponse(**cached_result)
+            return cached_result
         else:
             business_logger.log_cache_miss(cache_key)
     try:
-        logger.info(f"Procesando tarea de {len(request.texto)} caracteres", user_id=current_user.id)
-        try:
-            resultado = await asyncio.wait_for(
-                asyncio.to_thread(ai_service.desambiguar_tarea, request.texto),
-                timeout=settings.gemini_timeout
-            )
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout al procesar tarea ({settings.gemini_timeout}s)")
-            raise HTTPException(
-                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-                detail=(
-                    f"El análisis tardó más de {settings.gemini_timeout} segundos. "
-                    "Intenta con un texto más corto."
-                )
-            )
-        if "error" in resultado:
-            logger.error(
-                "Error en procesamiento IA",
-                error_detail=resultado["error"],
-                user_id=current_user.id
-            )
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=resultado["error"]
-            )
+        resultado = await _ejecutar_ia(texto, user_id, prioritario=prioritario)
         tiempo_proceso = (time() - start_process_time) * 1000
         business_logger.log_ai_call(
-            input_length=len(request.texto),
+            input_length=len(texto),
             response_time_ms=tiempo_proceso,
             success=True,
-            user_id=current_user.id,
+            user_id=user_id,
             pasos_count=len(resultado.get("pasos", [])),
-            ambiguedades_count=len(resultado.get("ambiguedades", []))
+            ambiguedades_count=len(resultado.get("ambiguedades", [])),
+            **resultado.get("uso", {})
         )
-        response_data = {
-            "pasos": resultado.get("pasos", []),
-            "ambiguedades": resultado.get("ambiguedades", []),
-            "preguntas_sugeridas": resultado.get("preguntas_sugeridas", []),
-            "metadata": {
-                "total_pasos": len(resultado.get("pasos", [])),
-                "total_ambiguedades": len(resultado.get("ambiguedades", [])),
-                "total_preguntas": len(resultado.get("preguntas_sugeridas", [])),
-                "timestamp": datetime.now().isoformat(),
-                "cached": False
-            }
-        }
-        try:
-            consulta = Consulta(
-                usuario_id=current_user.id,
-                texto_original=request.texto,
-                pasos=json.dumps(response_data["pasos"]),
-                ambiguedades=json.dumps(response_data["ambiguedades"]),
-                preguntas=json.dumps(response_data["preguntas_sugeridas"]),
-                tiempo_respuesta_ms=int(tiempo_proceso),
-                cached=False
-            )
-            db.add(consulta)
-            def timeout_handler(signum, frame):
-                raise TimeoutError("Database commit timeout")
-            old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(5)  # 5 segundos timeout
-            try:
-                db.commit()
-                logger.info(
-                    "Consulta guardada en BD",
-                    consulta_id=consulta.id,
-                    user_id=current_user.id
-                )
-            finally:
-                signal.alarm(0)  # Cancelar alarma
-                signal.signal(signal.SIGALRM, old_handler)
-        except TimeoutError:
-            logger.error("Timeout al guardar en BD", timeout_seconds=5, user_id=current_user.id)
-            db.rollback()
-            # No fallar el request si falla el guardado
-        except Exception as e:
-            logger.error("Error al guardar en BD", error=e, user_id=current_user.id)
-            db.rollback()
-            # No fallar el request si falla el guardado
-        # Guardar en cache
-        if settings.enable_cache:
+        response_data = _armar_respuesta(resultado)
+        _guardar_consultas(
+            db,
+            [_nueva_consulta(user_id, texto, response_data, tiempo_proceso)],
+            user_id
+        )
+        # Guardar en cache (una respuesta parcial no: el próximo intento puede salir completo)
+        if settings.enable_cache and not response_data["metadata"]["partial"]:
             cache.set(cache_key, response_data)
-        logger.info("Tarea procesada exitosamente")
-        return TareaResponse(**response_data)
-    except HTTPException:
+        logger.info("Tarea procesada exitosamente", sample_key="analisis_fin")
+        return response_data
+    except HTTPException as e:
+        if e.status_code in _ESTADOS_INDISPONIBLE:
+            stale = _respuesta_stale(cache_key)
+            if stale:
+                return stale
         raise
     except ValueError as e:
         logger.error(f"Error de validación: {str(e)}")
@@ -354,12 +675,428 @@ async def desambiguar_tarea(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error inesperado: {str(e)}"
         )
+@app.post(
+    "/api/desambiguar/batch",
+    response_model=TareaBatchResponse,
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {"description": "Lote procesado (revisar errores por ítem)"},
+        503: {"description": "Servicio de IA no disponible", "model": ErrorResponse}
+    },
+    tags=["Análisis"]
+)
+async def desambiguar_lote(
+    lote: TareaBatchRequest,
+    http_request: Request,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+) -> TareaBatchResponse:
+    start_process_time = time()
+    _verificar_servicio_ia()
+    # Deduplicar: textos idénticos se analizan una sola vez
+    claves = [generate_cache_key(tarea.texto) for tarea in lote.tareas]
+    textos: Dict[str, str] = {}
+    for clave, tarea in zip(claves, lote.tareas):
+        textos.setdefault(clave, tarea.texto)
+    resultados: Dict[str, Dict[str, Any]] = {}
+    errores: Dict[str, str] = {}
+    tiempos: Dict[str, float] = {}
+    if settings.enable_cache:
+        with span("cache.lookup", items=len(textos)):
+            for clave in textos:
+                cached_result = _leer_cache(clave, textos[clave], current_user.id)
+                if cached_result:
+                    resultados[clave] = cached_result
+    cacheados = set(resultados)
+    prioritario = _es_prioritario(http_request, current_user)
+    semaforo = asyncio.Semaphore(settings.batch_max_concurrency)
+    async def analizar(clave: str):
+        async with semaforo:
+            inicio = time()
+            try:
+                resultado = await _ejecutar_ia(
+                    textos[clave], current_user.id, prioritario=prioritario
+                )
+            except HTTPException as e:
+                stale = _respuesta_stale(clave) if e.status_code in _ESTADOS_INDISPONIBLE else None
+                if stale:
+                    resultados[clave] = stale
+                    cacheados.add(clave)
+                else:
+                    errores[clave] = str(e.detail)
+                return
+            except Exception as e:
+                logger.error("Error inesperado en ítem de lote", error=e, user_id=current_user.id)
+                errores[clave] = f"Error inesperado: {str(e)}"
+                return
+            tiempos[clave] = (time() - inicio) * 1000
+            resultados[clave] = _armar_respuesta(resultado)
+    # Fan-out de los misses con concurrencia acotada
+    await asyncio.gather(*(analizar(clave) for clave in textos if clave not in cacheados))
+    nuevos = [clave for clave in tiempos if clave in resultados]
+    if nuevos:
+        _guardar_consultas(
+            db,
+            [
+                _nueva_consulta(current_user.id, textos[clave], resultados[clave], tiempos[clave])
+                for clave in nuevos
+            ],
+            current_user.id
+        )
+        if settings.enable_cache:
+            for clave in nuevos:
+                if not resultados[clave]["metadata"]["partial"]:
+                    cache.set(clave, resultados[clave])
+    items = [
+        TareaBatchItem(
+            indice=indice,
+            resultado=TareaResponse(**resultados[clave]) if clave in resultados else None,
+            error=errores.get(clave),
+            cached=clave in cacheados
+        )
+        for indice, clave in enumerate(claves)
+    ]
+    exitosos = sum(1 for item in items if item.resultado is not None)
+    tiempo_total = (time() - start_process_time) * 1000
+    business_logger.log_user_action(
+        "batch_analysis",
+        current_user.id,
+        items=len(items),
+        unicos=len(textos),
+        cache_hits=len(cacheados),
+        fallidos=len(items) - exitosos,
+        response_time_ms=round(tiempo_total, 2)
+    )
+    return TareaBatchResponse(
+        resultados=items,
+        total=len(items),
+        exitosos=exitosos,
+        fallidos=len(items) - exitosos,
+        metadata={
+            "unicos": len(textos),
+            "cache_hits": len(cacheados),
+            "tiempo_ms": round(tiempo_total, 2),
+            "timestamp": datetime.now().isoformat()
+        }
+    )
+# ==================== ANÁLISIS EN STREAMING (SSE) ====================
+_EVENTOS_SSE = {
+    "pasos": "paso",
+    "ambiguedades": "ambiguedad",
+    "preguntas_sugeridas": "pregunta"
+}
+def _evento_sse(evento: str, data: Any) -> str:
+    return f"event: {evento}\ndata: {dumps(data)}\n\n"
+async def _stream_analisis(
+    texto: str,
+    user_id: int,
+    cache_key: Optional[str],
+    cached_result: Optional[Dict[str, Any]],
+    prioritario: bool = False
+) -> AsyncIterator[str]:
+    if cached_result:
+        for campo, evento in _EVENTOS_SSE.items():
+            for indice, valor in enumerate(cached_result.get(campo, [])):
+                yield _evento_sse(evento, {"indice": indice, "texto": valor})
+        yield _evento_sse("resultado", cached_result)
+        return
+    try:
+        espera = await ai_limiter.acquire(key=user_id, priority=prioritario)
+        if not ai_breaker.allow():
+            ai_limiter.release()
+            raise _circuito_abierto()
+    except HTTPException as e:
+        yield _evento_sse("error", {"error": e.detail, "retry_after": e.headers["Retry-After"]})
+        return
+    start_process_time = time()
+    sobrecarga = False
+    fallo = False
+    try:
+        async for evento in _stream_gemini(texto, user_id, start_process_time, cache_key, espera):
+            if evento is None:
+                sobrecarga = True  # Timeout entre chunks o 429 del proveedor
+                continue
+            # Igual que en _ejecutar_ia: los errores con "codigo" (deterministas) no cuentan
+            fallo = fallo or (evento.startswith("event: error") and '"codigo"' not in evento)
+            yield evento
+    finally:
+        latencia = time() - start_process_time
+        ai_breaker.record(success=not fallo and not sobrecarga, duration=latencia)
+        ai_limiter.release(latencia, overloaded=sobrecarga)
+async def _stream_gemini(texto: str, user_id: int, start_process_time: float,
+                         cache_key: Optional[str],
+                         espera: float = 0.0) -> AsyncIterator[Optional[str]]:
+    primer_item_ms = None
+    contadores = {campo: 0 for campo in _EVENTOS_SSE}
+    resultado = None
+    iterador = ai_service.desambiguar_tarea_stream(texto)
+    logger.info(
+        f"Procesando tarea de {len(texto)} caracteres (streaming)",
+        sample_key="analisis_inicio",
+        user_id=user_id,
+        queue_wait_ms=round(espera * 1000, 2)
+    )
+    try:
+        while True:
+            # El SDK de Gemini es bloqueante: cada chunk se espera en un thread
+            tipo, dato = await asyncio.wait_for(
+                asyncio.to_thread(next, iterador, (None, None)),
+                timeout=settings.gemini_timeout
+            )
+            if tipo is None:
+                break
+            if tipo == "item":
+                campo, valor = dato
+                if primer_item_ms is None:
+                    primer_item_ms = (time() - start_process_time) * 1000
+                yield _evento_sse(
+                    _EVENTOS_SSE[campo],
+                    {"indice": contadores[campo], "texto": valor}
+                )
+                contadores[campo] += 1
+            elif tipo == "resultado":
+                resultado = dato
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout entre chunks de streaming ({settings.gemini_timeout}s)", user_id=user_id)
+        yield None
+        yield _evento_sse("error", {
+            "error": "Timeout",
+            "detail": f"Gemini no envió datos durante {settings.gemini_timeout} segundos"
+        })
+        return
+    except Exception as e:
+        logger.error("Error en análisis streaming", error=e, user_id=user_id)
+        codigo = codigo_error(e)
+        if not codigo and is_overload_error(str(e)):
+            yield None
+        # Sin cache negativo: el streaming no reintenta un JSON mal formado como
+        # _procesar_con_reintentos, así que un solo corte no prueba que el texto falle siempre
+        error = {"error": "Error al procesar con Gemini", "detail": str(e)}
+        if codigo:
+            error["codigo"] = codigo
+        yield _evento_sse("error", error)
+        return
+    finally:
+        try:
+            iterador.close()
+        except ValueError:
+            pass  # Todavía ejecutándose en un thread (timeout/desconexión)
+    if resultado is None:
+        yield _evento_sse("error", {"error": "Gemini no generó una respuesta válida"})
+        return
+    tiempo_proceso = (time() - start_process_time) * 1000
+    business_logger.log_ai_call(
+        input_length=len(texto),
+        response_time_ms=tiempo_proceso,
+        success=True,
+        user_id=user_id,
+        streaming=True,
+        first_item_ms=round(primer_item_ms, 2) if primer_item_ms is not None else None,
+        pasos_count=len(resultado.get("pasos", [])),
+        ambiguedades_count=len(resultado.get("ambiguedades", [])),
+        **resultado.get("uso", {})
+    )
+    token_meter.record(user_id, **resultado.get("uso", {}))
+    response_data = _armar_respuesta(resultado)
+    if settings.enable_cache and cache_key and not response_data["metadata"]["partial"]:
+        cache.set(cache_key, response_data)
+    # La sesión de get_db ya se cerró al empezar el streaming: usar una propia
+    db = SessionLocal()
+    try:
+        _guardar_consultas(
+            db,
+            [_nueva_consulta(user_id, texto, response_data, tiempo_proceso)],
+            user_id
+        )
+    finally:
+        db.close()
+    yield _evento_sse("resultado", response_data)
+@app.post(
+    "/api/desambiguar/stream",
+    responses={
+        200: {
+            "description": (
+                "Eventos SSE: paso, ambiguedad, pregunta (a medida que se generan), "
+                "resultado (final) o error"
+            ),
+            "content": {"text/event-stream": {}}
+        },
+        503: {"description": "Servicio de IA no disponible", "model": ErrorResponse}
+    },
+    tags=["Análisis"]
+)
+async def desambiguar_tarea_stream(
+    request: TareaRequest,
+    http_request: Request,
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    _verificar_servicio_ia()
+    cache_key = None
+    cached_result = None
+    if settings.enable_cache:
+        cache_key = generate_cache_key(request.texto)
+        with span("cache.lookup"):
+            cached_result = _leer_cache(cache_key, request.texto, current_user.id)
+        if cached_result:
+            business_logger.log_cache_hit(cache_key)
+        else:
+            business_logger.log_cache_miss(cache_key)
+    if not cached_result and ai_breaker.is_open():
+        cached_result = _respuesta_stale(cache_key)
+        if not cached_result:
+            raise _circuito_abierto()
+    if not cached_result:
+        # Fallo determinista reciente, cuota agotada o cola llena: error HTTP
+        # antes de abrir el stream
+        fallo = _fallo_cacheado(request.texto)
+        if fallo:
+            raise fallo
+        await token_meter.check(current_user.id)
+        ai_limiter.check_admission(key=current_user.id)
+    return StreamingResponse(
+        _stream_analisis(
+            request.texto, current_user.id, cache_key, cached_result,
+            prioritario=_es_prioritario(http_request, current_user)
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+# ==================== TRABAJOS ASÍNCRONOS ====================
+async def procesar_trabajo(texto: str, user_id: int,
+                           timeout: float) -> Tuple[Dict[str, Any], Optional[int]]:
+    # Mismo flujo que /api/desambiguar, ejecutado por un worker de jobs.py
+    start_process_time = time()
+    _verificar_servicio_ia()
+    cache_key = None
+    if settings.enable_cache:
+        cache_key = generate_cache_key(texto)
+        cached_result = _leer_cache(cache_key, texto, user_id)
+        if cached_result:
+            business_logger.log_cache_hit(cache_key)
+            return cached_result, None
+        business_logger.log_cache_miss(cache_key)
+    resultado = await _ejecutar_ia(texto, user_id, timeout=timeout)
+    tiempo_proceso = (time() - start_process_time) * 1000
+    business_logger.log_ai_call(
+        input_length=len(texto),
+        response_time_ms=tiempo_proceso,
+        success=True,
+        user_id=user_id,
+        pasos_count=len(resultado.get("pasos", [])),
+        ambiguedades_count=len(resultado.get("ambiguedades", [])),
+        **resultado.get("uso", {})
+    )
+    response_data = _armar_respuesta(resultado)
+    consulta = _nueva_consulta(user_id, texto, response_data, tiempo_proceso)
+    db = SessionLocal()
+    try:
+        guardada = _guardar_consultas(db, [consulta], user_id)
+        consulta_id = consulta.id if guardada else None
+    finally:
+        db.close()
+    if cache_key and not response_data["metadata"]["partial"]:
+        cache.set(cache_key, response_data)
+    return response_data, consulta_id
+job_queue = JobQueue(max_intentos=settings.job_max_attempts)
+job_pool = JobWorkerPool(
+    job_queue,
+    procesar_trabajo,
+    workers=settings.job_workers,
+    job_timeout=settings.job_timeout,
+    poll_interval=settings.job_poll_interval,
+    retry_base_delay=settings.job_retry_base_delay,
+    retry_max_delay=settings.job_retry_max_delay
+)
+def _trabajo_response(trabajo: TrabajoAnalisis) -> TrabajoResponse:
+    return TrabajoResponse(
+        job_id=trabajo.id,
+        estado=trabajo.estado,
+        resultado=loads(trabajo.resultado) if trabajo.resultado else None,
+        error=trabajo.error,
+        consulta_id=trabajo.consulta_id,
+        intentos=trabajo.intentos,
+        created_at=trabajo.created_at.isoformat() if trabajo.created_at else None,
+        started_at=trabajo.started_at.isoformat() if trabajo.started_at else None,
+        finished_at=trabajo.finished_at.isoformat() if trabajo.finished_at else None
+    )
+def _obtener_trabajo(db: Session, job_id: str, user_id: int) -> TrabajoAnalisis:
+    trabajo = db.query(TrabajoAnalisis).filter(TrabajoAnalisis.id == job_id).first()
+    if not trabajo or trabajo.usuario_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Trabajo no encontrado"
+        )
+    return trabajo
+@app.post(
+    "/api/jobs",
+    response_model=TrabajoCreadoResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={
+        202: {"description": "Trabajo encolado"},
+        503: {"description": "Servicio de IA no disponible", "model": ErrorResponse}
+    },
+    tags=["Análisis"]
+)
+async def crear_trabajo(
+    request: TareaRequest,
+    http_request: Request,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+) -> TrabajoCreadoResponse:
+    _verificar_servicio_ia()
+    trabajo = job_queue.submit(db, current_user.id, request.texto)
+    job_pool.notify()
+    logger.info("Trabajo encolado", job_id=trabajo.id, user_id=current_user.id)
+    return TrabajoCreadoResponse(
+        job_id=trabajo.id,
+        estado=trabajo.estado,
+        status_url=str(http_request.url_for("obtener_trabajo", job_id=trabajo.id))
+    )
+@app.get("/api/jobs/{job_id}", response_model=TrabajoResponse, tags=["Análisis"])
+async def obtener_trabajo(
+    job_id: str,
+    wait: float = 0,
+    current_user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db)
+) -> TrabajoResponse:
+    # wait > 0: long-polling hasta que el trabajo termine o venza el plazo
+    trabajo = _obtener_trabajo(db, job_id, current_user.id)
+    deadline = time() + min(max(wait, 0), settings.job_max_wait)
+    while trabajo.estado not in ESTADOS_FINALES:
+        restante = deadline - time()
+        if restante <= 0:
+            break
+        await job_pool.wait(job_id, min(restante, settings.job_poll_interval * 5))
+        db.expire(trabajo)
+        trabajo = _obtener_trabajo(db, job_id, current_user.id)
+    return _trabajo_response(trabajo)
+# ==================== USO Y CUOTAS ====================
+@app.get("/api/uso", response_model=UsoResponse, tags=["Historial"])
+async def obtener_uso(
+    dias: int = 7,
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    # Tokens de Gemini del usuario por día (UTC), con la cuota diaria de hoy
+    dias = min(max(dias, 1), 90)
+    historial = await asyncio.to_thread(token_meter.history, current_user.id, dias)
+    reinicio = token_meter.reset_at()
+    hoy = historial[0] if historial and historial[0]["fecha"] == (reinicio.date() - timedelta(days=1)).isoformat() else None
+    usado = hoy["total_tokens"] if hoy else 0
+    limite = token_meter.daily_limit or None
+    return UsoResponse(
+        limite_diario=limite,
+        usado_hoy=usado,
+        restante_hoy=max(limite - usado, 0) if limite else None,
+        reinicio=f"{reinicio.isoformat()}Z",
+        costo_hoy_usd=hoy["costo_usd"] if hoy else 0.0,
+        dias=[UsoDiaItem(**dia) for dia in historial]
+    )
 # ==================== HISTORIAL ====================
 @app.get("/api/historial", tags=["Historial"])
 async def obtener_historial(
     limit: int = 10,
     offset: int = 0,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: CurrentUser = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     try:
@@ -378,9 +1115,9 @@ async def obtener_historial(
             historial.append({
                 "id": c.id,
                 "texto_original": c.texto_original,
-                "pasos": json.loads(c.pasos) if c.pasos else [],
-                "ambiguedades": json.loads(c.ambiguedades) if c.ambiguedades else [],
-                "preguntas": json.loads(c.preguntas) if c.preguntas else [],
+                "pasos": loads(c.pasos) if c.pasos else [],
+                "ambiguedades": loads(c.ambiguedades) if c.ambiguedades else [],
+                "preguntas": loads(c.preguntas) if c.preguntas else [],
                 "tiempo_respuesta_ms": c.tiempo_respuesta_ms,
                 "cached": c.cached,
                 "created_at": c.created_at.isoformat()
@@ -400,7 +1137,8 @@ async def obtener_historial(
 @app.get("/api/historial/{consulta_id}", tags=["Historial"])
 async def obtener_consulta(
     consulta_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     consulta = db.query(Consulta).filter(Consulta.id == consulta_id).first()
@@ -415,20 +1153,29 @@ async def obtener_consulta(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permiso para ver esta consulta"
         )
-    return {
-        "id": consulta.id,
-        "texto_original": consulta.texto_original,
-        "pasos": json.loads(consulta.pasos) if consulta.pasos else [],
-        "ambiguedades": json.loads(consulta.ambiguedades) if consulta.ambiguedades else [],
-        "preguntas": json.loads(consulta.preguntas) if consulta.preguntas else [],
-        "tiempo_respuesta_ms": consulta.tiempo_respuesta_ms,
-        "cached": consulta.cached,
-        "created_at": consulta.created_at.isoformat()
-    }
+    # Una consulta no cambia después de guardarse: id y fecha alcanzan como
+    # validador, y con un 304 no hace falta desencriptar ni parsear nada
+    creada = consulta.created_at.isoformat()
+    return respuesta_condicional(
+        request,
+        lambda: {
+            "id": consulta.id,
+            "texto_original": consulta.texto_original,
+            "pasos": loads(consulta.pasos) if consulta.pasos else [],
+            "ambiguedades": loads(consulta.ambiguedades) if consulta.ambiguedades else [],
+            "preguntas": loads(consulta.preguntas) if consulta.preguntas else [],
+            "tiempo_respuesta_ms": consulta.tiempo_respuesta_ms,
+            "cached": consulta.cached,
+            "created_at": creada
+        },
+        etag=etag_de("consulta", consulta.id, creada),
+        cache_control="private, no-cache",
+        last_modified=fecha_http(consulta.created_at)
+    )
 @app.delete("/api/historial/{consulta_id}", tags=["Historial"])
 async def eliminar_consulta(
     consulta_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: CurrentUser = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     consulta = db.query(Consulta).filter(Consulta.id == consulta_id).first()
@@ -452,17 +1199,21 @@ async def eliminar_consulta(
     )
     return {"message": "Consulta eliminada exitosamente"}
 # ==================== UTILIDADES ====================
-@app.get("/api/ejemplos", response_model=EjemplosResponse, tags=["Utilidades"])
-async def obtener_ejemplos():
+def _respuesta_ejemplos() -> RespuestaEstatica:
     from shared.config import EJEMPLOS
     ejemplos = [
         EjemploItem(categoria=key, texto=value)
         for key, value in EJEMPLOS.items()
     ]
-    return EjemplosResponse(
-        ejemplos=ejemplos,
-        total=len(ejemplos)
+    return RespuestaEstatica(
+        EjemplosResponse(ejemplos=ejemplos, total=len(ejemplos)).model_dump(),
+        cache_control=f"public, max-age={settings.static_cache_max_age}"
     )
+# Los ejemplos solo cambian con un deploy: se serializan una vez al arrancar
+ejemplos_estaticos = _respuesta_ejemplos()
+@app.get("/api/ejemplos", response_model=EjemplosResponse, tags=["Utilidades"])
+async def obtener_ejemplos(request: Request):
+    return ejemplos_estaticos.response(request)
 @app.get("/api/stats", response_model=StatsResponse, tags=["Monitoreo"])
 async def obtener_estadisticas():
     stats = stats_tracker.get_stats()
@@ -472,28 +1223,89 @@ async def cache_stats():
     return {
         "cache_enabled": settings.enable_cache,
         "cache_size": cache.size(),
-        "cache_ttl": settings.cache_ttl
+        "cache_ttl": settings.cache_ttl,
+        "swr_ttl": settings.cache_swr_ttl,
+        "revalidating": len(revalidaciones),
+        "negative_size": cache_negativo.size(),
+        "negative_ttl": settings.cache_negative_ttl,
+        **cache_contadores,
+        "auth_cache": auth_cache.get_stats(),
+        "idempotency": idempotency_store.get_stats()
     }
+@app.get("/api/ai/stats", tags=["Monitoreo"])
+async def ai_stats():
+    return {
+        "concurrency": ai_limiter.get_stats(),
+        "circuit_breaker": ai_breaker.get_stats(),
+        "resilience": ai_service.get_resilience_stats() if ai_service else None,
+        "tokens": ai_service.get_token_stats() if ai_service else None,
+        "usage": token_meter.get_stats()
+    }
+@app.get("/api/compression/stats", tags=["Monitoreo"])
+async def compression_stats_endpoint():
+    return {"enabled": settings.enable_compression, **compression_stats.get_stats()}
+@app.get("/api/logs/stats", tags=["Monitoreo"])
+async def log_stats():
+    return logger.get_stats()
 @app.post("/api/cache/clear", tags=["Monitoreo"])
 async def clear_cache():
     cache.clear()
+    cache_negativo.clear()
     logger.info("Cache limpiado manualmente")
     return {"message": "Cache limpiado correctamente"}
+# ==================== PROFILING (ADMIN) ====================
+@app.get("/api/admin/profiles", tags=["Monitoreo"])
+async def listar_perfiles(current_user: CurrentUser = Depends(get_current_admin)):
+    return {
+        "enabled": settings.enable_profiling,
+        "sample_rate": settings.profiling_sample_rate,
+        "max_profiles": settings.profiling_max_profiles,
+        "profiles": profile_store.list()
+    }
+@app.get("/api/admin/profiles/{profile_id}", tags=["Monitoreo"])
+async def descargar_perfil(
+    profile_id: int,
+    formato: str = "speedscope",
+    current_user: CurrentUser = Depends(get_current_admin)
+):
+    profile = profile_store.get(profile_id)
+    if not profile:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Perfil no encontrado"
+        )
+    if formato == "pstats":
+        return Response(
+            content=to_pstats_bytes(profile["stats"]),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.prof"'}
+        )
+    if formato == "speedscope":
+        nombre = f"{profile['method']} {profile['path']} ({profile['duration_ms']}ms)"
+        return FastJSONResponse(
+            content=to_speedscope(profile["stats"], nombre),
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.speedscope.json"'}
+        )
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Formato no soportado. Usa 'pstats' o 'speedscope'"
+    )
 # ==================== EXCEPTION HANDLERS ====================
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     logger.warning(f"HTTP {exc.status_code}: {exc.detail}")
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=exc.status_code,
         content=ErrorResponse(
             error=exc.detail or "Error en la petición",
             detail=str(exc.detail) if exc.detail else None
-        ).model_dump()
+        ).model_dump(),
+        headers=getattr(exc, "headers", None)
     )
 @app.exception_handler(ValueError)
 async def value_error_handler(request: Request, exc: ValueError):
     logger.warning(f"Validation error: {str(exc)}")
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content=ErrorResponse(
             error="Error de validación",
@@ -503,7 +1315,7 @@ async def value_error_handler(request: Request, exc: ValueError):
 @app.exception_handler(TimeoutError)
 async def timeout_error_handler(request: Request, exc: TimeoutError):
     logger.error(f"⏱️ Timeout error: {str(exc)}")
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=status.HTTP_504_GATEWAY_TIMEOUT,
         content=ErrorResponse(
             error="Timeout",
@@ -514,7 +1326,7 @@ async def timeout_error_handler(request: Request, exc: TimeoutError):
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.exception(f"Error no manejado: {exc}")
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=500,
         content=ErrorResponse(
             error="Error interno del servidor",
@@ -10,7 +10,7 @@ logger = logging.getLogger(__name__)
 class RequestLoggingMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         start_time = time()
-        logger.info(f"{request.method} {request.url.path}")
+        logger.debug(f"{request.method} {request.url.path}")
         response = await call_next(request)
         process_time = (time() - start_time) * 1000
         logger.info(
@@ -179,6 +179,7 @@ class APIKeyMiddleware(BaseHTTPMiddleware):
                 }
             )
         logger.info(f"Valid API key for {request.url.path}")
+        request.state.api_key_client = True  # Clase prioritaria en la cola de IA
         return await call_next(request)
 class SecurityHeadersMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -2,7 +2,26 @@ from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 import re
-import html
+# Bytes < 0x20 a eliminar (todos salvo \n, \r y \t). En UTF-8 nunca forman
+# parte de un carácter multibyte, así que borrarlos de los bytes equivale a
+# borrar esos caracteres del texto.
+_BYTES_CONTROL = bytes(c for c in range(32) if chr(c) not in '\n\r\t')
+# Mismos reemplazos y orden que html.escape(quote=True)
+_ESCAPES_HTML = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#x27;'))
+_ALFANUMERICO = re.compile(r'[a-zA-Z0-9]')
+def sanitizar_texto(v: str) -> str:
+    # Equivale a eliminar los caracteres de control (salvo \n, \r y \t),
+    # strip() y html.escape(), sin recorrer el texto carácter por carácter en Python
+    datos = v.encode('utf-8', 'surrogatepass')
+    limpios = datos.translate(None, _BYTES_CONTROL)
+    if len(limpios) != len(datos):
+        v = limpios.decode('utf-8', 'surrogatepass')
+    v = v.strip()
+    # `in` es mucho más barato que un replace() que no encuentra nada
+    for caracter, escape in _ESCAPES_HTML:
+        if caracter in v:
+            v = v.replace(caracter, escape)
+    return v
 class TareaRequest(BaseModel):
     texto: str = Field(
         ...,
@@ -15,12 +34,10 @@ class TareaRequest(BaseModel):
     def validar_texto(cls, v: str) -> str:
         if not v or not v.strip():
             raise ValueError('El texto no puede estar vacío')
-        # Sanitizar: eliminar caracteres de control
-        texto_limpio = ''.join(char for char in v if ord(char) >= 32 or char in '\n\r\t')
-        # Escape HTML para prevenir XSS
-        texto_limpio = html.escape(texto_limpio.strip())
+        # Sanitizar: eliminar caracteres de control y escape HTML para prevenir XSS
+        texto_limpio = sanitizar_texto(v)
         # Validar que no contenga solo caracteres especiales
-        if not re.search(r'[a-zA-Z0-9]', texto_limpio):
+        if not _ALFANUMERICO.search(texto_limpio):
             raise ValueError('El texto debe contener al menos caracteres alfanuméricos')
         # Validar longitud después de sanitización
         if len(texto_limpio) < 10:
@@ -66,6 +83,62 @@ class TareaResponse(BaseModel):
                 }
             }
         }
+BATCH_MAX_TAREAS = 50
+class TareaBatchRequest(BaseModel):
+    tareas: List[TareaRequest] = Field(
+        ...,
+        min_length=1,
+        max_length=BATCH_MAX_TAREAS,
+        description="Tareas a analizar en un solo request"
+    )
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "tareas": [
+                    {"texto": "Hacer un ensayo sobre la Segunda Guerra Mundial para el viernes"},
+                    {"texto": "Preparar una presentación sobre cambio climático"}
+                ]
+            }
+        }
+class TareaBatchItem(BaseModel):
+    indice: int = Field(..., description="Posición de la tarea en el request")
+    resultado: Optional[TareaResponse] = Field(None, description="Análisis (si tuvo éxito)")
+    error: Optional[str] = Field(None, description="Error del ítem (si falló)")
+    cached: bool = Field(False, description="Resultado servido desde cache")
+class TareaBatchResponse(BaseModel):
+    resultados: List[TareaBatchItem] = Field(..., description="Resultados en el orden del request")
+    total: int = Field(..., description="Total de tareas recibidas")
+    exitosos: int = Field(..., description="Tareas analizadas correctamente")
+    fallidos: int = Field(..., description="Tareas con error")
+    metadata: Optional[Dict[str, Any]] = Field(default=None, description="Metadatos del lote")
+class TrabajoCreadoResponse(BaseModel):
+    job_id: str = Field(..., description="Identificador del trabajo")
+    estado: str = Field(..., description="Estado inicial (pendiente)")
+    status_url: str = Field(..., description="URL para consultar el estado")
+class TrabajoResponse(BaseModel):
+    job_id: str = Field(..., description="Identificador del trabajo")
+    estado: str = Field(..., description="pendiente, procesando, completado o error")
+    resultado: Optional[TareaResponse] = Field(None, description="Análisis (si se completó)")
+    error: Optional[str] = Field(None, description="Error (si falló)")
+    consulta_id: Optional[int] = Field(None, description="Consulta guardada en el historial")
+    intentos: int = Field(0, description="Intentos de procesamiento")
+    created_at: Optional[str] = Field(None, description="Fecha de envío")
+    started_at: Optional[str] = Field(None, description="Inicio del procesamiento")
+    finished_at: Optional[str] = Field(None, description="Fin del procesamiento")
+class UsoDiaItem(BaseModel):
+    fecha: str = Field(..., description="Día (UTC)")
+    input_tokens: int = Field(..., description="Tokens de entrada enviados a la IA")
+    output_tokens: int = Field(..., description="Tokens generados por la IA")
+    total_tokens: int = Field(..., description="Entrada + salida")
+    llamadas: int = Field(..., description="Análisis que llamaron a la IA")
+    costo_usd: float = Field(..., description="Costo estimado con los precios configurados")
+class UsoResponse(BaseModel):
+    limite_diario: Optional[int] = Field(None, description="Tokens por día (null = sin límite)")
+    usado_hoy: int = Field(..., description="Tokens consumidos hoy")
+    restante_hoy: Optional[int] = Field(None, description="Tokens disponibles hasta el reinicio")
+    reinicio: str = Field(..., description="Próximo reinicio de la cuota (medianoche UTC)")
+    costo_hoy_usd: float = Field(..., description="Costo estimado de hoy")
+    dias: List[UsoDiaItem] = Field(..., description="Uso por día, del más reciente al más antiguo")
 class ErrorResponse(BaseModel):
     error: str = Field(..., description="Mensaje de error")
     detail: Optional[str] = Field(None, description="Detalles adicionales del error")
@@ -81,6 +154,7 @@ class ErrorResponse(BaseModel):
 class HealthResponse(BaseModel):
     status: str = Field(..., description="Estado del servicio")
     ai_service: str = Field(..., description="Estado del servicio de IA")
+    circuit_breaker: Optional[str] = Field(None, description="Estado del circuito hacia Gemini")
     version: str = Field(..., description="Versión de la API")
     uptime: Optional[float] = Field(None, description="Tiempo activo en segundos")
     class Config:
@@ -88,6 +162,7 @@ class HealthResponse(BaseModel):
             "example": {
                 "status": "healthy",
                 "ai_service": "ready",
+                "circuit_breaker": "closed",
                 "version": "1.0.0",
                 "uptime": 3600.5
             }
@@ -4,7 +4,7 @@ from sqlalchemy.orm import Session
 import os
 from typing import Optional
 from database import Usuario
-from auth import create_access_token, get_password_hash
+from auth import create_access_token, get_password_hash_async
 from datetime import timedelta
 # Configuración OAuth
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
@@ -76,7 +76,7 @@ async def google_callback(request: Request, db: Session):
                 username=username,
                 email=email,
                 nombre_completo=name,
-                password_hash=get_password_hash(google_id),  # Hash del Google ID como password
+                hashed_password=await get_password_hash_async(google_id),  # Hash del Google ID como password
                 is_active=True,
                 oauth_provider="google",
                 oauth_id=google_id
@@ -86,7 +86,7 @@ async def google_callback(request: Request, db: Session):
             db.refresh(usuario)
         # Crear token JWT
         access_token = create_access_token(
-            data={"sub": usuario.username, "user_id": usuario.id},
+            data={"sub": str(usuario.id)},
             expires_delta=timedelta(days=7)
         )
         return {
@@ -102,6 +102,8 @@ async def google_callback(request: Request, db: Session):
                 "created_at": usuario.created_at.isoformat()
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -0,0 +1,170 @@
+import asyncio
+import cProfile
+import marshal
+import pstats
+from collections import defaultdict, deque
+from datetime import datetime
+from random import random
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Optional
+from fastapi import HTTPException, Request
+from fastapi.security import HTTPAuthorizationCredentials
+from starlette.middleware.base import BaseHTTPMiddleware
+import logging
+from auth import get_current_user, get_current_admin
+from database import SessionLocal
+logger = logging.getLogger(__name__)
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+MAX_STACK_DEPTH = 64
+class ProfileStore:
+    def __init__(self, max_profiles: int = 20):
+        self._profiles = deque(maxlen=max_profiles)  # Ring buffer: descarta los más viejos
+        self._lock = Lock()
+        self._next_id = 1
+    def add(self, method: str, path: str, status_code: int,
+            duration_ms: float, stats: Dict) -> int:
+        with self._lock:
+            profile_id = self._next_id
+            self._next_id += 1
+            self._profiles.append({
+                "id": profile_id,
+                "method": method,
+                "path": path,
+                "status_code": status_code,
+                "duration_ms": round(duration_ms, 2),
+                "created_at": datetime.now().isoformat(),
+                "stats": stats
+            })
+        return profile_id
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {key: value for key, value in profile.items() if key != "stats"}
+                for profile in reversed(self._profiles)
+            ]
+    def get(self, profile_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for profile in self._profiles:
+                if profile["id"] == profile_id:
+                    return profile
+        return None
+    def size(self) -> int:
+        return len(self._profiles)
+def to_pstats_bytes(stats: Dict) -> bytes:
+    # Mismo formato que pstats.Stats.dump_stats (cargable con pstats.Stats(path))
+    return marshal.dumps(stats)
+def to_speedscope(stats: Dict, name: str) -> Dict[str, Any]:
+    # cProfile solo guarda aristas caller->callee; se reconstruyen stacks
+    # aproximados repartiendo el tiempo de cada función según sus callers
+    frames: List[Dict[str, Any]] = []
+    frame_index: Dict[tuple, int] = {}
+    def frame_id(func: tuple) -> int:
+        if func not in frame_index:
+            filename, line, funcname = func
+            frame_index[func] = len(frames)
+            frames.append({"name": funcname, "file": filename, "line": line})
+        return frame_index[func]
+    callees: Dict[tuple, Dict[tuple, float]] = defaultdict(dict)
+    roots = []
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    total = sum(entry[2] for entry in stats.values())
+    min_weight = total * 0.001  # Ignorar ramas de <0.1% para acotar el tamaño
+    samples: List[List[int]] = []
+    weights: List[float] = []
+    def walk(func: tuple, stack: List[int], inclusive: float):
+        _, _, own_time, cumulative, _ = stats[func]
+        scale = inclusive / cumulative if cumulative > 0 else 0.0
+        stack = stack + [frame_id(func)]
+        self_time = own_time * scale
+        if self_time > 0:
+            samples.append(stack)
+            weights.append(self_time)
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, {}).items():
+            weight = edge_time * scale
+            if weight < min_weight or frame_id(callee) in stack:
+                continue  # Rama despreciable o recursión
+            walk(callee, stack, weight)
+    for root in roots:
+        walk(root, [], stats[root][3])
+    return {
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "name": name,
+        "exporter": "demystify-api",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights
+        }]
+    }
+class ProfilingMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, store: ProfileStore, sample_rate: float = 0.0,
+                 header: str = "X-Profile"):
+        super().__init__(app)
+        self.store = store
+        self.sample_rate = sample_rate
+        self.header = header
+        self._active = Lock()  # cProfile admite un solo profiler activo por hilo
+    async def _is_admin_request(self, request: Request) -> bool:
+        authorization = request.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return False
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer",
+            credentials=authorization[len("Bearer "):]
+        )
+        # get_current_user puede consultar la BD: fuera del event loop
+        return await asyncio.to_thread(self._verificar_admin, credentials)
+    @staticmethod
+    def _verificar_admin(credentials: HTTPAuthorizationCredentials) -> bool:
+        db = SessionLocal()
+        try:
+            get_current_admin(get_current_user(credentials, db))
+            return True
+        except HTTPException:
+            return False
+        finally:
+            db.close()
+    async def _should_profile(self, request: Request) -> bool:
+        if self.sample_rate > 0 and random() < self.sample_rate:
+            return True
+        if request.headers.get(self.header):
+            return await self._is_admin_request(request)
+        return False
+    async def dispatch(self, request: Request, call_next):
+        if not await self._should_profile(request) or not self._active.acquire(blocking=False):
+            return await call_next(request)
+        # Perfila el hilo del event loop: incluye otras corrutinas intercaladas,
+        # no el trabajo enviado a threads (asyncio.to_thread)
+        profiler = cProfile.Profile()
+        start_time = time()
+        try:
+            profiler.enable()
+            try:
+                response = await call_next(request)
+            finally:
+                profiler.disable()
+        finally:
+            self._active.release()
+        duration_ms = (time() - start_time) * 1000
+        profile_id = self.store.add(
+            method=request.method,
+            path=request.url.path,
+            status_code=response.status_code,
+            duration_ms=duration_ms,
+            stats=pstats.Stats(profiler).stats
+        )
+        logger.info(f"Perfil #{profile_id} capturado para {request.method} {request.url.path}")
+        response.headers["X-Profile-Id"] = str(profile_id)
+        return response
@@ -14,7 +14,9 @@ RATE_LIMITS = {
 }
 def get_rate_limit(endpoint: str) -> str:
     return RATE_LIMITS.get(endpoint, RATE_LIMITS["api_general"])
-def setup_rate_limiting(app):
+def setup_rate_limiting(app, enabled: bool = True):
+    # enabled=False desactiva los @limiter.limit por endpoint (p.ej. pruebas de carga)
+    limiter.enabled = enabled
     app.state.limiter = limiter
     app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
     return limiter
\ No newline at end of file
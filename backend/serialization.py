@@ -0,0 +1,35 @@
+import json
+from typing import Any
+from fastapi.responses import JSONResponse
+try:
+    import orjson
+    JSON_BACKEND = "orjson"
+except ImportError:  # Opcional: se usa json de la stdlib
+    orjson = None
+    JSON_BACKEND = "json"
+def _default(obj: Any) -> Any:
+    # Mismo criterio en ambos backends para tipos no nativos (Decimal, etc.)
+    return str(obj)
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+    def dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode("utf-8")
+    def loads(data: Any) -> Any:
+        return orjson.loads(data)
+else:
+    def dumps_bytes(obj: Any) -> bytes:
+        return json.dumps(
+            obj,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=_default
+        ).encode("utf-8")
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default)
+    def loads(data: Any) -> Any:
+        return json.loads(data)
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
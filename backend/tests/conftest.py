@@ -0,0 +1,7 @@
+import os
+import sys
+# Los módulos del backend se importan por nombre (como en main.py) y `shared`
+# desde la raíz del repositorio
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(BACKEND_DIR))
@@ -0,0 +1,67 @@
+import pytest
+import shared.resilience as resilience
+from shared.resilience import (
+    CIRCUITO_ABIERTO, CIRCUITO_CERRADO, CIRCUITO_SEMIABIERTO, CircuitBreaker
+)
+@pytest.fixture
+def reloj(monkeypatch):
+    ahora = [1000.0]
+    monkeypatch.setattr(resilience, "monotonic", lambda: ahora[0])
+    return ahora
+def _breaker() -> CircuitBreaker:
+    return CircuitBreaker(failure_rate=0.5, slow_call_seconds=5.0, window=10,
+                          min_calls=4, open_seconds=30.0, half_open_calls=2)
+def _llamar(breaker: CircuitBreaker, success: bool, duration: float = 0.1) -> bool:
+    if not breaker.allow():
+        return False
+    breaker.record(success, duration)
+    return True
+def test_no_abre_antes_de_min_calls(reloj):
+    breaker = _breaker()
+    for _ in range(3):
+        _llamar(breaker, False)
+    assert breaker.state == CIRCUITO_CERRADO
+def test_abre_con_tasa_de_fallos_y_rechaza(reloj):
+    breaker = _breaker()
+    for exito in (True, False, True, False):
+        _llamar(breaker, exito)
+    assert breaker.state == CIRCUITO_ABIERTO
+    assert breaker.is_open()
+    assert not _llamar(breaker, True)
+    assert breaker.rejected == 1 and breaker.opened == 1
+def test_llamadas_lentas_cuentan_como_fallo(reloj):
+    breaker = _breaker()
+    for _ in range(4):
+        _llamar(breaker, True, duration=6.0)
+    assert breaker.state == CIRCUITO_ABIERTO
+def test_semiabierto_cierra_si_las_sondas_salen_bien(reloj):
+    breaker = _breaker()
+    for _ in range(4):
+        _llamar(breaker, False)
+    reloj[0] += 30.0
+    assert breaker.state == CIRCUITO_SEMIABIERTO
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()  # Solo half_open_calls sondas a la vez
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == CIRCUITO_CERRADO
+    # La ventana arranca limpia: un fallo aislado no reabre
+    _llamar(breaker, False)
+    assert breaker.state == CIRCUITO_CERRADO
+def test_semiabierto_reabre_con_un_fallo(reloj):
+    breaker = _breaker()
+    for _ in range(4):
+        _llamar(breaker, False)
+    reloj[0] += 30.0
+    assert _llamar(breaker, False)
+    assert breaker.state == CIRCUITO_ABIERTO
+    assert breaker.opened == 2
+    reloj[0] += 29.0
+    assert breaker.is_open()
+def test_resultados_tardios_con_circuito_abierto_no_cambian_nada(reloj):
+    breaker = _breaker()
+    for _ in range(4):
+        _llamar(breaker, False)
+    breaker.record(True)  # Llamada iniciada antes de abrir
+    reloj[0] += 30.0
+    assert breaker.state == CIRCUITO_SEMIABIERTO
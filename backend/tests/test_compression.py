@@ -0,0 +1,92 @@
+import asyncio
+import gzip
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from compression import CompressionMiddleware, CompressionStats, parse_accept_encoding
+GRANDE = {"items": ["texto repetido " * 10] * 50}
+async def _pequeno(request):
+    return JSONResponse({"ok": True})
+async def _grande(request):
+    return JSONResponse(GRANDE)
+async def _stream(request):
+    async def partes():
+        for i in range(5):
+            yield ("linea %d " % i) * 400
+    return StreamingResponse(partes(), media_type="text/plain")
+async def _sse(request):
+    async def eventos():
+        yield "data: hola\n\n"
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+class _Pasante(BaseHTTPMiddleware):
+    # Como los middlewares de main.py: reenvía el cuerpo + un mensaje final vacío
+    async def dispatch(self, request, call_next):
+        return await call_next(request)
+def _cliente(stats: CompressionStats, encodings=("gzip",)) -> TestClient:
+    app = Starlette(
+        routes=[Route("/pequeno", _pequeno), Route("/grande", _grande),
+                Route("/stream", _stream), Route("/sse", _sse)],
+        middleware=[
+            Middleware(CompressionMiddleware, minimum_size=500, encodings=encodings, stats=stats),
+            Middleware(_Pasante),
+            Middleware(_Pasante)
+        ]
+    )
+    return TestClient(app)
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip, br;q=0.8, *;q=0") == {"gzip": 1.0, "br": 0.8, "*": 0.0}
+    assert parse_accept_encoding("gzip;q=x") == {"gzip": 0.0}
+def test_cuerpo_pequeno_detras_de_base_http_middleware_no_se_comprime():
+    stats = CompressionStats()
+    respuesta = _cliente(stats).get("/pequeno", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in respuesta.headers
+    assert respuesta.headers["content-length"] == str(len(respuesta.content))
+    assert respuesta.json() == {"ok": True}
+    assert stats.skipped_small == 1
+    assert stats.por_encoding == {}
+def test_cuerpo_completo_detras_de_base_http_middleware_lleva_content_length():
+    stats = CompressionStats()
+    respuesta = _cliente(stats).get("/grande", headers={"Accept-Encoding": "gzip"})
+    assert respuesta.headers["content-encoding"] == "gzip"
+    assert respuesta.headers["vary"] == "Accept-Encoding"
+    assert int(respuesta.headers["content-length"]) < len(respuesta.content)
+    assert respuesta.json() == GRANDE
+    gzip_stats = stats.por_encoding["gzip"]
+    assert gzip_stats["responses"] == 1 and gzip_stats["streamed"] == 0
+def test_streaming_se_comprime_por_chunk():
+    stats = CompressionStats()
+    respuesta = _cliente(stats).get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert respuesta.headers["content-encoding"] == "gzip"
+    assert "content-length" not in respuesta.headers
+    assert respuesta.text == "".join(("linea %d " % i) * 400 for i in range(5))
+    assert stats.por_encoding["gzip"]["streamed"] == 1
+def test_sse_y_sin_accept_encoding_pasan_sin_tocar():
+    stats = CompressionStats()
+    cliente = _cliente(stats)
+    assert "content-encoding" not in cliente.get("/sse", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in cliente.get("/grande", headers={"Accept-Encoding": "identity"}).headers
+    assert stats.skipped_type == 1
+def test_q_cero_excluye_encoding():
+    stats = CompressionStats()
+    respuesta = _cliente(stats).get("/grande", headers={"Accept-Encoding": "gzip;q=0, *;q=0"})
+    assert "content-encoding" not in respuesta.headers
+def test_etag_fuerte_pasa_a_debil():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"application/json"), (b"etag", b'"abc"')
+        ]})
+        await send({"type": "http.response.body", "body": b"x" * 2000})
+    enviados = []
+    async def send(message):
+        enviados.append(message)
+    async def receive():
+        return {"type": "http.request", "body": b""}
+    middleware = CompressionMiddleware(app, minimum_size=500, encodings=("gzip",))
+    scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(middleware(scope, receive, send))
+    headers = dict(enviados[0]["headers"])
+    assert headers[b"etag"] == b'W/"abc"'
+    assert gzip.decompress(enviados[1]["body"]) == b"x" * 2000
@@ -0,0 +1,198 @@
+import asyncio
+import random
+import pytest
+from fastapi import HTTPException
+import concurrency
+from concurrency import AdaptiveConcurrencyLimiter, FairQueue, is_overload_error
+@pytest.fixture
+def reloj(monkeypatch):
+    # Tiempo controlado: las bajas del límite están espaciadas por "ronda"
+    ahora = [1000.0]
+    monkeypatch.setattr(concurrency, "monotonic", lambda: ahora[0])
+    return ahora
+def _llamar(limiter: AdaptiveConcurrencyLimiter, latencia: float, overloaded: bool = False):
+    # Una llamada completa con `in_flight` alto, como bajo carga
+    limiter.in_flight += 1
+    limiter.release(latencia, overloaded=overloaded)
+def test_crece_aditivamente_con_exitos(reloj):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=6)
+    limiter.in_flight = 3
+    for _ in range(40):
+        _llamar(limiter, 0.2)
+    assert limiter.limit == 6.0
+    assert limiter.decreases == 0
+def test_no_crece_si_no_se_usa(reloj):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+    for _ in range(40):
+        _llamar(limiter, 0.2)  # in_flight 1 de 8
+    assert limiter.limit == 8.0
+def test_sobrecarga_reduce_multiplicativamente(reloj):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=10, backoff=0.5)
+    _llamar(limiter, 0.2, overloaded=True)
+    assert limiter.limit == 5.0
+    # Fallos simultáneos cuentan una vez por ronda
+    _llamar(limiter, 0.2, overloaded=True)
+    assert limiter.limit == 5.0
+    reloj[0] += 2.0
+    _llamar(limiter, 0.2, overloaded=True)
+    assert limiter.limit == 2.5
+def test_ruido_de_latencia_sano_no_reduce(reloj):
+    rng = random.Random(7)
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=8)
+    limiter.in_flight = 6
+    for _ in range(2000):
+        reloj[0] += 0.05
+        _llamar(limiter, rng.lognormvariate(-1.6, 0.5))
+    assert limiter.decreases == 0
+def test_suba_sostenida_de_latencia_reduce_y_se_recupera(reloj):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=8, latency_tolerance=2.0)
+    limiter.in_flight = 6
+    for _ in range(300):
+        reloj[0] += 0.05
+        _llamar(limiter, 0.2)
+    for _ in range(30):
+        reloj[0] += 0.05
+        _llamar(limiter, 0.6)
+    assert limiter.decreases >= 1
+    assert limiter.limit < 8.0
+    for _ in range(300):
+        reloj[0] += 0.05
+        _llamar(limiter, 0.2)
+    assert limiter.limit == 8.0
+def test_pocas_muestras_no_juzgan_latencia(reloj):
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+    _llamar(limiter, 0.01)
+    for _ in range(concurrency.MIN_MUESTRAS_LATENCIA - 2):
+        _llamar(limiter, 5.0)
+    assert limiter.decreases == 0
+def test_cola_llena_responde_503_con_retry_after():
+    async def escenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_queue=1)
+        await limiter.acquire()
+        esperando = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            await limiter.acquire()
+        assert error.value.status_code == 503
+        assert int(error.value.headers["Retry-After"]) >= 1
+        limiter.release(0.1)
+        assert await esperando >= 0.0
+        assert limiter.in_flight == 1 and limiter.rejected == 1
+    asyncio.run(escenario())
+def test_plazo_de_espera_vencido():
+    async def escenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, queue_timeout=0.05)
+        await limiter.acquire()
+        with pytest.raises(HTTPException):
+            await limiter.acquire()
+        assert limiter.queue_timeouts == 1
+        assert len(limiter._waiters) == 0
+        limiter.release(0.1)
+        assert limiter.in_flight == 0
+    asyncio.run(escenario())
+def test_cancelar_en_cola_no_pierde_lugares():
+    async def escenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+        await limiter.acquire()
+        esperando = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        esperando.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await esperando
+        limiter.release(0.1)
+        assert limiter.in_flight == 0
+        assert await limiter.acquire() == 0.0
+    asyncio.run(escenario())
+def _cola(pedidos):
+    # pedidos: [(usuario, peso), ...] en orden de llegada; devuelve el orden de atención
+    loop = asyncio.new_event_loop()
+    try:
+        cola = FairQueue()
+        nombres = {}
+        for i, (usuario, peso) in enumerate(pedidos):
+            waiter = loop.create_future()
+            nombres[waiter] = (usuario, i)
+            cola.push(usuario, waiter, peso)
+        orden = []
+        while len(cola):
+            orden.append(nombres[cola.pop()])
+        return orden
+    finally:
+        loop.close()
+def test_fair_queue_alterna_entre_usuarios():
+    # "a" encola 4 antes de que llegue "b": igual se alternan
+    orden = _cola([("a", 1)] * 4 + [("b", 1)] * 2)
+    assert [usuario for usuario, _ in orden] == ["a", "b", "a", "b", "a", "a"]
+    # Dentro de un usuario se respeta el orden de llegada
+    assert [i for usuario, i in orden if usuario == "a"] == [0, 1, 2, 3]
+def test_fair_queue_respeta_pesos():
+    orden = _cola([("normal", 1)] * 8 + [("prioridad", 4)] * 8)
+    primeros = [usuario for usuario, _ in orden[:10]]
+    assert primeros.count("prioridad") == 8
+    assert primeros.count("normal") == 2
+def test_fair_queue_flujo_vacio_no_acumula_deficit():
+    loop = asyncio.new_event_loop()
+    try:
+        cola = FairQueue()
+        for _ in range(3):
+            cola.push("a", loop.create_future())
+            cola.pop()
+        assert cola.flows() == 0
+        b = loop.create_future()
+        cola.push("b", b)
+        a = loop.create_future()
+        cola.push("a", a)
+        assert cola.pop() is b
+    finally:
+        loop.close()
+def test_fair_queue_remove():
+    loop = asyncio.new_event_loop()
+    try:
+        cola = FairQueue()
+        a1, a2 = loop.create_future(), loop.create_future()
+        cola.push("a", a1)
+        cola.push("a", a2)
+        cola.remove("a", a1)
+        cola.remove("a", a1)  # Idempotente
+        assert len(cola) == 1 and cola.queued("a") == 1
+        cola.remove("a", a2)
+        assert len(cola) == 0 and cola.flows() == 0
+        assert cola.pop() is None
+    finally:
+        loop.close()
+def test_limiter_atiende_en_orden_justo():
+    async def escenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_queue_per_key=5)
+        await limiter.acquire()
+        atendidos = []
+        async def pedido(usuario):
+            await limiter.acquire(key=usuario)
+            atendidos.append(usuario)
+            limiter.release(0.01)
+        tareas = [asyncio.create_task(pedido("a")) for _ in range(4)]
+        tareas += [asyncio.create_task(pedido("b")) for _ in range(2)]
+        await asyncio.sleep(0)
+        limiter.release(0.01)
+        await asyncio.gather(*tareas)
+        assert atendidos == ["a", "b", "a", "b", "a", "a"]
+    asyncio.run(escenario())
+def test_cola_por_usuario_llena():
+    async def escenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_queue_per_key=2)
+        await limiter.acquire()
+        tareas = [asyncio.create_task(limiter.acquire(key="a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException):
+            limiter.check_admission("a")
+        with pytest.raises(HTTPException):
+            await limiter.acquire(key="a")
+        limiter.check_admission("b")  # Otro usuario todavía entra en cola
+        for _ in range(3):
+            limiter.release(0.01)
+        await asyncio.gather(*tareas)
+    asyncio.run(escenario())
+def test_is_overload_error():
+    assert is_overload_error("429 Resource has been exhausted")
+    assert is_overload_error("The model is overloaded")
+    assert not is_overload_error("Invalid API key")
+    assert not is_overload_error(None)
@@ -0,0 +1,70 @@
+import pytest
+import shared.ai_service as ai_service
+from shared.ai_service import AIService, FakeBackend, FakeBackendError
+from shared.resilience import RetryBudget, is_transient_error
+class _TimerManual:
+    # Timer que no dispara solo: el test decide cuándo, y cancel() no lo frena
+    # (como un threading.Timer que ya disparó)
+    creados = []
+    def __init__(self, delay, funcion):
+        self.funcion = funcion
+        self.daemon = False
+        _TimerManual.creados.append(self)
+    def start(self):
+        pass
+    def cancel(self):
+        pass
+@pytest.fixture
+def servicio(monkeypatch):
+    _TimerManual.creados.clear()
+    monkeypatch.setattr(ai_service, "Timer", _TimerManual)
+    servicio = AIService(backend=FakeBackend(latency_median_ms=1, seed=1),
+                         retry_budget=RetryBudget(min_retries=100))
+    monkeypatch.setattr(servicio, "_hedge_delay", lambda: 0.01)
+    yield servicio
+    servicio._hedge_pool.shutdown(wait=True)
+def test_timer_que_dispara_tras_fallo_del_primario_no_lanza_hedge(servicio, monkeypatch):
+    def falla(prompt):
+        raise FakeBackendError("503 Service Unavailable (fake backend)")
+    monkeypatch.setattr(servicio, "_procesar_con_gemini", falla)
+    with pytest.raises(FakeBackendError):
+        servicio._procesar_con_hedge(servicio.prompts.build("texto"))
+    _TimerManual.creados[0].funcion()  # El timer dispara tarde
+    assert servicio.stats["hedges"] == 0
+def test_timer_que_dispara_tras_exito_del_primario_no_lanza_hedge(servicio, monkeypatch):
+    monkeypatch.setattr(servicio, "_procesar_con_gemini", lambda prompt: {"pasos": ["a"]})
+    assert servicio._procesar_con_hedge(servicio.prompts.build("texto")) == {"pasos": ["a"]}
+    _TimerManual.creados[0].funcion()
+    assert servicio.stats["hedges"] == 0
+def test_hedge_en_curso_rescata_fallo_del_primario(servicio, monkeypatch):
+    llamadas = []
+    def gemini(prompt):
+        llamadas.append(prompt)
+        if len(llamadas) == 1:
+            _TimerManual.creados[0].funcion()  # El hedge sale mientras el primario corre
+            raise FakeBackendError("503 Service Unavailable (fake backend)")
+        return {"pasos": ["hedge"]}
+    monkeypatch.setattr(servicio, "_procesar_con_gemini", gemini)
+    assert servicio._procesar_con_hedge(servicio.prompts.build("texto")) == {"pasos": ["hedge"]}
+    assert servicio.stats["hedges"] == 1
+class _ErrorConCodigo(Exception):
+    def __init__(self, mensaje, code):
+        super().__init__(mensaje)
+        self.code = code
+class _Respuesta:
+    status_code = 502
+class _ErrorHTTP(Exception):
+    response = _Respuesta()
+@pytest.mark.parametrize("error, transitorio", [
+    (FakeBackendError("503 Service Unavailable"), True),
+    (_ErrorConCodigo("Resource exhausted", 429), True),
+    (_ErrorHTTP("Bad gateway"), True),
+    (TimeoutError("read timed out"), True),
+    (ConnectionError("reset"), True),
+    # El texto no decide: un 400 que menciona "500" o "timeout" no se reintenta
+    (_ErrorConCodigo("max_output_tokens must be <= 500", 400), False),
+    (ValueError("timeout must be positive, got 500"), False),
+    (ValueError("Invalid API key"), False),
+])
+def test_is_transient_error_por_tipo_o_status(error, transitorio):
+    assert is_transient_error(error) is transitorio
@@ -0,0 +1,110 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+import idempotency
+from idempotency import IdempotencyStore, MAX_KEY_LENGTH
+def _contador():
+    llamadas = []
+    async def compute():
+        llamadas.append(1)
+        await asyncio.sleep(0.01)
+        return {"n": len(llamadas)}
+    return llamadas, compute
+def test_reintento_recibe_la_respuesta_original():
+    async def escenario():
+        store = IdempotencyStore()
+        llamadas, compute = _contador()
+        huella = IdempotencyStore.fingerprint("texto")
+        assert await store.run(1, "k", huella, compute) == ({"n": 1}, False)
+        assert await store.run(1, "k", huella, compute) == ({"n": 1}, True)
+        assert len(llamadas) == 1 and store.replayed == 1
+    asyncio.run(escenario())
+def test_reintentos_concurrentes_comparten_el_computo():
+    async def escenario():
+        store = IdempotencyStore()
+        llamadas, compute = _contador()
+        huella = IdempotencyStore.fingerprint("texto")
+        resultados = await asyncio.gather(*(store.run(1, "k", huella, compute) for _ in range(5)))
+        assert len(llamadas) == 1
+        assert sorted(replayed for _, replayed in resultados) == [False, True, True, True, True]
+        assert store.attached == 4
+    asyncio.run(escenario())
+def test_clave_por_usuario():
+    async def escenario():
+        store = IdempotencyStore()
+        llamadas, compute = _contador()
+        huella = IdempotencyStore.fingerprint("texto")
+        await store.run(1, "k", huella, compute)
+        assert (await store.run(2, "k", huella, compute))[1] is False
+        assert len(llamadas) == 2
+    asyncio.run(escenario())
+def test_misma_clave_con_otro_cuerpo_es_conflicto():
+    async def escenario():
+        store = IdempotencyStore()
+        _, compute = _contador()
+        await store.run(1, "k", IdempotencyStore.fingerprint("a"), compute)
+        with pytest.raises(HTTPException) as error:
+            await store.run(1, "k", IdempotencyStore.fingerprint("b"), compute)
+        assert error.value.status_code == 422
+    asyncio.run(escenario())
+def test_errores_no_se_guardan():
+    async def escenario():
+        store = IdempotencyStore()
+        intentos = []
+        async def compute():
+            intentos.append(1)
+            if len(intentos) == 1:
+                raise HTTPException(status_code=503, detail="saturado")
+            return {"ok": True}
+        huella = IdempotencyStore.fingerprint("texto")
+        with pytest.raises(HTTPException):
+            await store.run(1, "k", huella, compute)
+        assert await store.run(1, "k", huella, compute) == ({"ok": True}, False)
+    asyncio.run(escenario())
+def test_cliente_cancelado_no_corta_el_computo():
+    async def escenario():
+        store = IdempotencyStore()
+        llamadas, compute = _contador()
+        huella = IdempotencyStore.fingerprint("texto")
+        primero = asyncio.create_task(store.run(1, "k", huella, compute))
+        await asyncio.sleep(0)
+        primero.cancel()
+        assert await store.run(1, "k", huella, compute) == ({"n": 1}, True)
+        assert len(llamadas) == 1
+    asyncio.run(escenario())
+def test_expira_tras_ttl(monkeypatch):
+    async def escenario():
+        ahora = [1000.0]
+        monkeypatch.setattr(idempotency, "time", lambda: ahora[0])
+        store = IdempotencyStore(ttl=60)
+        llamadas, compute = _contador()
+        huella = IdempotencyStore.fingerprint("texto")
+        await store.run(1, "k", huella, compute)
+        ahora[0] += 61
+        assert (await store.run(1, "k", huella, compute))[1] is False
+        assert len(llamadas) == 2
+    asyncio.run(escenario())
+def test_desalojo_prefiere_completadas():
+    async def escenario():
+        store = IdempotencyStore(max_entries=2)
+        _, compute = _contador()
+        bloqueo = asyncio.Event()
+        async def lento():
+            await bloqueo.wait()
+            return {"lento": True}
+        en_curso = asyncio.create_task(store.run(1, "lento", "h", lento))
+        await asyncio.sleep(0)
+        await store.run(1, "a", "h", compute)
+        await store.run(1, "b", "h", compute)
+        assert store.get_stats()["size"] == 2
+        assert store.get_stats()["in_flight"] == 1
+        bloqueo.set()
+        assert await en_curso == ({"lento": True}, False)
+    asyncio.run(escenario())
+@pytest.mark.parametrize("clave", ["", "   ", "x" * (MAX_KEY_LENGTH + 1)])
+def test_validate_key_rechaza_claves_invalidas(clave):
+    with pytest.raises(HTTPException) as error:
+        IdempotencyStore.validate_key(clave)
+    assert error.value.status_code == 400
+def test_validate_key_recorta_espacios():
+    assert IdempotencyStore.validate_key("  abc  ") == "abc"
@@ -0,0 +1,32 @@
+import random
+import pytest
+from pydantic import ValidationError
+from benchmarks.bench_validacion import (
+    ALFABETO, SEED, _caso, _resultado, _sanitizar_referencia, _validar_referencia
+)
+from models import TareaRequest, sanitizar_texto
+# Equivalencia de sanitizar_texto/validar_texto con la implementación original
+# (carácter por carácter) sobre entradas aleatorias con semilla fija
+@pytest.mark.parametrize("semilla", [SEED, SEED + 1, SEED + 2])
+def test_equivalencia_aleatoria(semilla):
+    rng = random.Random(semilla)
+    for _ in range(3000):
+        v = _caso(rng)
+        assert _resultado(sanitizar_texto, v) == _resultado(_sanitizar_referencia, v), repr(v)
+        assert _resultado(TareaRequest.validar_texto, v) == _resultado(_validar_referencia, v), repr(v)
+@pytest.mark.parametrize("v", ALFABETO + [
+    "".join(ALFABETO) * 3,
+    "&" * 20,
+    " \x1c\x1f " * 5 + "texto válido 123",
+    "\ufeff\u3000 texto con espacios unicode\u2028 ",
+    "línea 1\r\nlínea 2\tcon tab",
+])
+def test_equivalencia_casos_borde(v):
+    assert _resultado(sanitizar_texto, v) == _resultado(_sanitizar_referencia, v)
+    assert _resultado(TareaRequest.validar_texto, v) == _resultado(_validar_referencia, v)
+def test_modelo_sanitiza_y_escapa():
+    tarea = TareaRequest(texto="  Revisar <b>precios</b> & \"descuentos\"\x07  ")
+    assert tarea.texto == "Revisar &lt;b&gt;precios&lt;/b&gt; &amp; &quot;descuentos&quot;"
+def test_modelo_rechaza_texto_sin_alfanumericos():
+    with pytest.raises(ValidationError, match="alfanuméricos"):
+        TareaRequest(texto="¿¡!? .,;: ¿¡!?")
@@ -0,0 +1,166 @@
+import secrets
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from time import time_ns
+from typing import Any, Dict, List, Optional
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+import logging
+from serialization import dumps
+logger = logging.getLogger(__name__)
+# Códigos OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind",
+                 "start_ns", "end_ns", "attributes", "error")
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str] = None,
+                 kind: int = SPAN_KIND_INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+        trace.spans.append(self)
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+    def finish(self):
+        if self.end_ns is None:
+            self.end_ns = time_ns()
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else time_ns()
+        return (end - self.start_ns) / 1e6
+class Trace:
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List[Span] = []  # list.append es atómico: seguro desde threads
+        self.root = Span(self, name, kind=SPAN_KIND_SERVER, attributes=attributes)
+    def server_timing(self) -> str:
+        # Suma por nombre de span (un span puede repetirse, p.ej. reintentos)
+        totals: Dict[str, float] = {}
+        for s in self.spans:
+            if s is not self.root:
+                totals[s.name] = totals.get(s.name, 0.0) + s.duration_ms
+        metrics = [f"{name};dur={duration:.1f}" for name, duration in totals.items()]
+        metrics.append(f"total;dur={self.root.duration_ms:.1f}")
+        return ", ".join(metrics)
+    def to_otlp(self, service_name: str) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "demystify.tracing"},
+                    "spans": [_otlp_span(self.trace_id, s) for s in self.spans]
+                }]
+            }]
+        }
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+def _otlp_span(trace_id: str, s: Span) -> Dict[str, Any]:
+    data = {
+        "traceId": trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns or s.start_ns),
+        "attributes": _otlp_attributes(s.attributes),
+        "status": (
+            {"code": STATUS_ERROR, "message": s.error}
+            if s.error else {"code": STATUS_UNSET}
+        )
+    }
+    if s.parent_id:
+        data["parentSpanId"] = s.parent_id
+    return data
+@contextmanager
+def span(name: str, **attributes):
+    parent = _current_span.get()
+    if parent is None:
+        # Sin trace activo (tracing deshabilitado o fuera de un request): no-op
+        yield None
+        return
+    current = Span(parent.trace, name, parent_id=parent.span_id, attributes=attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.finish()
+        _current_span.reset(token)
+def current_trace() -> Optional[Trace]:
+    current = _current_span.get()
+    return current.trace if current else None
+class TraceExporter:
+    # Escribe un trace OTLP/JSON por línea desde un hilo propio
+    def __init__(self, path: str, service_name: str, min_duration_ms: float = 0.0,
+                 queue_size: int = 1000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.service_name = service_name
+        self.min_duration_ms = min_duration_ms
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+    def export(self, trace: Trace):
+        if trace.root.duration_ms < self.min_duration_ms:
+            return
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                line = dumps(trace.to_otlp(self.service_name))
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except Exception as e:
+                logger.warning(f"No se pudo exportar trace {trace.trace_id}: {e}")
+class TracingMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, exporter: Optional[TraceExporter] = None):
+        super().__init__(app)
+        self.exporter = exporter
+    async def dispatch(self, request: Request, call_next):
+        trace = Trace(
+            f"{request.method} {request.url.path}",
+            attributes={"http.method": request.method, "http.target": request.url.path}
+        )
+        token = _current_span.set(trace.root)
+        try:
+            response = await call_next(request)
+            trace.root.set_attribute("http.status_code", response.status_code)
+        except BaseException as e:
+            trace.root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            trace.root.finish()
+            _current_span.reset(token)
+            if self.exporter:
+                self.exporter.export(trace)
+        response.headers["Server-Timing"] = trace.server_timing()
+        response.headers["X-Trace-Id"] = trace.trace_id
+        return response
@@ -0,0 +1,225 @@
+import asyncio
+from datetime import date, datetime, timedelta
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException, status
+import logging
+from database import SessionLocal, UsoTokensDiario
+logger = logging.getLogger(__name__)
+QUOTA_RESET_HEADER = "X-Quota-Reset"
+Clave = Tuple[int, date]  # (usuario_id, día UTC)
+def _hoy() -> date:
+    return datetime.utcnow().date()
+class TokenMeter:
+    # Tokens de Gemini por usuario y día (UTC). Cada llamada suma en memoria y
+    # un loop vuelca los pendientes cada `flush_interval` segundos (o antes si
+    # hay `max_pending` claves) con UPDATE x = x + delta, así varios procesos
+    # comparten la tabla sin pisarse. La cuota diaria se verifica antes de
+    # llamar a la IA contra el total en BD (releído cada `refresh_seconds`)
+    # más lo pendiente en este proceso.
+    def __init__(self, session_factory=SessionLocal, daily_limit: int = 0,
+                 flush_interval: float = 5.0, max_pending: int = 500,
+                 refresh_seconds: float = 30.0, price_input_per_million: float = 0.0,
+                 price_output_per_million: float = 0.0):
+        self.session_factory = session_factory
+        self.daily_limit = daily_limit  # Tokens (entrada + salida); 0 = sin límite
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.refresh_seconds = refresh_seconds
+        self.price_input_per_million = price_input_per_million
+        self.price_output_per_million = price_output_per_million
+        self._lock = Lock()  # flush() corre en un thread
+        self._pendientes: Dict[Clave, List[int]] = {}  # [entrada, salida, llamadas]
+        self._volcando: Dict[Clave, List[int]] = {}
+        self._base: Dict[Clave, Tuple[int, float]] = {}  # Total en BD y cuándo se leyó
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.flushes = 0
+        self.flush_errors = 0
+        self.rejected = 0
+    def record(self, user_id: int, input_tokens: int = 0, output_tokens: int = 0):
+        if not input_tokens and not output_tokens:
+            return
+        clave = (user_id, _hoy())
+        with self._lock:
+            pendiente = self._pendientes.setdefault(clave, [0, 0, 0])
+            pendiente[0] += input_tokens
+            pendiente[1] += output_tokens
+            pendiente[2] += 1
+            lleno = len(self._pendientes) >= self.max_pending
+        if lleno:
+            self._wakeup.set()
+    def _local(self, clave: Clave) -> int:
+        total = 0
+        for deltas in (self._pendientes.get(clave), self._volcando.get(clave)):
+            if deltas:
+                total += deltas[0] + deltas[1]
+        return total
+    def _leer_bd(self, clave: Clave) -> int:
+        db = self.session_factory()
+        try:
+            fila = db.query(UsoTokensDiario).filter(
+                UsoTokensDiario.usuario_id == clave[0],
+                UsoTokensDiario.fecha == clave[1]
+            ).first()
+            total = (fila.input_tokens + fila.output_tokens) if fila else 0
+        finally:
+            db.close()
+        with self._lock:
+            self._base[clave] = (total, monotonic())
+        return total
+    async def used_today(self, user_id: int) -> int:
+        clave = (user_id, _hoy())
+        with self._lock:
+            base = self._base.get(clave)
+        if base is None or monotonic() - base[1] >= self.refresh_seconds:
+            await asyncio.to_thread(self._leer_bd, clave)
+        with self._lock:
+            return self._base.get(clave, (0, 0.0))[0] + self._local(clave)
+    async def check(self, user_id: int):
+        # Antes de cada llamada a la IA; 429 con la hora de reinicio si se agotó
+        if self.daily_limit <= 0:
+            return
+        usado = await self.used_today(user_id)
+        if usado < self.daily_limit:
+            return
+        self.rejected += 1
+        reinicio = self.reset_at()
+        segundos = max(1, int((reinicio - datetime.utcnow()).total_seconds()))
+        logger.warning(f"Cuota diaria de tokens agotada: usuario={user_id}, usado={usado}")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=(
+                f"Cuota diaria de tokens agotada ({usado}/{self.daily_limit}). "
+                f"Se renueva el {reinicio.isoformat()}Z."
+            ),
+            headers={"Retry-After": str(segundos), QUOTA_RESET_HEADER: f"{reinicio.isoformat()}Z"}
+        )
+    @staticmethod
+    def reset_at() -> datetime:
+        # Las cuotas se renuevan a medianoche UTC
+        return datetime.combine(_hoy() + timedelta(days=1), datetime.min.time())
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        return round(
+            input_tokens * self.price_input_per_million / 1_000_000
+            + output_tokens * self.price_output_per_million / 1_000_000,
+            6
+        )
+    def flush(self):
+        with self._lock:
+            if not self._pendientes or self._volcando:
+                return
+            self._volcando, self._pendientes = self._pendientes, {}
+            lote = dict(self._volcando)
+        db = self.session_factory()
+        try:
+            ahora = datetime.utcnow()
+            for (usuario_id, fecha), (entrada, salida, llamadas) in lote.items():
+                actualizadas = db.query(UsoTokensDiario).filter(
+                    UsoTokensDiario.usuario_id == usuario_id,
+                    UsoTokensDiario.fecha == fecha
+                ).update(
+                    {
+                        UsoTokensDiario.input_tokens: UsoTokensDiario.input_tokens + entrada,
+                        UsoTokensDiario.output_tokens: UsoTokensDiario.output_tokens + salida,
+                        UsoTokensDiario.llamadas: UsoTokensDiario.llamadas + llamadas,
+                        UsoTokensDiario.updated_at: ahora
+                    },
+                    synchronize_session=False
+                )
+                if not actualizadas:
+                    db.add(UsoTokensDiario(
+                        usuario_id=usuario_id, fecha=fecha, input_tokens=entrada,
+                        output_tokens=salida, llamadas=llamadas, updated_at=ahora
+                    ))
+            db.commit()
+        except Exception as e:
+            # Otro proceso insertó la misma fila o la BD falló: se reintenta en
+            # el próximo volcado (la fila ya existirá y será un UPDATE)
+            db.rollback()
+            self.flush_errors += 1
+            logger.error(f"Error volcando uso de tokens ({len(lote)} claves): {e}")
+            with self._lock:
+                for clave, deltas in self._volcando.items():
+                    pendiente = self._pendientes.setdefault(clave, [0, 0, 0])
+                    for i, delta in enumerate(deltas):
+                        pendiente[i] += delta
+                self._volcando = {}
+            return
+        finally:
+            db.close()
+        with self._lock:
+            # Lo volcado pasa a la base leída (si la había) para no contarlo dos veces
+            for clave, (entrada, salida, _) in lote.items():
+                if clave in self._base:
+                    total, leido = self._base[clave]
+                    self._base[clave] = (total + entrada + salida, leido)
+            self._volcando = {}
+            # Bases de días anteriores ya no sirven
+            hoy = _hoy()
+            for clave in [clave for clave in self._base if clave[1] != hoy]:
+                del self._base[clave]
+        self.flushes += 1
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await asyncio.to_thread(self.flush)
+    async def start(self):
+        self._wakeup = asyncio.Event()  # Ligado al loop en curso
+        self._task = asyncio.create_task(self._loop())
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.flush)
+    def history(self, user_id: int, days: int) -> List[Dict[str, Any]]:
+        # Días con uso, del más reciente al más antiguo; el de hoy incluye lo pendiente
+        desde = _hoy() - timedelta(days=days - 1)
+        db = self.session_factory()
+        try:
+            filas = db.query(UsoTokensDiario).filter(
+                UsoTokensDiario.usuario_id == user_id,
+                UsoTokensDiario.fecha >= desde
+            ).all()
+            por_dia = {
+                fila.fecha: [fila.input_tokens, fila.output_tokens, fila.llamadas] for fila in filas
+            }
+        finally:
+            db.close()
+        with self._lock:
+            for fuente in (self._volcando, self._pendientes):
+                for (usuario_id, fecha), deltas in fuente.items():
+                    if usuario_id == user_id and fecha >= desde:
+                        dia = por_dia.setdefault(fecha, [0, 0, 0])
+                        for i, delta in enumerate(deltas):
+                            dia[i] += delta
+        return [
+            {
+                "fecha": fecha.isoformat(),
+                "input_tokens": entrada,
+                "output_tokens": salida,
+                "total_tokens": entrada + salida,
+                "llamadas": llamadas,
+                "costo_usd": self.cost(entrada, salida)
+            }
+            for fecha, (entrada, salida, llamadas) in sorted(por_dia.items(), reverse=True)
+        ]
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pendientes = len(self._pendientes)
+        return {
+            "daily_limit": self.daily_limit,
+            "pending_keys": pendientes,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "rejected": self.rejected
+        }
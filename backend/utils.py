@@ -6,21 +6,41 @@ from typing import Optional, Any
 import logging
 logger = logging.getLogger(__name__)
 class SimpleCache:
-    def __init__(self, ttl: int = 300):
+    def __init__(self, ttl: int = 300, stale_ttl: int = 0, swr_ttl: int = 0):
         self.cache = {}
         self.ttl = ttl
+        self.stale_ttl = stale_ttl  # Tiempo extra en que una entrada vencida sirve como respaldo
+        self.swr_ttl = swr_ttl  # Tiempo extra en que se sirve vencida mientras se refresca
+        self.retention = ttl + max(stale_ttl, swr_ttl)
     def get(self, key: str) -> Optional[Any]:
         if key in self.cache:
             value, timestamp = self.cache[key]
-            if time() - timestamp < self.ttl:
+            age = time() - timestamp
+            if age < self.ttl:
                 logger.debug(f"Cache HIT: {key}")
                 return value
-            else:
+            elif age >= self.retention:
                 # Expiró
                 del self.cache[key]
                 logger.debug(f"Cache EXPIRED: {key}")
         logger.debug(f"Cache MISS: {key}")
         return None
+    def get_stale(self, key: str) -> Optional[Any]:
+        # Acepta entradas vencidas dentro de la ventana stale (p.ej. con la IA caída)
+        if key in self.cache:
+            value, timestamp = self.cache[key]
+            if time() - timestamp < self.ttl + self.stale_ttl:
+                logger.debug(f"Cache STALE HIT: {key}")
+                return value
+        return None
+    def get_swr(self, key: str) -> Optional[Any]:
+        # Stale-while-revalidate: vencida hace menos de swr_ttl (tras un get() que dio MISS)
+        if key in self.cache:
+            value, timestamp = self.cache[key]
+            if time() - timestamp < self.ttl + self.swr_ttl:
+                logger.debug(f"Cache SWR HIT: {key}")
+                return value
+        return None
     def set(self, key: str, value: Any):
         self.cache[key] = (value, time())
         logger.debug(f"Cache SET: {key}")
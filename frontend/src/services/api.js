@@ -32,6 +32,23 @@ const getAuthHeaders = () => {
   return headers;
 };
 
+/**
+ * Genera una Idempotency-Key (UUID v4)
+ * crypto.randomUUID solo existe en contextos seguros (HTTPS o localhost);
+ * en HTTP plano (p.ej. en la LAN) se arma desde crypto.getRandomValues
+ * @returns {string} UUID v4
+ */
+const generarIdempotencyKey = () => {
+  if (typeof crypto.randomUUID === 'function') {
+    return crypto.randomUUID();
+  }
+  const bytes = crypto.getRandomValues(new Uint8Array(16));
+  bytes[6] = (bytes[6] & 0x0f) | 0x40; // Versión 4
+  bytes[8] = (bytes[8] & 0x3f) | 0x80; // Variante RFC 4122
+  const hex = Array.from(bytes, (b) => b.toString(16).padStart(2, '0')).join('');
+  return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`;
+};
+
 export const api = {
   /**
    * Analiza una tarea ambigua usando la API (requiere autenticación)
@@ -40,13 +57,15 @@ export const api = {
    */
   async desambiguarTarea(texto) {
     let retryCount = 0;
+    // Misma clave en todos los reintentos: el backend no repite el análisis
+    const idempotencyKey = generarIdempotencyKey();
     
     try {
       const response = await fetchWithRetry(
         `${API_URL}/api/desambiguar`,
         {
           method: 'POST',
-          headers: getAuthHeaders(),
+          headers: { ...getAuthHeaders(), 'Idempotency-Key': idempotencyKey },
           body: JSON.stringify({ texto }),
         },
         {
@@ -1,142 +1,619 @@
 import os
 import json
+import hashlib
 import logging
-from typing import Dict, Any
-import google.generativeai as genai
+import random
+import contextvars
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from threading import Lock, Timer
+from time import monotonic, sleep
+from typing import Dict, Any, Callable, ContextManager, Iterator, List, Optional, Protocol, Tuple
 from dotenv import load_dotenv
 from .config import (
     GEMINI_MODEL,
     DEFAULT_TEMPERATURE,
-    MAX_OUTPUT_TOKENS,
 )
+from .json_stream import CAMPOS_RESULTADO, IncrementalResultParser, reparar_resultado
+from .prompts import ESQUEMA_RESPUESTA, PROMPT_SIMPLE, Prompt, PromptBuilder, estimar_tokens
+from .resilience import LatencyTracker, RetryBudget, backoff_delay, is_transient_error
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 # Cargar variables de entorno
 load_dotenv()
-# Prompt Engineering - La "Salsa Secreta"
-SYSTEM_PROMPT = (
-    """Eres un asistente especializado en gestión de proyectos """
-    """y planificación académica.
-"""
-    """Tu objetivo es ayudar a las personas a convertir """
-    """instrucciones vagas en pasos claros y concretos."""
-Analiza la siguiente tarea y proporciona tu respuesta en formato JSON válido con esta estructura:
-{
-  "pasos": [
-    "Lista de pasos concretos y accionables para completar la tarea",
-    "Cada paso debe comenzar con un verbo de acción",
-    "Ejemplo: Definir el alcance del proyecto"
-  ],
-  "ambiguedades": [
-    "Lista de información que falta o no está clara",
-    "Ejemplo: No se especifica la fecha de entrega exacta"
-  ],
-  "preguntas_sugeridas": [
-    "Preguntas específicas para clarificar las ambigüedades",
-    "Ejemplo: ¿Cuál es el formato requerido para el documento?"
-  ]
-}
-Responde ÚNICAMENTE con el JSON, sin texto adicional antes o después."""
-class AIService:
+# Configuración de seguridad - permitir todo
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+def _null_span(name: str, **attributes):
+    return nullcontext()
+class UsoTokens:
+    # Tokens de un análisis: suma de intentos, reintentos y hedges que
+    # terminaron antes de devolver el resultado
     def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = Lock()  # Los hedges registran desde otro thread
+    def add(self, input_tokens: int, output_tokens: int):
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {"input_tokens": self.input_tokens, "output_tokens": self.output_tokens}
+# Acumulador del análisis en curso (los hedges heredan el contexto)
+_uso_actual: contextvars.ContextVar[Optional[UsoTokens]] = contextvars.ContextVar(
+    "uso_tokens", default=None
+)
+# Future del análisis en curso que se completa con el primer resultado válido
+# (ver desambiguar_tarea); un hedge que gana lo completa desde su thread
+_entrega_actual: contextvars.ContextVar[Optional[Tuple[Future, UsoTokens]]] = contextvars.ContextVar(
+    "entrega_resultado", default=None
+)
+def _entregar(entrega: Future, resultado: Dict[str, Any]) -> bool:
+    # True si este resultado fue el primero (el hedge y el primario compiten)
+    try:
+        entrega.set_result(resultado)
+        return True
+    except InvalidStateError:
+        return False
+class RespuestaMalformadaError(Exception):
+    pass
+class RespuestaBloqueadaError(Exception):
+    pass
+# Códigos de fallos deterministas: repetir el mismo texto da el mismo error,
+# así que el llamador puede cachearlos un rato (cache negativo)
+ERROR_SAFETY = "safety"
+ERROR_MALFORMADA = "malformed"
+def codigo_error(error: Exception) -> Optional[str]:
+    if isinstance(error, RespuestaBloqueadaError):
+        return ERROR_SAFETY
+    if isinstance(error, RespuestaMalformadaError):
+        return ERROR_MALFORMADA
+    return None
+# Valores de FinishReason de la API de Gemini
+FINISH_REASON_STOP = 1
+FINISH_REASON_MAX_TOKENS = 2
+FINISH_REASON_SAFETY = 3
+@dataclass
+class Generacion:
+    text: str
+    finish_reason: int = FINISH_REASON_STOP
+    input_tokens: Optional[int] = None  # None si el backend no reporta uso
+    output_tokens: Optional[int] = None
+class AIBackend(Protocol):
+    # Proveedor del modelo: AIService arma prompts, parsea, reintenta y hace hedging.
+    # system_instruction va por el canal de instrucciones del modelo, no concatenada;
+    # con response_schema el modelo debe responder JSON que cumpla ese esquema.
+    name: str
+    def generate(self, prompt: str, temperature: float, max_output_tokens: int,
+                 system_instruction: Optional[str] = None,
+                 response_schema: Optional[Dict[str, Any]] = None) -> Generacion:
+        ...
+    def generate_stream(self, prompt: str, temperature: float, max_output_tokens: int,
+                        system_instruction: Optional[str] = None,
+                        response_schema: Optional[Dict[str, Any]] = None,
+                        on_usage: Optional[Callable[[int, int], None]] = None) -> Iterator[str]:
+        # on_usage(tokens_entrada, tokens_salida) al terminar, si el backend lo reporta
+        ...
+class GeminiBackend:
+    name = "gemini"
+    def __init__(self, model: str = GEMINI_MODEL):
+        import google.generativeai as genai  # Solo requerido con este backend
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEY no configurada en .env")
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(GEMINI_MODEL)
-        logger.info(f"Gemini inicializado con modelo: {GEMINI_MODEL}")
-    def desambiguar_tarea(self, texto_tarea: str) -> Dict[str, Any]:
-        prompt_usuario = f"""Analiza la siguiente tarea o instrucción:
-"{texto_tarea}"
-Desglósala en pasos concretos e identifica qué información falta o es ambigua.
-Responde en formato JSON como se indicó."""
+        self._genai = genai
+        self.model_name = model
+        self.model = genai.GenerativeModel(model)
+        # El SDK fija la system instruction al crear el modelo: uno por instrucción
+        self._modelos: Dict[str, Any] = {}
+        logger.info(f"Gemini inicializado con modelo: {model}")
+    def _modelo(self, system_instruction: Optional[str]):
+        if not system_instruction:
+            return self.model
+        modelo = self._modelos.get(system_instruction)
+        if modelo is None:
+            modelo = self._genai.GenerativeModel(self.model_name, system_instruction=system_instruction)
+            self._modelos[system_instruction] = modelo
+        return modelo
+    @staticmethod
+    def _config(temperature: float, max_output_tokens: int,
+                response_schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        config = {"temperature": temperature, "max_output_tokens": max_output_tokens}
+        if response_schema:
+            config["response_mime_type"] = "application/json"
+            config["response_schema"] = response_schema
+        return config
+    @staticmethod
+    def _uso(response) -> Tuple[Optional[int], Optional[int]]:
+        uso = getattr(response, "usage_metadata", None)
+        if not uso:
+            return None, None
+        return uso.prompt_token_count, uso.candidates_token_count
+    def generate(self, prompt: str, temperature: float, max_output_tokens: int,
+                 system_instruction: Optional[str] = None,
+                 response_schema: Optional[Dict[str, Any]] = None) -> Generacion:
+        response = self._modelo(system_instruction).generate_content(
+            prompt,
+            generation_config=self._config(temperature, max_output_tokens, response_schema),
+            safety_settings=SAFETY_SETTINGS
+        )
+        finish_reason = (
+            int(response.candidates[0].finish_reason)
+            if response.candidates else FINISH_REASON_STOP
+        )
+        input_tokens, output_tokens = self._uso(response)
+        if finish_reason == FINISH_REASON_SAFETY:
+            return Generacion("", finish_reason, input_tokens, output_tokens)
+        try:
+            texto = response.text
+        except ValueError:
+            texto = ""  # Sin partes (p.ej. presupuesto agotado antes de responder)
+        if not texto and finish_reason != FINISH_REASON_MAX_TOKENS:
+            raise Exception(
+                f"Gemini no generó una respuesta válida. "
+                f"Código de finalización: {finish_reason}"
+            )
+        return Generacion(texto, finish_reason, input_tokens, output_tokens)
+    def generate_stream(self, prompt: str, temperature: float, max_output_tokens: int,
+                        system_instruction: Optional[str] = None,
+                        response_schema: Optional[Dict[str, Any]] = None,
+                        on_usage: Optional[Callable[[int, int], None]] = None) -> Iterator[str]:
+        response = self._modelo(system_instruction).generate_content(
+            prompt,
+            generation_config=self._config(temperature, max_output_tokens, response_schema),
+            safety_settings=SAFETY_SETTINGS,
+            stream=True
+        )
+        uso = (None, None)
+        for chunk in response:
+            if getattr(chunk, "usage_metadata", None):
+                uso = self._uso(chunk)  # Acumulado: el último chunk trae el total
+            try:
+                yield chunk.text
+            except ValueError:
+                # Chunk sin partes (p.ej. corte por SAFETY)
+                continue
+        if on_usage and uso[0] is not None:
+            on_usage(*uso)
+class FakeBackendError(Exception):
+    # Imita un 503 del proveedor (code como google.api_core) para ejercitar
+    # reintentos y breaker
+    code = 503
+class FakeBackend:
+    # Modelo local determinístico para pruebas de carga sin cuota: el mismo
+    # prompt produce siempre el mismo JSON. Latencia lognormal (mediana y
+    # sigma) y tasas configurables de errores, cortes SAFETY y JSON roto.
+    name = "fake"
+    def __init__(self, latency_median_ms: float = 800.0, latency_sigma: float = 0.5,
+                 error_rate: float = 0.0, safety_rate: float = 0.0,
+                 malformed_rate: float = 0.0, seed: Optional[int] = None,
+                 chunk_size: int = 40):
+        self.latency_median = latency_median_ms / 1000
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.safety_rate = safety_rate
+        self.malformed_rate = malformed_rate
+        self.chunk_size = chunk_size
+        self._rng = random.Random(seed)
+        self._lock = Lock()  # random.Random no es seguro entre threads
+        logger.info("Backend de IA falso inicializado (sin llamadas a Gemini)")
+    def _sortear(self) -> Tuple[float, float]:
+        with self._lock:
+            latencia = self._rng.lognormvariate(0.0, self.latency_sigma) * self.latency_median
+            return latencia, self._rng.random()
+    @staticmethod
+    def _respuesta(prompt: str) -> Dict[str, List[str]]:
+        semilla = int(hashlib.sha256(prompt.encode()).hexdigest()[:8], 16)
+        rng = random.Random(semilla)
+        citas = [linea.strip('"') for linea in prompt.splitlines() if linea.startswith('"')]
+        tema = citas[0][:60] if citas else "la tarea"
+        return {
+            "pasos": [f"Paso {i}: definir y ejecutar la parte {i} de {tema}"
+                      for i in range(1, rng.randint(3, 7))],
+            "ambiguedades": [f"No se especifica el detalle {i}" for i in range(1, rng.randint(2, 4))],
+            "preguntas_sugeridas": [f"¿Cuál es el criterio {i}?" for i in range(1, rng.randint(2, 4))]
+        }
+    def _generar(self, prompt: str, max_output_tokens: int,
+                 system_instruction: Optional[str]) -> Tuple[float, Generacion]:
+        latencia, sorteo = self._sortear()
+        if sorteo < self.error_rate:
+            sleep(latencia)
+            raise FakeBackendError("503 Service Unavailable (fake backend)")
+        sorteo -= self.error_rate
+        # Uso estimado como lo contaría el proveedor: instrucción + prompt
+        input_tokens = estimar_tokens((system_instruction or "") + prompt)
+        if sorteo < self.safety_rate:
+            return latencia, Generacion("", FINISH_REASON_SAFETY, input_tokens, 0)
+        texto = json.dumps(self._respuesta(prompt), ensure_ascii=False)
+        finish_reason = FINISH_REASON_STOP
+        if sorteo - self.safety_rate < self.malformed_rate:
+            texto = texto[:len(texto) * 2 // 3]  # JSON truncado
+        if estimar_tokens(texto) > max_output_tokens:
+            texto = texto[:max_output_tokens * 4]
+            finish_reason = FINISH_REASON_MAX_TOKENS
+        return latencia, Generacion(texto, finish_reason, input_tokens, estimar_tokens(texto))
+    def generate(self, prompt: str, temperature: float, max_output_tokens: int,
+                 system_instruction: Optional[str] = None,
+                 response_schema: Optional[Dict[str, Any]] = None) -> Generacion:
+        # Siempre responde JSON del esquema (salvo las fallas sorteadas)
+        latencia, generacion = self._generar(prompt, max_output_tokens, system_instruction)
+        sleep(latencia)
+        return generacion
+    def generate_stream(self, prompt: str, temperature: float, max_output_tokens: int,
+                        system_instruction: Optional[str] = None,
+                        response_schema: Optional[Dict[str, Any]] = None,
+                        on_usage: Optional[Callable[[int, int], None]] = None) -> Iterator[str]:
+        latencia, generacion = self._generar(prompt, max_output_tokens, system_instruction)
+        chunks = [
+            generacion.text[i:i + self.chunk_size]
+            for i in range(0, len(generacion.text), self.chunk_size)
+        ] or [""]
+        for chunk in chunks:
+            sleep(latencia / len(chunks))
+            if chunk:
+                yield chunk
+        if on_usage:
+            on_usage(generacion.input_tokens, generacion.output_tokens)
+def crear_backend(nombre: str = "gemini", **opciones) -> AIBackend:
+    if nombre == "gemini":
+        return GeminiBackend(**opciones)
+    if nombre == "fake":
+        return FakeBackend(**opciones)
+    raise ValueError(f"Backend de IA desconocido: {nombre}")
+class AIService:
+    def __init__(self, span_factory: Optional[Callable[..., ContextManager]] = None,
+                 backend: Optional[AIBackend] = None, max_retries: int = 2, retry_base_delay: float = 0.5,
+                 retry_max_delay: float = 4.0, retry_budget: Optional[RetryBudget] = None,
+                 hedge_enabled: bool = True, hedge_quantile: float = 0.95,
+                 hedge_min_delay: float = 2.0, hedge_min_samples: int = 20,
+                 hedge_workers: int = 32, prompt_builder: Optional[PromptBuilder] = None,
+                 structured_output: bool = True):
+        # span_factory permite al backend medir fases (tracing) sin acoplar este módulo
+        self._span = span_factory or _null_span
+        # Reintentos (errores transitorios y JSON mal formado) y hedging; ambos
+        # consumen del mismo presupuesto para no amplificar una caída
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retry_budget = retry_budget or RetryBudget()
+        self.hedge_enabled = hedge_enabled
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._latencias = LatencyTracker()
+        # Solo para hedges: el intento primario corre en el thread del llamador.
+        # Debe alcanzar para un hedge por llamada en curso (>= ai_concurrency_max)
+        self._hedge_pool = ThreadPoolExecutor(
+            max_workers=hedge_workers,
+            thread_name_prefix="gemini-hedge"
+        )
+        # responses: salidas parseadas; malformed: rechazadas por json.loads, de
+        # las cuales repaired se rescataron sin volver a llamar al modelo
+        self.stats = {
+            "retries": 0, "hedges": 0, "hedge_wins": 0, "budget_retries": 0,
+            "responses": 0, "malformed": 0, "repaired": 0
+        }
+        self.backend = backend or GeminiBackend()
+        # Prompt versionado (system instruction + tarea) y presupuesto de salida
+        self.prompts = prompt_builder or PromptBuilder()
+        # Salida JSON restringida por esquema (response_mime_type + response_schema)
+        self.response_schema = ESQUEMA_RESPUESTA if structured_output else None
+        # Tokens por versión de prompt; se actualiza desde varios threads
+        self._uso: Dict[str, Dict[str, int]] = {}
+        self._uso_lock = Lock()
+    def desambiguar_tarea(self, texto_tarea: str, deadline: Optional[float] = None,
+                          entrega: Optional[Future] = None) -> Dict[str, Any]:
+        # deadline: instante (time.monotonic) tras el cual no vale la pena reintentar.
+        # El resultado (también el de error) incluye "uso" con los tokens consumidos;
+        # el de error trae "codigo" si el fallo es determinista (ver codigo_error).
+        # entrega: se completa con el primer resultado, que puede ser el de un hedge
+        # mientras este thread sigue esperando al primario (no se puede cancelar);
+        # el llamador puede esperarla en lugar del thread.
+        prompt = self.prompts.build(texto_tarea)
+        uso = UsoTokens()
+        token = _uso_actual.set(uso)
+        token_entrega = _entrega_actual.set((entrega, uso) if entrega is not None else None)
         try:
-            return self._procesar_con_gemini(prompt_usuario)
+            resultado = self._procesar_con_reintentos(prompt, deadline)
         except Exception as e:
             logger.error(f"Error al procesar con Gemini: {str(e)}")
-            return {
+            resultado = {
                 "error": f"Error al procesar con Gemini: {str(e)}",
                 "pasos": [],
                 "ambiguedades": [],
                 "preguntas_sugeridas": []
             }
-    def _procesar_con_gemini(self, prompt_usuario: str) -> Dict[str, Any]:
-        prompt_completo = f"{SYSTEM_PROMPT}\n\nTarea a analizar:\n{prompt_usuario}"
-        # Configuración de generación
-        generation_config = {
-            "temperature": DEFAULT_TEMPERATURE,
-            "max_output_tokens": MAX_OUTPUT_TOKENS,
-        }
-        # Configuración de seguridad - permitir todo
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
-        response = self.model.generate_content(
-            prompt_completo,
-            generation_config=generation_config,
-            safety_settings=safety_settings
+            codigo = codigo_error(e)
+            if codigo:
+                resultado["codigo"] = codigo
+        finally:
+            _uso_actual.reset(token)
+            _entrega_actual.reset(token_entrega)
+        resultado["uso"] = uso.as_dict()
+        if entrega is not None:
+            _entregar(entrega, resultado)
+        return resultado
+    def _procesar_con_reintentos(self, prompt: Prompt,
+                                 deadline: Optional[float] = None) -> Dict[str, Any]:
+        self.retry_budget.record_request()
+        intento = 0
+        while True:
+            try:
+                return self._procesar_con_hedge(prompt, deadline)
+            except Exception as e:
+                if not (isinstance(e, RespuestaMalformadaError) or is_transient_error(e)):
+                    raise
+                if intento >= self.max_retries:
+                    raise
+                espera = backoff_delay(intento, self.retry_base_delay, self.retry_max_delay)
+                if deadline is not None and monotonic() + espera >= deadline:
+                    raise
+                if not self.retry_budget.try_spend():
+                    logger.warning("Presupuesto de reintentos agotado, sin reintentar")
+                    raise
+                intento += 1
+                self.stats["retries"] += 1
+                logger.warning(f"Reintento {intento}/{self.max_retries} en {espera:.2f}s: {e}")
+                sleep(espera)
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge_enabled or self._latencias.count() < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, self._latencias.percentile(self.hedge_quantile))
+    def _procesar_con_hedge(self, prompt: Prompt,
+                            deadline: Optional[float] = None) -> Dict[str, Any]:
+        delay = self._hedge_delay()
+        inicio = monotonic()
+        if delay is None or (deadline is not None and monotonic() + delay >= deadline):
+            resultado = self._procesar_con_gemini(prompt)
+            self._latencias.observe(monotonic() - inicio)
+            return resultado
+        # Hedging: el primario corre en este thread; si supera el p95, un timer
+        # lanza un segundo intento en el pool y gana el primer resultado válido
+        # (el perdedor no se puede cancelar y termina en segundo plano)
+        contexto = contextvars.copy_context()  # Spans y uso del request en el hedge
+        entrega = _entrega_actual.get()
+        lock = Lock()
+        # terminado: el primario volvió (ya no se lanza un hedge);
+        # primario_ok: su resultado es el que vale
+        estado: Dict[str, Any] = {"terminado": False, "primario_ok": False, "hedge": None, "ganador": None}
+        def hedge_listo(futuro: Future):
+            if futuro.exception() is not None:
+                return
+            resultado = futuro.result()
+            with lock:
+                if estado["primario_ok"] or estado["ganador"] is not None:
+                    return
+                estado["ganador"] = resultado
+            self.stats["hedge_wins"] += 1
+            self._latencias.observe(monotonic() - inicio)
+            if entrega is not None:
+                futuro_entrega, uso = entrega
+                _entregar(futuro_entrega, {**resultado, "uso": uso.as_dict()})
+        def lanzar_hedge():
+            with lock:
+                if estado["terminado"] or not self.retry_budget.try_spend():
+                    return
+                self.stats["hedges"] += 1
+                logger.info(f"Hedging: segundo intento tras {delay:.2f}s")
+                estado["hedge"] = self._hedge_pool.submit(
+                    contexto.run, self._procesar_con_gemini, prompt
+                )
+            estado["hedge"].add_done_callback(hedge_listo)
+        timer = Timer(delay, lanzar_hedge)
+        timer.daemon = True
+        timer.start()
+        try:
+            resultado, error = self._procesar_con_gemini(prompt), None
+        except Exception as e:
+            resultado, error = None, e
+        finally:
+            timer.cancel()
+        with lock:
+            # También si falló: timer.cancel() no frena un timer que ya disparó,
+            # y un hedge lanzado después de leer estado["hedge"] quedaría huérfano
+            estado["terminado"] = True
+            if error is None and estado["ganador"] is None:
+                estado["primario_ok"] = True
+            hedge, ganador = estado["hedge"], estado["ganador"]
+        if ganador is not None:
+            return ganador  # Lo que ya recibió el llamador
+        if error is None:
+            self._latencias.observe(monotonic() - inicio)
+            return resultado
+        if hedge is None:
+            raise error
+        # El primario falló: queda el hedge en curso
+        try:
+            hedge.result()
+        except Exception:
+            raise error
+        with lock:
+            ganador = estado["ganador"]
+        return ganador if ganador is not None else hedge.result()
+    def _generar(self, nombre_span: str, prompt: Prompt, usuario: str,
+                 system_instruction: Optional[str], temperature: float,
+                 max_output_tokens: int) -> Generacion:
+        with self._span(nombre_span, backend=self.backend.name, prompt_version=prompt.version,
+                        max_output_tokens=max_output_tokens):
+            generacion = self.backend.generate(
+                usuario,
+                temperature=temperature,
+                max_output_tokens=max_output_tokens,
+                system_instruction=system_instruction,
+                response_schema=self.response_schema
+            )
+        self._registrar_uso(
+            prompt.version,
+            generacion.input_tokens, generacion.output_tokens,
+            (system_instruction or "") + usuario, generacion.text,
+            max_output_tokens, generacion.finish_reason
         )
+        return generacion
+    def _procesar_con_gemini(self, prompt: Prompt) -> Dict[str, Any]:
+        generacion = self._generar(
+            "gemini.generate", prompt, prompt.usuario, prompt.system_instruction,
+            DEFAULT_TEMPERATURE, prompt.max_output_tokens
+        )
+        if (generacion.finish_reason == FINISH_REASON_MAX_TOKENS
+                and prompt.max_output_tokens < self.prompts.max_output_tokens):
+            # Presupuesto corto para esta tarea: una sola vez con el tope
+            self.stats["budget_retries"] += 1
+            logger.warning(
+                f"Respuesta cortada en {prompt.max_output_tokens} tokens, "
+                f"repitiendo con {self.prompts.max_output_tokens}"
+            )
+            generacion = self._generar(
+                "gemini.budget_retry", prompt, prompt.usuario, prompt.system_instruction,
+                DEFAULT_TEMPERATURE, self.prompts.max_output_tokens
+            )
         # Verificar el finish_reason
-        if response.candidates and len(response.candidates) > 0:
-            finish_reason = response.candidates[0].finish_reason
-            if finish_reason == 2:  # SAFETY
-                # Intentar de nuevo con un prompt más simple
-                prompt_simple = f"""Analiza esta tarea y responde en JSON:
-Tarea: {prompt_usuario.split(':', 1)[-1].strip().replace('"', '')}
-Formato de respuesta (JSON):
-{{
-  "pasos": ["paso 1", "paso 2", "paso 3"],
-  "ambiguedades": ["info faltante 1", "info faltante 2"],
-  "preguntas_sugeridas": ["pregunta 1", "pregunta 2"]
-}}"""
-                response = self.model.generate_content(
-                    prompt_simple,
-                    generation_config={"temperature": 0.3, "max_output_tokens": 2048},
-                    safety_settings=safety_settings
-                )
+        if generacion.finish_reason == FINISH_REASON_SAFETY:
+            # Intentar de nuevo con un prompt más simple
+            prompt_simple = PROMPT_SIMPLE.format(texto=prompt.texto.replace('"', ''))
+            generacion = self._generar(
+                "gemini.safety_retry", prompt, prompt_simple, None,
+                0.3, prompt.max_output_tokens
+            )
         # Verificar que hay respuesta
-        if not response.text:
-            finish_reason = (
-                response.candidates[0].finish_reason
-                if response.candidates
-                else 'desconocido'
+        if not generacion.text and generacion.finish_reason == FINISH_REASON_SAFETY:
+            raise RespuestaBloqueadaError(
+                "Gemini bloqueó la respuesta por filtros de seguridad, también con el prompt simple"
             )
+        if not generacion.text:
             raise Exception(
                 f"Gemini no generó una respuesta válida. "
-                f"Código de finalización: {finish_reason}"
+                f"Código de finalización: {generacion.finish_reason}"
             )
-        # Gemini a veces devuelve el JSON dentro de markdown code blocks
-        texto = response.text.strip()
-        # Limpiar markdown code blocks
-        if texto.startswith("```json"):
-            texto = texto[7:]
-        elif texto.startswith("```"):
-            texto = texto[3:]
-        if texto.endswith("```"):
-            texto = texto[:-3]
-        texto = texto.strip()
-        # Logging para debug (solo en desarrollo)
+        with self._span("gemini.parse"):
+            return self._parsear_respuesta(generacion.text)
+    def _parsear_respuesta(self, texto: str) -> Dict[str, Any]:
+        self.stats["responses"] += 1
         logger.debug(f"Respuesta de Gemini (primeros 500 chars): {texto[:500]}")
-        # Intentar parsear JSON con mejor manejo de errores
         try:
             resultado = json.loads(texto)
-            logger.info("JSON parseado exitosamente")
-            # Validar que tenga las claves necesarias
-            required_keys = ["pasos", "ambiguedades", "preguntas_sugeridas"]
-            if not all(key in resultado for key in required_keys):
-                logger.warning(f"JSON incompleto. Claves presentes: {list(resultado.keys())}")
-                # Agregar claves faltantes con valores por defecto
-                for key in required_keys:
-                    if key not in resultado:
-                        resultado[key] = []
-            return resultado
         except json.JSONDecodeError as e:
-            logger.error(f"Error parseando JSON: {e}")
-            raise Exception(f"JSON incompleto o mal formado. Por favor, intenta de nuevo.")
+            logger.warning(f"Salida de Gemini no es JSON válido: {e}")
+            resultado = None
+        if not isinstance(resultado, dict):
+            # Texto alrededor del JSON (markdown) o salida truncada: rescatar
+            # lo posible antes de pagar otra llamada al modelo
+            self.stats["malformed"] += 1
+            resultado, completo = reparar_resultado(texto)
+            if resultado is None or not (completo or resultado["pasos"]):
+                # Sin ningún paso completo no vale como respuesta parcial
+                logger.error("Error parseando JSON: nada rescatable en la respuesta")
+                raise RespuestaMalformadaError("JSON incompleto o mal formado. Por favor, intenta de nuevo.")
+            self.stats["repaired"] += 1
+            if not completo:
+                logger.warning("JSON truncado; usando los ítems completos")
+                resultado["parcial"] = True
+        # Validar que tenga las claves necesarias
+        faltantes = [campo for campo in CAMPOS_RESULTADO if campo not in resultado]
+        if faltantes:
+            logger.warning(f"JSON incompleto. Claves presentes: {list(resultado.keys())}")
+            for campo in faltantes:
+                resultado[campo] = []
+        return resultado
+    def _registrar_uso(self, version: str, input_tokens: Optional[int],
+                       output_tokens: Optional[int], entrada: str, salida: str,
+                       max_output_tokens: int, finish_reason: int) -> Tuple[int, int]:
+        estimado = input_tokens is None or output_tokens is None
+        if input_tokens is None:
+            input_tokens = estimar_tokens(entrada)
+        if output_tokens is None:
+            output_tokens = estimar_tokens(salida) if salida else 0
+        logger.info(
+            f"Uso IA: prompt={version}, tokens_entrada={input_tokens}, "
+            f"tokens_salida={output_tokens}, max_salida={max_output_tokens}, "
+            f"fin={finish_reason}{' (estimado)' if estimado else ''}"
+        )
+        with self._uso_lock:
+            uso = self._uso.setdefault(
+                version, {"calls": 0, "input_tokens": 0, "output_tokens": 0, "truncated": 0}
+            )
+            uso["calls"] += 1
+            uso["input_tokens"] += input_tokens
+            uso["output_tokens"] += output_tokens
+            if finish_reason == FINISH_REASON_MAX_TOKENS:
+                uso["truncated"] += 1
+        uso_analisis = _uso_actual.get()
+        if uso_analisis is not None:
+            uso_analisis.add(input_tokens, output_tokens)
+        return input_tokens, output_tokens
+    def get_token_stats(self) -> Dict[str, Any]:
+        with self._uso_lock:
+            por_version = {version: dict(uso) for version, uso in self._uso.items()}
+        for uso in por_version.values():
+            uso["avg_input_tokens"] = round(uso["input_tokens"] / uso["calls"], 1)
+            uso["avg_output_tokens"] = round(uso["output_tokens"] / uso["calls"], 1)
+        return {
+            "prompt_version": self.prompts.version,
+            "min_output_tokens": self.prompts.min_output_tokens,
+            "max_output_tokens": self.prompts.max_output_tokens,
+            "by_version": por_version
+        }
+    def get_resilience_stats(self) -> Dict[str, Any]:
+        p95 = self._latencias.percentile(0.95)
+        respuestas = self.stats["responses"]
+        return {
+            **self.stats,
+            "malformed_rate": round(self.stats["malformed"] / respuestas, 4) if respuestas else 0.0,
+            "hedge_delay_s": self._hedge_delay(),
+            "p95_s": round(p95, 3) if p95 is not None else None,
+            "retry_budget": self.retry_budget.get_stats()
+        }
+    def desambiguar_tarea_stream(self, texto_tarea: str) -> Iterator[Tuple[str, Any]]:
+        # Emite ("item", (campo, texto)) a medida que Gemini genera y al final
+        # ("resultado", dict). Los errores se propagan como excepciones.
+        prompt = self.prompts.build(texto_tarea)
+        parser = IncrementalResultParser()
+        partes = []
+        uso: Dict[str, int] = {}
+        # Sin spans aquí: cada chunk se consume desde un thread distinto
+        chunks = self.backend.generate_stream(
+            prompt.usuario,
+            temperature=DEFAULT_TEMPERATURE,
+            max_output_tokens=prompt.max_output_tokens,
+            system_instruction=prompt.system_instruction,
+            response_schema=self.response_schema,
+            on_usage=lambda entrada, salida: uso.update(entrada=entrada, salida=salida)
+        )
+        for texto in chunks:
+            partes.append(texto)
+            for campo, valor in parser.feed(texto):
+                yield "item", (campo, valor)
+        texto_completo = "".join(partes)
+        uso_analisis = UsoTokens()
+        uso_analisis.add(*self._registrar_uso(
+            prompt.version, uso.get("entrada"), uso.get("salida"),
+            prompt.system_instruction + prompt.usuario, texto_completo,
+            prompt.max_output_tokens, FINISH_REASON_STOP
+        ))
+        if not texto_completo.strip():
+            # Sin salida (SAFETY u otro corte): usar la ruta no-streaming con su reintento
+            logger.warning("Streaming sin contenido, reintentando sin streaming")
+            token = _uso_actual.set(uso_analisis)
+            try:
+                resultado = self._procesar_con_gemini(prompt)
+            finally:
+                _uso_actual.reset(token)
+            for campo in parser.campos:
+                for valor in resultado.get(campo, []):
+                    yield "item", (campo, valor)
+        else:
+            # Si el JSON final viene truncado, el reparador conserva los mismos
+            # ítems completos que ya se emitieron
+            resultado = self._parsear_respuesta(texto_completo)
+        resultado["uso"] = uso_analisis.as_dict()
+        yield "resultado", resultado
 # Función auxiliar para testing rápido
 def test_ai_service():
     servicio = AIService()
@@ -0,0 +1,90 @@
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+CAMPOS_RESULTADO = ("pasos", "ambiguedades", "preguntas_sugeridas")
+class IncrementalResultParser:
+    # Recorre el JSON a medida que llega y emite cada string completo de las
+    # listas de primer nivel (pasos, ambiguedades, preguntas_sugeridas) sin
+    # esperar a que el documento cierre. Ignora texto previo al primer "{"
+    # (p.ej. bloques ```json de markdown).
+    def __init__(self, campos: Sequence[str] = CAMPOS_RESULTADO):
+        self.campos = tuple(campos)
+        self.items: Dict[str, List[str]] = {campo: [] for campo in self.campos}
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._raw: List[str] = []
+        self._expect_key = False
+        self._current_key = None
+        self.done = False
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        eventos: List[Tuple[str, str]] = []
+        for ch in chunk:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._raw.append(ch)
+                elif ch == "\\":
+                    self._escape = True
+                    self._raw.append(ch)
+                elif ch == '"':
+                    self._in_string = False
+                    self._string_done("".join(self._raw), eventos)
+                else:
+                    self._raw.append(ch)
+                continue
+            if not self._stack:
+                if ch == "{" and not self.done:
+                    self._stack.append(ch)
+                    self._expect_key = True
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._raw = []
+            elif ch in "{[":
+                self._stack.append(ch)
+            elif ch in "}]":
+                self._stack.pop()
+                if not self._stack:
+                    self.done = True
+            elif len(self._stack) == 1:
+                if ch == ":":
+                    self._expect_key = False
+                elif ch == ",":
+                    self._expect_key = True
+        return eventos
+    def _string_done(self, raw: str, eventos: List[Tuple[str, str]]):
+        try:
+            valor = json.loads(f'"{raw}"')
+        except ValueError:
+            valor = raw
+        if len(self._stack) == 1 and self._expect_key:
+            self._current_key = valor
+        elif (
+            len(self._stack) == 2
+            and self._stack[1] == "["
+            and self._current_key in self.items
+        ):
+            self.items[self._current_key].append(valor)
+            eventos.append((self._current_key, valor))
+    def resultado(self) -> Dict[str, List[str]]:
+        return {campo: list(valores) for campo, valores in self.items.items()}
+def reparar_resultado(texto: str,
+                      campos: Sequence[str] = CAMPOS_RESULTADO) -> Tuple[Optional[Dict[str, Any]], bool]:
+    # Para salidas que json.loads rechaza. Devuelve (resultado, completo):
+    # - JSON válido rodeado de texto (p.ej. bloques ```json): completo
+    # - JSON truncado: los strings ya cerrados de cada lista, sin el último a medias
+    # - nada rescatable: (None, False)
+    inicio, fin = texto.find("{"), texto.rfind("}")
+    if inicio != -1 and fin > inicio:
+        try:
+            resultado = json.loads(texto[inicio:fin + 1])
+        except ValueError:
+            pass
+        else:
+            if isinstance(resultado, dict):
+                return resultado, True
+    parser = IncrementalResultParser(campos)
+    parser.feed(texto)
+    if not any(parser.items.values()):
+        return None, False
+    return parser.resultado(), False
@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from typing import Dict
+from .config import MAX_OUTPUT_TOKENS
+# Versión del prompt en uso. Cada llamada loguea versión y tokens para poder
+# comparar costo y latencia entre versiones (AI_PROMPT_VERSION).
+PROMPT_VERSION = "v2"
+@dataclass(frozen=True)
+class PlantillaPrompt:
+    version: str
+    system_instruction: str
+    usuario: str  # Plantilla con {texto}
+# v1: el prompt original, con ejemplos dentro de la estructura JSON
+_SYSTEM_V1 = (
+    """Eres un asistente especializado en gestión de proyectos """
+    """y planificación académica.
+"""
+    """Tu objetivo es ayudar a las personas a convertir """
+    """instrucciones vagas en pasos claros y concretos.
+Analiza la siguiente tarea y proporciona tu respuesta en formato JSON válido con esta estructura:
+{
+  "pasos": [
+    "Lista de pasos concretos y accionables para completar la tarea",
+    "Cada paso debe comenzar con un verbo de acción",
+    "Ejemplo: Definir el alcance del proyecto"
+  ],
+  "ambiguedades": [
+    "Lista de información que falta o no está clara",
+    "Ejemplo: No se especifica la fecha de entrega exacta"
+  ],
+  "preguntas_sugeridas": [
+    "Preguntas específicas para clarificar las ambigüedades",
+    "Ejemplo: ¿Cuál es el formato requerido para el documento?"
+  ]
+}
+Responde ÚNICAMENTE con el JSON, sin texto adicional antes o después."""
+)
+_USUARIO_V1 = """Analiza la siguiente tarea o instrucción:
+"{texto}"
+Desglósala en pasos concretos e identifica qué información falta o es ambigua.
+Responde en formato JSON como se indicó."""
+# v2: esquema compacto, sin ejemplos ni texto repetido en cada tarea
+_SYSTEM_V2 = """Convierte instrucciones vagas en pasos concretos (gestión de proyectos y planificación académica).
+Responde solo con JSON: {"pasos":[str],"ambiguedades":[str],"preguntas_sugeridas":[str]}
+pasos: acciones concretas, cada una empieza con un verbo.
+ambiguedades: información que falta o no está clara.
+preguntas_sugeridas: preguntas para aclarar las ambigüedades."""
+_USUARIO_V2 = 'Tarea:\n"{texto}"'
+PLANTILLAS: Dict[str, PlantillaPrompt] = {
+    "v1": PlantillaPrompt("v1", _SYSTEM_V1, _USUARIO_V1),
+    "v2": PlantillaPrompt("v2", _SYSTEM_V2, _USUARIO_V2),
+}
+# Esquema de salida para el modo estructurado (response_schema de Gemini)
+_LISTA_STRINGS = {"type": "array", "items": {"type": "string"}}
+ESQUEMA_RESPUESTA = {
+    "type": "object",
+    "properties": {
+        "pasos": _LISTA_STRINGS,
+        "ambiguedades": _LISTA_STRINGS,
+        "preguntas_sugeridas": _LISTA_STRINGS,
+    },
+    "required": ["pasos", "ambiguedades", "preguntas_sugeridas"],
+}
+# Prompt de respaldo tras un corte por SAFETY: sin system instruction
+PROMPT_SIMPLE = """Analiza esta tarea y responde en JSON:
+Tarea: {texto}
+Formato de respuesta (JSON):
+{{
+  "pasos": ["paso 1", "paso 2", "paso 3"],
+  "ambiguedades": ["info faltante 1", "info faltante 2"],
+  "preguntas_sugeridas": ["pregunta 1", "pregunta 2"]
+}}"""
+def estimar_tokens(texto: str) -> int:
+    # ~4 caracteres por token en español; solo cuando el backend no reporta uso
+    return max(1, (len(texto) + 3) // 4)
+@dataclass(frozen=True)
+class Prompt:
+    texto: str  # Tarea original (para el prompt de respaldo)
+    version: str
+    system_instruction: str
+    usuario: str
+    max_output_tokens: int
+class PromptBuilder:
+    # Arma el prompt de una tarea y su presupuesto de tokens de salida:
+    # `min_output_tokens` + `output_tokens_ratio` tokens por token de la tarea,
+    # con tope en `max_output_tokens`. Si la respuesta se corta por el
+    # presupuesto, AIService repite una vez con el tope.
+    def __init__(self, version: str = PROMPT_VERSION, min_output_tokens: int = 1024,
+                 output_tokens_ratio: float = 2.0, max_output_tokens: int = MAX_OUTPUT_TOKENS):
+        if version not in PLANTILLAS:
+            raise ValueError(f"Versión de prompt desconocida: {version}")
+        self.plantilla = PLANTILLAS[version]
+        self.min_output_tokens = min(min_output_tokens, max_output_tokens)
+        self.output_tokens_ratio = output_tokens_ratio
+        self.max_output_tokens = max_output_tokens
+    @property
+    def version(self) -> str:
+        return self.plantilla.version
+    def presupuesto_salida(self, texto: str) -> int:
+        presupuesto = self.min_output_tokens + int(self.output_tokens_ratio * estimar_tokens(texto))
+        return min(presupuesto, self.max_output_tokens)
+    def build(self, texto: str) -> Prompt:
+        return Prompt(
+            texto=texto,
+            version=self.plantilla.version,
+            system_instruction=self.plantilla.system_instruction,
+            usuario=self.plantilla.usuario.format(texto=texto),
+            max_output_tokens=self.presupuesto_salida(texto)
+        )
@@ -0,0 +1,181 @@
+import logging
+import random
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Any, Deque, Dict, Optional
+logger = logging.getLogger(__name__)
+CIRCUITO_CERRADO = "closed"
+CIRCUITO_ABIERTO = "open"
+CIRCUITO_SEMIABIERTO = "half_open"
+class CircuitBreaker:
+    # Ventana deslizante de las últimas `window` llamadas. Una llamada cuenta
+    # como fallo si terminó con error o tardó más de `slow_call_seconds`.
+    # Con al menos `min_calls` y una tasa de fallos >= `failure_rate` se abre
+    # durante `open_seconds`; luego deja pasar `half_open_calls` sondas: si
+    # todas salen bien se cierra, con un fallo vuelve a abrirse.
+    def __init__(self, name: str = "gemini", failure_rate: float = 0.5,
+                 slow_call_seconds: float = 20.0, window: int = 20, min_calls: int = 10,
+                 open_seconds: float = 30.0, half_open_calls: int = 3):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._results: Deque[bool] = deque(maxlen=window)  # True = fallo
+        self._state = CIRCUITO_CERRADO
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = Lock()
+        self.rejected = 0
+        self.opened = 0
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh()
+            return self._state
+    def _refresh(self):
+        if self._state == CIRCUITO_ABIERTO and monotonic() - self._opened_at >= self.open_seconds:
+            self._state = CIRCUITO_SEMIABIERTO
+            self._probes = 0
+            self._probe_successes = 0
+            logger.info(f"Circuito {self.name}: semiabierto, probando recuperación")
+    def is_open(self) -> bool:
+        # Consulta sin consumir sondas (para rechazar antes de encolar)
+        return self.state == CIRCUITO_ABIERTO
+    def allow(self) -> bool:
+        # Reserva el paso de una llamada; toda llamada permitida debe reportar record()
+        with self._lock:
+            self._refresh()
+            if self._state == CIRCUITO_CERRADO:
+                return True
+            if self._state == CIRCUITO_SEMIABIERTO and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+    def record(self, success: bool, duration: float = 0.0):
+        fallo = not success or duration > self.slow_call_seconds
+        with self._lock:
+            if self._state == CIRCUITO_SEMIABIERTO:
+                if fallo:
+                    self._open()
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._state = CIRCUITO_CERRADO
+                        self._results.clear()
+                        logger.info(f"Circuito {self.name}: cerrado")
+                return
+            if self._state == CIRCUITO_ABIERTO:
+                return  # Llamadas iniciadas antes de abrir: no cambian nada
+            self._results.append(fallo)
+            if len(self._results) >= self.min_calls and self._failure_ratio() >= self.failure_rate:
+                self._open()
+    def _failure_ratio(self) -> float:
+        return sum(self._results) / len(self._results) if self._results else 0.0
+    def _open(self):
+        self._state = CIRCUITO_ABIERTO
+        self._opened_at = monotonic()
+        self.opened += 1
+        logger.warning(
+            f"Circuito {self.name}: abierto por {self.open_seconds:.0f}s "
+            f"(fallos={self._failure_ratio():.0%})"
+        )
+    def retry_after(self) -> int:
+        with self._lock:
+            restante = self.open_seconds - (monotonic() - self._opened_at)
+        return max(1, int(restante + 0.999))
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refresh()
+            return {
+                "state": self._state,
+                "failure_rate": round(self._failure_ratio(), 3),
+                "calls_in_window": len(self._results),
+                "rejected": self.rejected,
+                "opened": self.opened
+            }
+class RetryBudget:
+    # Presupuesto de reintentos/hedges: en la ventana, como máximo
+    # `min_retries` + `ratio` * requests. Evita que los reintentos multipliquen
+    # la carga sobre un proveedor que ya está fallando.
+    def __init__(self, ratio: float = 0.1, min_retries: int = 3, window_seconds: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window_seconds = window_seconds
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+        self._lock = Lock()
+        self.denied = 0
+    def _trim(self, now: float):
+        limite = now - self.window_seconds
+        for eventos in (self._requests, self._retries):
+            while eventos and eventos[0] < limite:
+                eventos.popleft()
+    def record_request(self):
+        with self._lock:
+            now = monotonic()
+            self._trim(now)
+            self._requests.append(now)
+    def try_spend(self) -> bool:
+        with self._lock:
+            now = monotonic()
+            self._trim(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+                self.denied += 1
+                return False
+            self._retries.append(now)
+            return True
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._trim(monotonic())
+            return {
+                "requests_in_window": len(self._requests),
+                "retries_in_window": len(self._retries),
+                "ratio": self.ratio,
+                "denied": self.denied
+            }
+class LatencyTracker:
+    # Últimas `window` latencias exitosas, para calcular el delay de hedging
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = Lock()
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+    def count(self) -> int:
+        return len(self._samples)
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordenadas = sorted(self._samples)
+        return ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))]
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    # "Full jitter": uniforme entre 0 y el backoff exponencial acotado
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+# Errores transitorios del SDK (google.api_core) y de red, por nombre para no
+# acoplar este módulo al SDK
+TRANSIENT_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+    "InternalServerError", "GatewayTimeout", "ConnectionError", "TimeoutError"
+}
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+def _status_code(error: BaseException) -> Optional[int]:
+    # google.api_core expone el HTTP status en .code; httpx/requests en
+    # .status_code o .response.status_code
+    for atributo in ("code", "status_code"):
+        valor = getattr(error, atributo, None)
+        if isinstance(valor, int):
+            return valor
+    valor = getattr(getattr(error, "response", None), "status_code", None)
+    return valor if isinstance(valor, int) else None
+def is_transient_error(error: BaseException) -> bool:
+    # Por tipo o status code, no por el mensaje: "500" o "timeout" pueden
+    # aparecer en el texto de errores que no se arreglan reintentando
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+    return _status_code(error) in TRANSIENT_STATUS_CODES